@@ -0,0 +1,117 @@
+import re
+import sys
+import threading
+from dataclasses import dataclass
+
+from cache import TTLCache
+from textvec import cosine, hashed_features, norm, tokenize
+
+ANSWER_CACHE_TTL = 6 * 60 * 60 # answers only change when the documents or prompts do
+ANSWER_CACHE_SIZE = 512
+ANSWER_CACHE_BYTES = 16 * 1024 * 1024
+NEAR_DUPLICATE_SIMILARITY = 0.85 # cosine similarity of hashed n-gram vectors, when near-duplicate lookups are on
+
+# Words that don't change what a question is about; a near duplicate must have exactly the same other words
+STOP_WORDS = frozenset(
+    "a an the of for in on to at by from with and or is are be was were do does did what which how when where "
+    "who i my we our you your me us there here".split()
+)
+
+# Questions that lean on earlier turns ("what about the other one?") can't be answered from a shared cache
+REFERS_TO_HISTORY = re.compile(
+    r"\b(?:it|its|that|this|these|those|they|them|above|previous(?:ly)?|earlier|again|same|also|else|more|instead|other)\b",
+    re.IGNORECASE,
+)
+
+@dataclass(frozen=True)
+class CachedAnswer:
+    query: str
+    category: str
+    answer: str
+    relative_paths: tuple
+    vector: dict
+    vector_norm: float
+
+def normalize_query(query):
+    return " ".join(tokenize(query))
+
+def content_text(normalized):
+    return " ".join(word for word in normalized.split() if word not in STOP_WORDS)
+
+def history_independent(question, chat_history):
+    return not chat_history or not REFERS_TO_HISTORY.search(question)
+
+def _sizeof(entry):
+    return (sys.getsizeof(entry.answer) + sys.getsizeof(entry.query)
+            + sum(sys.getsizeof(path) for path in entry.relative_paths) + 64 * len(entry.vector))
+
+class AnswerCache:
+    # Process-wide cache of final answers keyed on the normalized optimized query, the category and the
+    # pipeline config. An opt-in near-duplicate lookup (`similarity`) also matches a rephrasing with exactly the
+    # same content words, found through an index on those words, if its hashed n-gram vectors are close enough.
+
+    def __init__(self, ttl=ANSWER_CACHE_TTL, maxsize=ANSWER_CACHE_SIZE, max_bytes=ANSWER_CACHE_BYTES, similarity=None):
+        self.entries = TTLCache(ttl, maxsize=maxsize, max_bytes=max_bytes, sizeof=_sizeof)
+        self.similarity = similarity # None disables the near-duplicate lookup, e.g. NEAR_DUPLICATE_SIMILARITY
+        self.near = {} # (content words, category, config) -> key of the latest entry stored with them
+        self.hits = 0
+        self.misses = 0
+        self.near_hits = 0
+        self._lock = threading.Lock()
+
+    def _key(self, query, category, config):
+        return (normalize_query(query), category, tuple(config))
+
+    def _count(self, entry, near=False):
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.near_hits += near
+        return entry
+
+    def get(self, query, category, config):
+        key = self._key(query, category, config)
+        entry = self.entries.get(key)
+        if entry is not None or self.similarity is None:
+            return self._count(entry)
+
+        text = content_text(key[0])
+        with self._lock:
+            other_key = self.near.get((frozenset(text.split()), category, key[2]))
+        other = self.entries.get(other_key) if other_key is not None else None
+        if other is None:
+            return self._count(None)
+        vector = hashed_features(text)
+        if cosine(vector, other.vector, norm(vector), other.vector_norm) < self.similarity:
+            return self._count(None)
+        return self._count(other, near=True)
+
+    def put(self, query, category, config, answer, relative_paths):
+        key = self._key(query, category, config)
+        text = content_text(key[0])
+        vector = hashed_features(text) # word order of the content words, for the near-duplicate check
+        entry = CachedAnswer(query, category, answer, tuple(relative_paths), vector, norm(vector))
+        stored = self.entries.set(key, entry)
+        if stored and self.similarity is not None:
+            with self._lock:
+                self.near[frozenset(text.split()), category, key[2]] = key
+                if len(self.near) > 2 * self.entries.maxsize:
+                    # drop index entries whose answer was evicted or expired
+                    live = {key for key, _ in self.entries.items()}
+                    self.near = {words: key for words, key in self.near.items() if key in live}
+        return stored
+
+    def stats(self):
+        # the underlying cache's own counts include the second lookup of a near-duplicate
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(self.entries.stats(), hits=self.hits, misses=self.misses, near_hits=self.near_hits,
+                        hit_rate=self.hits / lookups if lookups else 0.0)
+
+_answer_cache = AnswerCache()
+
+def get_answer_cache():
+    # The process-wide instance; module state survives Streamlit reruns, so every session shares it
+    return _answer_cache
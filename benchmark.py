@@ -0,0 +1,390 @@
+import argparse
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from answer_cache import AnswerCache
+from cache import TTLCache
+from conversation_memory import ConversationMemory, make_llm_summarizer
+import doc_links
+from engine import MIN_SCORE, NUM_CHUNKS, Backends, RagEngine
+from fakes import CallLog, FakeComplete, FakeProvider, FakeSearchService, FakeSession, Latency, make_corpus
+from model_router import ModelRouter
+from pipeline import count_call, percentile
+from relevance_filter import RelevanceFilter
+from resilience import BACKOFF, DEFAULT_TIMEOUT, HEDGE_MIN_DELAY, REQUEST_DEADLINE, STAGE_TIMEOUTS, ResilientComplete
+from resources import SnowflakeResources
+from search_client import CachingSearchClient
+from session_pool import POOL_SIZE, SessionPool
+from tracing import Tracer
+
+# Offline benchmark of the request path against the latency-injecting fakes in fakes.py.
+# Needs no network or Snowflake account, e.g. `python benchmark.py --concurrency 8 --time-scale 0.1`
+
+QUESTIONS = [
+    "What are the structural integrity requirements for foundation systems in Vancouver for buildings over 100 feet tall, particularly in seismic zones?",
+    "What are the fire protection and smoke ventilation requirements for underground parking garages in Vancouver according to the BC Building Code?",
+    "What are the specific design requirements for load-bearing walls in multi-story commercial buildings under Vancouver's seismic regulations?",
+    "What are the ventilation system requirements for industrial facilities in Vancouver that handle hazardous materials to ensure worker safety?",
+    "What are the energy efficiency and insulation requirements for residential buildings in Vancouver, particularly in terms of thermal resistance (R-values)?",
+    "What are the construction site signage requirements for hazardous areas, such as those with high-voltage equipment, in Vancouver?",
+    "What are the requirements for soil contamination testing before commencing construction in Vancouver?",
+    "What is the minimum guardrail height for a balcony?",
+    "How many exits does an assembly occupancy need?",
+    "What does the plumbing code say about backflow prevention?",
+]
+
+def load_questions(path):
+    if path is None:
+        return list(QUESTIONS)
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line)["question"] for line in f if line.strip()]
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+class FakeBackends:
+    # One set of fakes sharing a call log, plus fresh caches so runs don't warm each other up
+
+    def __init__(self, args):
+        rng = random.Random(args.seed)
+        self.log = CallLog()
+        fake_complete = FakeComplete(scale=args.time_scale, rng=rng, log=self.log, failure_rate=args.failure_rate,
+                                     small_model_miss_rate=args.small_model_miss_rate)
+
+        def complete(model, prompt, stream=False):
+            # counted like the app's own wrapper around Complete
+            count_call("complete")
+            return fake_complete(model, prompt, stream=stream)
+
+        self.complete = complete
+        if args.resilient:
+            timeouts = {stage: timeout * args.time_scale for stage, timeout in STAGE_TIMEOUTS.items()}
+            self.complete = ResilientComplete(complete, stage_timeouts=timeouts, default_timeout=DEFAULT_TIMEOUT * args.time_scale,
+                                              backoff=BACKOFF * args.time_scale,
+                                              hedge_min_delay=HEDGE_MIN_DELAY * args.time_scale, rng=rng)
+        corpus = make_corpus(rng=rng)
+        self.svc = FakeSearchService(corpus, scale=args.time_scale, rng=rng, log=self.log)
+        self.session = FakeSession(scale=args.time_scale, rng=rng, log=self.log)
+        self.provider = FakeProvider(scale=args.time_scale, rng=rng, log=self.log)
+
+        self.search_client = self.svc if args.no_search_cache else CachingSearchClient(self.svc, name="bench", cache=TTLCache(60))
+        if args.local_index:
+            from local_index import FallbackSearchService, build_index # needs numpy
+            self.index_dir = tempfile.TemporaryDirectory(prefix="capstruct-index-")
+            self.search_client = FallbackSearchService(build_index(corpus, self.index_dir.name), self.search_client)
+        self.answer_cache = None if args.no_answer_cache else AnswerCache()
+        self.relevance_filter = RelevanceFilter(self.provider.context_relevance, MIN_SCORE, max_workers=NUM_CHUNKS,
+                                                cache=TTLCache(24 * 60 * 60))
+        doc_links._url_cache.clear()
+        self.tracer = Tracer(enabled=args.trace is not None, output=args.trace)
+
+def run_engine(backends, question, memory, stream):
+    engine = backends.engine
+    start = time.perf_counter()
+    answer = engine.answer_question(question, memory, stream=stream)
+    text = "".join(answer.stream)
+    engine.document_links(answer.relative_paths, answer.pipeline)
+    latency = time.perf_counter() - start
+    backends.tracer.finish(answer.pipeline, "engine")
+
+    memory.add("user", question)
+    memory.add("assistant", text)
+    breakdown = answer.pipeline.breakdown()
+    return {
+        "latency_s": latency,
+        "time_to_first_token_s": answer.stream.first_token_s,
+        "stages": {name: stage["duration_s"] for name, stage in breakdown["stages"].items() if not stage["discarded"]},
+        "calls": breakdown["calls"],
+        "cached": answer.cached,
+        "errors": answer.errors,
+    }
+
+def run_capstruct(backends, question, app, stream):
+    start = time.perf_counter()
+    app.query(question)
+    latency = time.perf_counter() - start
+    breakdown = app.last_breakdown
+    return {
+        "latency_s": latency,
+        "time_to_first_token_s": None, # CapstructAI.query does not stream
+        "stages": {name: stage["duration_s"] for name, stage in breakdown["stages"].items() if not stage["discarded"]},
+        "calls": breakdown["calls"],
+        "cached": False,
+        "errors": [],
+    }
+
+def make_target(name, backends, args):
+    # (run(backends, question, state, stream), new per-user state), or raises ImportError if unavailable here
+    if name == "engine":
+        urls = lambda paths: doc_links.get_presigned_urls(backends.session, paths)
+        deadline = REQUEST_DEADLINE * args.time_scale if args.resilient else None
+        model_router = ModelRouter(json.loads(args.models) if args.models else None)
+        backends.engine = RagEngine(Backends(backends.complete, backends.search_client, urls), backends.relevance_filter,
+                                    backends.answer_cache, request_deadline=deadline, model_router=model_router)
+        return run_engine, lambda: ConversationMemory(summarizer=make_llm_summarizer(backends.complete, model_router))
+
+    # CapstructAI lives next to the TruLens and Snowflake imports it is evaluated with
+    from trulens_eval import CapstructAI_v1
+    return run_capstruct, lambda: CapstructAI_v1(backends.search_client, backends.relevance_filter, backends.complete)
+
+def summarize(name, records, elapsed, backends, concurrency):
+    latencies = [record["latency_s"] for record in records]
+    first_tokens = [record["time_to_first_token_s"] for record in records if record["time_to_first_token_s"] is not None]
+    stages = {}
+    for record in records:
+        for stage, duration in record["stages"].items():
+            stages.setdefault(stage, []).append(duration)
+    calls = Counter()
+    for record in records:
+        calls.update(record["calls"])
+
+    return {
+        "target": name,
+        "requests": len(records),
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_rps": round(len(records) / elapsed, 3) if elapsed else None,
+        "latency_s": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "max": max(latencies, default=None)},
+        "time_to_first_token_s": {"p50": percentile(first_tokens, 50), "p95": percentile(first_tokens, 95)},
+        "stages_s": {stage: {"n": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95)}
+                     for stage, values in stages.items()},
+        "calls": dict(calls), # as counted by the pipeline
+        "backend_calls": dict(backends.log.calls), # as seen by the fakes, including background work
+        "answer_cache_hits": sum(record["cached"] for record in records),
+        "errors": sum(len(record["errors"]) for record in records),
+        "failed": sum(record.get("failed", False) for record in records),
+        "completions": backends.complete.stats() if hasattr(backends.complete, "stats") else None,
+        "models": backends.engine.models.stats() if hasattr(backends, "engine") else None,
+    }
+
+def run(name, args, questions):
+    backends = FakeBackends(args)
+    try:
+        ask, new_state = make_target(name, backends, args)
+    except ImportError as e:
+        return {"target": name, "skipped": f"{e}"}
+
+    rng = random.Random(args.seed)
+    # Each simulated user asks its own sequence of questions, sampled with repeats so caches see realistic reuse
+    workloads = [[rng.choice(questions) for _ in range(args.questions)] for _ in range(args.concurrency)]
+    records = []
+    lock = threading.Lock()
+
+    def user(workload):
+        state = new_state()
+        for question in workload:
+            start = time.perf_counter()
+            try:
+                record = ask(backends, question, state, args.stream)
+            except Exception as e:
+                # the question failed outright; counted, with the time it took, rather than ending the run
+                record = {"latency_s": time.perf_counter() - start, "time_to_first_token_s": None, "stages": {},
+                          "calls": {}, "cached": False, "errors": [f"{e}"], "failed": True}
+            with lock:
+                records.append(record)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix=f"bench-{name}") as executor:
+        list(executor.map(user, workloads))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    summary = summarize(name, records, elapsed, backends, args.concurrency)
+    summary["memory"] = {"python_peak_mb": round(peak / 2**20, 2), "max_rss_mb": max_rss_mb()}
+    return summary
+
+def run_batch(args, questions):
+    # The same questions as the other targets, sent as one RagEngine.answer_many() batch
+    backends = FakeBackends(args)
+    make_target("engine", backends, args)
+    rng = random.Random(args.seed)
+    batch = [rng.choice(questions) for _ in range(args.questions * args.concurrency)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    answers = backends.engine.answer_many(batch, max_workers=args.concurrency)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    records = []
+    for answer in {id(answer): answer for answer in answers}.values(): # repeated questions share an Answer
+        breakdown = answer.pipeline.breakdown()
+        records.append({
+            "latency_s": breakdown["stages"]["answer"]["end_s"],
+            "time_to_first_token_s": None,
+            "stages": {name: stage["duration_s"] for name, stage in breakdown["stages"].items() if not stage["discarded"]},
+            "calls": breakdown["calls"],
+            "cached": answer.cached,
+            "errors": answer.errors,
+        })
+    summary = summarize("batch", records, elapsed, backends, args.concurrency)
+    summary["requests"] = len(batch)
+    summary["throughput_rps"] = round(len(batch) / elapsed, 3) if elapsed else None
+    summary["batch"] = backends.engine.last_batch
+    summary["memory"] = {"python_peak_mb": round(peak / 2**20, 2), "max_rss_mb": max_rss_mb()}
+    return summary
+
+def run_startup(args):
+    # Setup cost of a Streamlit run: rebuilding the session, search service handle and TruLens provider on every
+    # rerun (as the app used to) against SnowflakeResources built once per process with a lazy provider
+    rng = random.Random(args.seed)
+    connect_latency = Latency(1.5, 4.0, args.time_scale, rng) # Snowpark login
+    lookup_latency = Latency(0.3, 0.8, args.time_scale, rng) # Root(session) and the service handle
+    provider_latency = Latency(0.8, 2.0, args.time_scale, rng) # TruLens import and the Cortex provider
+
+    def connect():
+        connect_latency.sleep()
+        return FakeSession(scale=args.time_scale, rng=rng)
+
+    def search_service(session):
+        lookup_latency.sleep()
+        return object()
+
+    def make_provider(session):
+        provider_latency.sleep()
+        return FakeProvider(scale=args.time_scale, rng=rng)
+
+    def rebuild():
+        session = connect()
+        search_service(session)
+        make_provider(session)
+
+    resources = SnowflakeResources(connect, search_service, make_provider)
+
+    def shared():
+        resources.run(resources.service)
+
+    summary = {"target": "startup", "runs": args.questions}
+    for name, setup in (("before", rebuild), ("after", shared)):
+        runs = []
+        for _ in range(args.questions):
+            start = time.perf_counter()
+            setup()
+            runs.append(time.perf_counter() - start)
+        summary[name] = {"cold_start_s": runs[0], "rerun_p50_s": percentile(runs[1:], 50),
+                         "rerun_p95_s": percentile(runs[1:], 95)}
+    summary["resources"] = resources.stats()
+    return summary
+
+def run_pool(args):
+    # Backend calls from concurrent users on one shared session, as the app used to make them, against a pool of
+    # --pool-size sessions with per-call checkout
+    rng = random.Random(args.seed)
+    log = CallLog()
+    query = lambda session: session.sql("select get_presigned_url(@docs, ?, 360)", params=["doc.pdf"]).collect()
+    summary = {"target": "pool", "users": args.concurrency, "calls": args.questions * args.concurrency}
+    for name, size in (("before", 1), ("after", args.pool_size)):
+        pool = SessionPool(lambda: FakeSession(scale=args.time_scale, rng=rng, log=log), max_size=size)
+        latencies = []
+
+        def user(_):
+            for _ in range(args.questions):
+                start = time.perf_counter()
+                pool.run(query)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix=f"bench-pool-{name}") as executor:
+            list(executor.map(user, range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        stats = pool.stats()
+        summary[name] = {"pool_size": size, "elapsed_s": round(elapsed, 4), "throughput_cps": round(len(latencies) / elapsed, 3),
+                         "latency_p50_s": percentile(latencies, 50), "latency_p95_s": percentile(latencies, 95),
+                         "wait_p50_s": stats["wait_p50_s"], "wait_p95_s": stats["wait_p95_s"],
+                         "peak_in_use": stats["peak_in_use"], "sessions": stats["created"]}
+    return summary
+
+def max_rss_mb():
+    try:
+        import resource
+    except ImportError: # not available on Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (2**20 if sys.platform == "darwin" else 2**10), 2)
+
+def _fmt(value):
+    return "-" if value is None else f"{value:.3f}"
+
+def print_summary(summary):
+    if "skipped" in summary:
+        print(f"{summary['target']}: skipped ({summary['skipped']})")
+        return
+    if summary["target"] == "startup":
+        print(f"startup: {summary['runs']} runs")
+        for name in ("before", "after"):
+            values = summary[name]
+            print(f"  {name:<7} cold start {_fmt(values['cold_start_s'])}s, rerun p50 {_fmt(values['rerun_p50_s'])}s "
+                  f"p95 {_fmt(values['rerun_p95_s'])}s")
+        return
+    if summary["target"] == "pool":
+        print(f"pool: {summary['users']} users, {summary['calls']} calls")
+        for name in ("before", "after"):
+            values = summary[name]
+            print(f"  {name:<7} {values['pool_size']} session(s): {values['throughput_cps']} calls/s, "
+                  f"latency p50 {_fmt(values['latency_p50_s'])}s p95 {_fmt(values['latency_p95_s'])}s, "
+                  f"checkout wait p50 {_fmt(values['wait_p50_s'])}s p95 {_fmt(values['wait_p95_s'])}s, peak in use {values['peak_in_use']}")
+        return
+    latency, ttft = summary["latency_s"], summary["time_to_first_token_s"]
+    print(f"{summary['target']}: {summary['requests']} requests, {summary['concurrency']} users, "
+          f"{summary['elapsed_s']:.2f}s, {summary['throughput_rps']} req/s")
+    print(f"  latency p50 {_fmt(latency['p50'])}s p95 {_fmt(latency['p95'])}s max {_fmt(latency['max'])}s, "
+          f"first token p50 {_fmt(ttft['p50'])}s p95 {_fmt(ttft['p95'])}s")
+    for stage, values in summary["stages_s"].items():
+        print(f"  {stage:<18} n={values['n']:<5} p50 {_fmt(values['p50'])}s p95 {_fmt(values['p95'])}s")
+    print(f"  calls {summary['calls']}")
+    print(f"  backend calls {summary['backend_calls']}")
+    if "batch" in summary:
+        print(f"  batch {summary['batch']}")
+    if summary["completions"]:
+        print(f"  completions {summary['completions']}")
+    for stage, values in (summary["models"] or {}).items():
+        models = ", ".join(f"{model} n={values[model]['calls']} ok={values[model]['success_rate']} p50 {_fmt(values[model]['p50_s'])}s"
+                           for model in values["models"] if model in values)
+        if models:
+            print(f"  {stage:<18} {models}, escalations {values['escalations']}")
+    print(f"  answer cache hits {summary['answer_cache_hits']}, errors {summary['errors']}, failed {summary['failed']}, memory {summary['memory']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CapstructAI request path offline against local fakes")
+    parser.add_argument("--questions", type=int, default=10, help="questions asked by each simulated user")
+    parser.add_argument("--question-file", help=".txt (one per line) or .jsonl question set; defaults to a built-in set")
+    parser.add_argument("--concurrency", type=int, default=4, help="simulated users asking at the same time")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiplies every injected latency, e.g. 0.01 for a quick CI run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stream", action="store_true", help="stream answers as the app does")
+    parser.add_argument("--no-answer-cache", action="store_true")
+    parser.add_argument("--no-search-cache", action="store_true")
+    parser.add_argument("--local-index", action="store_true", help="search a local BM25 index of the corpus, falling back to the fake service")
+    parser.add_argument("--target", nargs="+", default=["engine", "capstruct"], choices=["engine", "capstruct", "batch", "startup", "pool"])
+    parser.add_argument("--resilient", action="store_true", help="wrap the fake Complete in ResilientComplete (deadlines, hedging, retries, breaker)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of fake Complete calls that raise")
+    parser.add_argument("--models", help="model ladders per stage as JSON, like CAPSTRUCT_MODELS; "
+                        "'{\"rewrite\": \"mistral-large2\", \"classify\": \"mistral-large2\"}' is the old assignment")
+    parser.add_argument("--small-model-miss-rate", type=float, default=0.0,
+                        help="share of fake rewrites and classifications from small models that fail their check")
+    parser.add_argument("--trace", help="write a JSON line per request to this file, as CAPSTRUCT_TRACE does in the app")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE, help="Snowpark sessions in the pool for --target pool")
+    parser.add_argument("--output", help="write the summaries as JSON")
+    args = parser.parse_args(argv)
+
+    questions = load_questions(args.question_file)
+    runners = {"batch": run_batch, "startup": lambda args, questions: run_startup(args), "pool": lambda args, questions: run_pool(args)}
+    summaries = [runners.get(name, lambda args, questions: run(name, args, questions))(args, questions) for name in args.target]
+    for summary in summaries:
+        print_summary(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summaries, f, indent=2)
+    return summaries
+
+if __name__ == "__main__":
+    main()
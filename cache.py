@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    # Thread-safe LRU cache whose entries also expire `ttl` seconds after they were stored.
+    # Lives at module level in the modules that use it, so it is shared by every Streamlit session in the process.
+
+    def __init__(self, ttl, maxsize=1024, max_bytes=None, sizeof=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes # optional bound on the summed sizeof() of the values
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict() # key -> (expires_at, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _remove(self, key):
+        entry = self._data.pop(key)
+        self._bytes -= entry[2]
+        return entry
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires_at, value, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._remove(key) if key in self._data else None
+        return default if entry is None else entry[1]
+
+    def items(self):
+        # Snapshot of the live entries, least recently used first
+        now = time.monotonic()
+        with self._lock:
+            return [(key, entry[1]) for key, entry in self._data.items() if entry[0] > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
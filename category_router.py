@@ -0,0 +1,305 @@
+import json
+import math
+import re
+import sys
+from collections import Counter, defaultdict, namedtuple
+
+from textvec import N_FEATURES, bucket, hashed_features
+
+CATEGORIES = ["Safety", "Building Code", "Sustainability", "Plumbing", "Fire", "Electrical"]
+ALL = "ALL"
+
+ROUTER_THRESHOLD = 0.8 # below this confidence the router falls back to the LLM classifier
+
+Route = namedtuple("Route", ["category", "confidence", "source"])
+
+# Words that have to appear for a question to possibly ask for a category of documents
+CATEGORY_TERMS = {
+    "Safety": r"(?:safety|safe|worksafe(?:\s*bc)?|ohs|occupational\s+health)",
+    "Building Code": r"(?:(?:bc|vancouver|national)\s+)?building",
+    "Sustainability": r"(?:sustainability|sustainable|green|energy|zero\s+emissions?)",
+    "Plumbing": r"plumbing",
+    "Fire": r"fire",
+    "Electrical": r"electrical",
+}
+
+# Names that can only mean one category's documents, e.g. "the plumbing code" but not "plumbing" or "code"
+CATEGORY_SOURCES = {
+    "Safety": r"(?:worksafe(?:\s*bc)?(?:\s+(?:documents?|docs|regulations?|guidelines?))?|ohs\s+regulations?|"
+              r"occupational\s+health\s+and\s+safety\s+regulations?|safety\s+(?:documents?|docs|regulations?|category))",
+    "Building Code": r"(?:(?:(?:bc|vancouver|national)\s+)?building\s+(?:codes?|bylaws?)(?:\s+documents?)?|building\s+(?:documents?|docs|category))",
+    "Sustainability": r"(?:(?:sustainability|green\s+building)\s+(?:documents?|docs|guidelines?|category)|energy\s+step\s+code|"
+                      r"zero\s+emissions?\s+building\s+(?:plan|requirements))",
+    "Plumbing": r"plumbing\s+(?:codes?|documents?|docs|regulations?|category)",
+    "Fire": r"fire\s+(?:codes?|documents?|docs|regulations?|category)",
+    "Electrical": r"(?:canadian\s+)?electrical\s+(?:codes?|documents?|docs|regulations?|category)",
+}
+
+# Asking for a source: "according to the fire code", "only use the plumbing documents", "in the safety category"
+ASK = r"(?:search(?:\s+(?:in|through))?|look\s+(?:in|through|at)|according\s+to|per|using|(?:only\s+)?use|based\s+on|refer(?:ring)?\s+to|consult)"
+IN = r"(?:in|within|from)"
+IN_DOCS = r"(?:documents?|docs|category)"
+
+EXPLICIT_RULES = [
+    (category, re.compile(rf"\b(?:{ASK}\s+(?:the\s+)?{source}|{IN}\s+(?:the\s+)?{CATEGORY_TERMS[category]}\s+{IN_DOCS})\b",
+                          re.IGNORECASE))
+    for category, source in CATEGORY_SOURCES.items()
+]
+SOURCE_NAMES = [(category, re.compile(rf"\b{source}\b", re.IGNORECASE)) for category, source in CATEGORY_SOURCES.items()]
+SOURCE_WEIGHT = 3 # counts of the feature added for naming a source, so it outweighs the question's other words
+ANY_CATEGORY_TERM = re.compile(r"\b(?:" + "|".join(CATEGORY_TERMS.values()) + r")\b", re.IGNORECASE)
+
+# Seed examples in the style of our traffic, labelled the way the mistral-large2 classifier labels them.
+# Questions that merely mention a topic are "ALL"; only explicit requests for a category are not.
+SEED_EXAMPLES = [
+    ("What is the minimum guardrail height for a balcony?", ALL),
+    ("How far apart do fire separations need to be in a parking garage?", ALL),
+    ("What are the fire protection requirements for underground parking garages in Vancouver?", ALL),
+    ("What are the electrical clearance requirements around a panel?", ALL),
+    ("What plumbing fixtures are required in a commercial washroom?", ALL),
+    ("What are the energy efficiency requirements for residential buildings?", ALL),
+    ("What safety equipment do workers need on a scaffold?", ALL),
+    ("What are the structural requirements for foundations in seismic zones?", ALL),
+    ("How wide must an exit stair be?", ALL),
+    ("What are the requirements for soil contamination testing before construction?", ALL),
+    ("Do I need a sprinkler system in a four storey residential building?", ALL),
+    ("What is the maximum travel distance to an exit?", ALL),
+    ("Can you explain that in more detail?", ALL),
+    ("Thanks, that was helpful", ALL),
+    ("That answer was wrong", ALL),
+    ("What insulation R-value is needed for exterior walls?", ALL),
+    ("What are the signage requirements for hazardous areas with high-voltage equipment?", ALL),
+    ("What ventilation is required for industrial facilities handling hazardous materials?", ALL),
+    ("What are the fire separation requirements between suites?", ALL),
+    ("Is a fire alarm required in a duplex?", ALL),
+    ("What electrical permits do I need for a basement renovation?", ALL),
+    ("How do I size a plumbing vent for a kitchen sink?", ALL),
+    ("What are the safety requirements for excavations deeper than 1.2 m?", ALL),
+    ("How energy efficient do replacement windows need to be?", ALL),
+    ("What building permits are required for a deck?", ALL),
+    ("Is a fire rated door needed between the garage and the house?", ALL),
+    # Naming a source without one of the rules' phrasings, e.g. "what does the plumbing code say", is left to the
+    # model, and these are what calibrate it on each category
+    ("What does WorkSafe BC require for fall protection on roofs?", "Safety"),
+    ("WorkSafe BC rules for confined space entry", "Safety"),
+    ("What do the OHS regulations say about hearing protection?", "Safety"),
+    ("Occupational health and safety regulation requirements for first aid kits on site", "Safety"),
+    ("What does the BC Building Code say about guard heights?", "Building Code"),
+    ("Vancouver Building Bylaw rules for basement ceiling heights", "Building Code"),
+    ("What does the national building code require for stair headroom?", "Building Code"),
+    ("Building code minimum bedroom window size", "Building Code"),
+    ("What does the energy step code require for airtightness testing?", "Sustainability"),
+    ("Energy step code targets for Part 9 houses", "Sustainability"),
+    ("What does the zero emissions building plan say about gas appliances?", "Sustainability"),
+    ("Green building guidelines for rainwater harvesting", "Sustainability"),
+    ("What does the plumbing code say about trap seal protection?", "Plumbing"),
+    ("Plumbing code minimum slope for a building drain", "Plumbing"),
+    ("What do the plumbing regulations require for cleanout locations?", "Plumbing"),
+    ("plumbing code rules for hot water temperature limits", "Plumbing"),
+    ("What does the fire code say about extinguisher placement?", "Fire"),
+    ("Fire code requirements for emergency lighting in exits", "Fire"),
+    ("What do the fire regulations require for storing propane tanks?", "Fire"),
+    ("fire code inspection intervals for standpipe systems", "Fire"),
+    ("What does the electrical code say about GFCI outlets in bathrooms?", "Electrical"),
+    ("Electrical code rules for EV charger circuits", "Electrical"),
+    ("What does the Canadian Electrical Code require for grounding a service?", "Electrical"),
+    ("electrical regulations for temporary power on a construction site", "Electrical"),
+    ("Search the safety documents for fall protection requirements", "Safety"),
+    ("According to the safety regulations, when is fall protection required?", "Safety"),
+    ("Only use the WorkSafe BC documents: what PPE is required on site?", "Safety"),
+    ("In the safety category, what are the rules for working at heights?", "Safety"),
+    ("According to the BC Building Code, what is the minimum ceiling height?", "Building Code"),
+    ("Search the building code documents for stair riser dimensions", "Building Code"),
+    ("Using the Vancouver Building Bylaw, what are the requirements for secondary suites?", "Building Code"),
+    ("Per the building code, how many exits does an assembly occupancy need?", "Building Code"),
+    ("Search the sustainability documents for heat pump requirements", "Sustainability"),
+    ("According to the green building guidelines, what is the energy step code target?", "Sustainability"),
+    ("Using the sustainability category, what are the zero emissions building requirements?", "Sustainability"),
+    ("Search the plumbing documents for backflow preventer requirements", "Plumbing"),
+    ("According to the plumbing code, what size should a building drain be?", "Plumbing"),
+    ("Only use plumbing documents: how is a water heater vented?", "Plumbing"),
+    ("According to the fire code, how often must extinguishers be inspected?", "Fire"),
+    ("Search the fire documents for standpipe requirements", "Fire"),
+    ("Using the fire code, what are the requirements for fire alarm systems?", "Fire"),
+    ("According to the electrical code, what is the required clearance for a service panel?", "Electrical"),
+    ("Search the electrical documents for GFCI requirements in kitchens", "Electrical"),
+    ("Only use the electrical regulations: how must temporary wiring be protected?", "Electrical"),
+]
+
+def _clean_label(text):
+    return text.replace("'", "").replace('"', "").strip().rstrip(".").lower()
+
+def parse_category(text):
+    # The category an LLM answered with, or None unless the answer is exactly one of the options
+    cleaned = _clean_label(text)
+    for category in CATEGORIES + [ALL]:
+        if cleaned == category.lower():
+            return category
+    return None
+
+def normalize_category(text):
+    # Map a free-form label (e.g. an LLM answer) onto one of the known categories, defaulting to ALL
+    category = parse_category(text)
+    if category is not None:
+        return category
+    cleaned = _clean_label(text)
+    for category in CATEGORIES:
+        if re.search(rf"\b{category.lower()}\b", cleaned):
+            return category
+    return ALL
+
+def router_features(text, n_features=N_FEATURES):
+    # Word n-grams, plus a feature per category whose source the question names ("the plumbing code") even when
+    # it doesn't ask for it in one of the rules' phrasings
+    features = hashed_features(text, n_features)
+    for category, name in SOURCE_NAMES:
+        if name.search(text):
+            features[bucket(f"source:{category}", n_features)] += SOURCE_WEIGHT
+    return features
+
+class HashedNaiveBayes:
+    # Multinomial naive Bayes over hashed word n-gram counts
+
+    def __init__(self, n_features=N_FEATURES, alpha=0.5):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.label_counts = Counter()
+        self.feature_counts = defaultdict(Counter)
+        self.feature_totals = Counter()
+
+    def fit(self, examples):
+        for text, label in examples:
+            self.label_counts[label] += 1
+            for feature, count in router_features(text, self.n_features).items():
+                self.feature_counts[label][feature] += count
+                self.feature_totals[label] += count
+        return self
+
+    def predict_proba(self, text, held_out_label=None):
+        # held_out_label: `text` is one of the training examples, with that label, and is left out of the counts,
+        # for leave-one-out calibration
+        features = router_features(text, self.n_features)
+        total = sum(self.label_counts.values()) - (held_out_label is not None)
+        log_probs = {}
+        for label, label_count in self.label_counts.items():
+            held = label == held_out_label
+            label_count -= held
+            if label_count <= 0:
+                continue
+            denominator = self.feature_totals[label] - held * sum(features.values()) + self.alpha * self.n_features
+            log_prob = math.log(label_count / total)
+            for feature, count in features.items():
+                log_prob += count * math.log((self.feature_counts[label][feature] - held * count + self.alpha) / denominator)
+            log_probs[label] = log_prob
+        top = max(log_probs.values())
+        unnormalized = {label: math.exp(value - top) for label, value in log_probs.items()}
+        norm = sum(unnormalized.values())
+        return {label: value / norm for label, value in unnormalized.items()}
+
+def calibrate(model, examples):
+    # {predicted label: (held-out predictions, correct ones)}, each example predicted by the model without it
+    counts = defaultdict(lambda: [0, 0])
+    for text, label in examples:
+        probabilities = model.predict_proba(text, held_out_label=label)
+        predicted = max(probabilities, key=probabilities.get)
+        counts[predicted][0] += 1
+        counts[predicted][1] += predicted == label
+    return {label: tuple(count) for label, count in counts.items()}
+
+class CategoryRouter:
+    # First tier of category routing: pattern rules, then a small local classifier,
+    # and only when neither is confident, the LLM classifier passed in as `fallback`.
+
+    def __init__(self, fallback=None, threshold=ROUTER_THRESHOLD, examples=None):
+        self.fallback = fallback
+        self.threshold = threshold
+        self.examples = examples = SEED_EXAMPLES + list(examples or [])
+        self.model = HashedNaiveBayes().fit(examples)
+        # calibrated on the questions the rules leave to the model
+        self.calibration = calibrate(self.model, [example for example in examples if self.rule_route(example[0]) is None])
+
+    def model_confidence(self, category, probability):
+        # The naive Bayes posterior is overconfident; it is capped by how often the model was right, on held-out
+        # examples, when it predicted this category, smoothed so that a category it has rarely or never predicted
+        # stays near 0.5 and goes to the LLM
+        predicted, correct = self.calibration.get(category, (0, 0))
+        return min(probability, (correct + 1) / (predicted + 2))
+
+    def rule_route(self, query):
+        for category, rule in EXPLICIT_RULES:
+            if rule.search(query):
+                return Route(category, 1.0, "rule")
+
+        if not ANY_CATEGORY_TERM.search(query):
+            # None of the category words appear, so the question can't be asking for a category
+            return Route(ALL, 1.0, "rule")
+        return None
+
+    def predict(self, query):
+        # Local prediction only, never calls the LLM
+        route = self.rule_route(query)
+        if route is not None:
+            return route
+
+        probabilities = self.model.predict_proba(query)
+        category = max(probabilities, key=probabilities.get)
+        return Route(category, self.model_confidence(category, probabilities[category]), "model")
+
+    def confident(self, route):
+        return route.confidence >= self.threshold
+
+    def classify_with_fallback(self, query):
+        return Route(normalize_category(self.fallback(query)), 1.0, "llm")
+
+    def route(self, query):
+        route = self.predict(query)
+        if self.confident(route) or self.fallback is None:
+            return route
+        return self.classify_with_fallback(query)
+
+def load_examples(path):
+    # JSON lines with "question" and "category" keys, e.g. questions labelled by the LLM classifier
+    examples = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                examples.append((record["question"], normalize_category(record["category"])))
+    return examples
+
+def evaluate(router, examples):
+    # Offline accuracy of the local tiers against reference (LLM) labels
+    confusion = defaultdict(Counter)
+    correct = confident = confident_correct = 0
+    sources = Counter()
+    for question, label in examples:
+        route = router.predict(question)
+        confusion[label][route.category] += 1
+        sources[route.source] += 1
+        correct += route.category == label
+        if router.confident(route):
+            confident += 1
+            confident_correct += route.category == label
+    n = len(examples)
+    return {
+        "n": n,
+        "accuracy": correct / n if n else 0.0,
+        "coverage": confident / n if n else 0.0, # share of questions answered without the LLM
+        "confident_accuracy": confident_correct / confident if confident else 0.0,
+        "sources": dict(sources),
+        "confusion": {label: dict(predicted) for label, predicted in confusion.items()},
+    }
+
+def main(argv):
+    if len(argv) < 2:
+        print("usage: python category_router.py LABELS.jsonl [TRAIN.jsonl] [THRESHOLD]")
+        return 1
+    examples = load_examples(argv[1])
+    training = load_examples(argv[2]) if len(argv) > 2 else []
+    threshold = float(argv[3]) if len(argv) > 3 else ROUTER_THRESHOLD
+    router = CategoryRouter(threshold=threshold, examples=training)
+    print(json.dumps(evaluate(router, examples), indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,122 @@
+import os
+from dataclasses import dataclass, field
+
+CONTEXT_TOKEN_BUDGET = 2000 # tokens of retrieved text allowed into the answer prompt
+MIN_OVERLAP = 20 # shortest shared run of characters treated as chunker overlap rather than coincidence
+MAX_OVERLAP = 400 # text_chunker uses chunk_overlap = 256, plus slack for separators
+MIN_TRUNCATED_TOKENS = 50 # don't bother squeezing in a passage if less than this is left of the budget
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English prose; good enough for budgeting
+    return (len(text) + 3) // 4
+
+@dataclass
+class Passage:
+    relative_path: str
+    text: str
+    hits: int = 1 # number of search hits merged into this passage
+
+@dataclass
+class Context:
+    text: str
+    stats: dict = field(default_factory=dict)
+
+def _overlap(first, second):
+    # Length of the longest suffix of `first` that is a prefix of `second`
+    longest = min(len(first), len(second), MAX_OVERLAP)
+    for size in range(longest, MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return size
+    return 0
+
+def _merge(first, second):
+    # Joined text if the two chunks overlap (in either order), otherwise None
+    first, second = first.strip(), second.strip()
+    if second in first:
+        return first
+    if first in second:
+        return second
+    size = _overlap(first, second)
+    if size:
+        return first + second[size:]
+    size = _overlap(second, first)
+    if size:
+        return second + first[size:]
+    return None
+
+def merge_passages(hits):
+    # Merges overlapping chunks of the same document, keeping the passages in order of their best-ranked hit
+    passages = []
+    for hit in hits:
+        passage = Passage(hit.get("relative_path", ""), hit["chunk"].strip())
+        while True:
+            for other in passages:
+                text = _merge(other.text, passage.text) if other.relative_path == passage.relative_path else None
+                if text is not None:
+                    passages.remove(other)
+                    passage = Passage(passage.relative_path, text, other.hits + passage.hits)
+                    break
+            else:
+                break
+        passages.append(passage)
+    return _rank(passages, hits)
+
+def _rank(passages, hits):
+    # Order passages by the rank of the first hit each one contains
+    def first_rank(passage):
+        for rank, hit in enumerate(hits):
+            if hit.get("relative_path", "") == passage.relative_path and hit["chunk"].strip() in passage.text:
+                return rank
+        return len(hits)
+    return sorted(passages, key=first_rank)
+
+def _truncate(text, tokens):
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    # prefer ending on a sentence, then on a word
+    for boundary in (". ", "\n", " "):
+        index = cut.rfind(boundary)
+        if index > limit // 2:
+            return cut[:index + 1].rstrip() + " ..."
+    return cut + " ..."
+
+def build_context(hits, token_budget=CONTEXT_TOKEN_BUDGET, raw_json=""):
+    # Compact prompt context from search hits: no JSON envelope, overlaps merged, packed into the token budget
+    passages = merge_passages(hits)
+    sections = []
+    used = 0
+    truncated = dropped = 0
+    for passage in passages:
+        header = f"[{len(sections) + 1}] {os.path.basename(passage.relative_path)}\n" if passage.relative_path else f"[{len(sections) + 1}]\n"
+        remaining = token_budget - used - estimate_tokens(header)
+        if remaining < MIN_TRUNCATED_TOKENS:
+            dropped += 1
+            continue
+        text = passage.text
+        if estimate_tokens(text) > remaining:
+            text = _truncate(text, remaining)
+            truncated += 1
+        section = header + text
+        sections.append(section)
+        used += estimate_tokens(section)
+
+    text = "\n\n".join(sections)
+    raw_chars = len(raw_json) if raw_json else sum(len(hit["chunk"]) for hit in hits)
+    return Context(text, {
+        "hits": len(hits),
+        "passages": len(sections),
+        "merged_hits": len(hits) - len(passages),
+        "truncated": truncated,
+        "dropped": dropped,
+        "raw_chars": raw_chars,
+        "context_chars": len(text),
+        "raw_tokens": (raw_chars + 3) // 4,
+        "context_tokens": estimate_tokens(text),
+        "token_budget": token_budget,
+    })
+
+def format_chat_history(messages):
+    # One "role: content" line per message instead of the repr of a list of dicts
+    return "\n".join(f"{message['role']}: {message['content']}" for message in messages)
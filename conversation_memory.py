@@ -0,0 +1,170 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from context_builder import estimate_tokens, format_chat_history
+from model_router import ModelRouter
+
+MAX_MESSAGES = 6 # recent messages kept verbatim
+SUMMARIZE_EVERY = 6 # evicted messages folded into the summary at a time, i.e. every three turns
+SUMMARY_WORKERS = 4 # background summaries at once across all sessions
+MAX_MESSAGE_CHARS = 4000 # longer messages are clipped before they are stored
+MAX_SUMMARY_TOKENS = 300
+MAX_PROMPT_TOKENS = 1500 # summary plus recent messages as they appear in a prompt
+
+def _clip_tokens(text, tokens, keep="start"):
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    return text[:limit] if keep == "start" else text[-limit:]
+
+def extractive_summary(summary, messages, max_tokens=MAX_SUMMARY_TOKENS):
+    # Summarizer that needs no model: the first sentence of every evicted message, oldest dropped first
+    lines = [f"{message['role']}: {message['content'].split('. ')[0].strip()}" for message in messages]
+    text = "\n".join(filter(None, [summary] + lines))
+    return _clip_tokens(text, max_tokens, keep="end")
+
+# Process-wide, for memories that update their summary off the request path
+_summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="capstruct-summary")
+
+def summary_executor():
+    return _summary_executor
+
+def make_llm_summarizer(complete, models=None, max_tokens=MAX_SUMMARY_TOKENS):
+    # The summary model comes from the "summary" stage of the model router
+    models = models or ModelRouter.from_env()
+
+    def summarize(summary, messages):
+        prompt = f"""
+            Update the SUMMARY between the <summary> and </summary> tags of an ongoing conversation about building codes
+            and construction safety with the new MESSAGES between the <messages> and </messages> tags.
+            Keep the facts, requirements, numbers and document names the user may refer back to.
+            Answer with only the updated summary in at most {max_tokens * 3 // 4} words. Do not add any explanation.
+
+            <summary>
+            {summary}
+            </summary>
+            <messages>
+            {format_chat_history(messages)}
+            </messages>
+            """
+        return _clip_tokens(models.call("summary", complete, prompt).strip(), max_tokens)
+    return summarize
+
+class ConversationMemory:
+    # Bounded conversation memory: a ring buffer of the most recent messages plus a rolling summary of older ones.
+    # The summary is updated incrementally once every `summarize_every` evicted messages, never rebuilt from scratch.
+    # Evicted messages stay in `pending`, and in the prompt, until the summary that covers them is in place. While a
+    # summary is being made, at most `summarize_every` more wait behind it; older ones are folded into `backlog` with
+    # the extractive summarizer, and appended to the new summary once it is in place.
+
+    def __init__(self, max_messages=MAX_MESSAGES, summarize_every=SUMMARIZE_EVERY, summarizer=None,
+                 max_prompt_tokens=MAX_PROMPT_TOKENS, executor=None):
+        self.recent = deque(maxlen=max_messages)
+        self.summarize_every = summarize_every
+        self.summarizer = summarizer or extractive_summary
+        self.max_prompt_tokens = max_prompt_tokens
+        self.executor = executor # if set, summaries are updated in the background
+        self.summary = ""
+        self.pending = [] # evicted messages not yet in the summary
+        self.backlog = "" # extractive summary of messages evicted while a slow summary was being made
+        self.in_flight = 0 # messages at the start of `pending` that the running summary covers
+        self.summaries = 0
+        self.summarizing = False
+        self.generation = 0 # bumped by clear(), so a summary still being made for the old conversation is dropped
+        self._lock = threading.Lock()
+
+    def add(self, role, content):
+        message = {"role": role, "content": content[:MAX_MESSAGE_CHARS]}
+        with self._lock:
+            if len(self.recent) == self.recent.maxlen:
+                self.pending.append(self.recent[0])
+            self.recent.append(message)
+            if self.summarizing and len(self.pending) - self.in_flight > self.summarize_every:
+                overflow = self.pending[self.in_flight:-self.summarize_every]
+                self.backlog = extractive_summary(self.backlog, overflow)
+                del self.pending[self.in_flight:-self.summarize_every]
+            if len(self.pending) < self.summarize_every or self.summarizing:
+                return
+            self.summarizing = True
+            evicted = list(self.pending)
+            self.in_flight = len(evicted)
+            summary = self.summary
+            generation = self.generation
+
+        if self.executor is None:
+            self._summarize(summary, evicted, generation)
+        else:
+            self.executor.submit(self._summarize, summary, evicted, generation)
+
+    def _summarize(self, summary, evicted, generation):
+        try:
+            summary = self.summarizer(summary, evicted)
+        except Exception:
+            summary = extractive_summary(summary, evicted)
+        with self._lock:
+            if generation != self.generation:
+                return
+            self.summary = _clip_tokens("\n".join(filter(None, [summary, self.backlog])), MAX_SUMMARY_TOKENS, keep="end")
+            self.backlog = ""
+            del self.pending[:len(evicted)]
+            self.in_flight = 0
+            self.summaries += 1
+            self.summarizing = False
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self.pending = []
+            self.summary = ""
+            self.backlog = ""
+            self.in_flight = 0
+            self.summarizing = False
+            self.generation += 1
+
+    def messages(self):
+        with self._lock:
+            return list(self.recent)
+
+    def __len__(self):
+        return len(self.recent) + (1 if self.summary or self.backlog or self.pending else 0)
+
+    def prompt_text(self):
+        # Summary and not-yet-summarized messages first, then the most recent messages that fit in the token cap
+        with self._lock:
+            summary = self.summary
+            # the backlog, already "role: sentence" lines, sits between the messages being summarized and newer ones
+            messages = [format_chat_history([message]) for message in self.pending[:self.in_flight]]
+            messages += [self.backlog] if self.backlog else []
+            messages += [format_chat_history([message]) for message in self.pending[self.in_flight:] + list(self.recent)]
+
+        parts = []
+        budget = self.max_prompt_tokens
+        if summary:
+            # the summary gets at most half of the cap, the rest goes to the messages themselves
+            summary = _clip_tokens(summary, budget // 2, keep="end")
+            parts.append(f"Summary of the earlier conversation:\n{summary}")
+            budget -= estimate_tokens(parts[0])
+
+        lines = []
+        for line in reversed(messages):
+            if estimate_tokens(line) > budget:
+                line = _clip_tokens(line, max(budget, 0))
+            if not line:
+                break
+            lines.append(line)
+            budget -= estimate_tokens(line)
+        if lines:
+            parts.append("\n".join(reversed(lines)))
+        return "\n\n".join(parts)
+
+    def stats(self):
+        text = self.prompt_text()
+        return {
+            "messages": len(self.recent),
+            "pending": len(self.pending),
+            "summaries": self.summaries,
+            "summary_tokens": estimate_tokens(self.summary),
+            "backlog_tokens": estimate_tokens(self.backlog),
+            "prompt_tokens": estimate_tokens(text),
+        }
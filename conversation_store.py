@@ -0,0 +1,173 @@
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+# Conversations persisted in a local SQLite database, so long sessions stay cheap to render and survive app
+# restarts. Messages are stored compactly (the role as an integer, long contents zlib-compressed), read back a
+# page at a time, and exported as a stream of text only when an export is asked for, e.g.
+#   python conversation_store.py conversations.db <conversation id> > chat_history.txt
+
+STORE_ENV = "CAPSTRUCT_CONVERSATIONS"
+DEFAULT_PATH = "conversations.db"
+PAGE_SIZE = 20 # messages rendered per page of history
+COMPRESS_MIN_CHARS = 256 # shorter contents are stored as plain UTF-8
+EXPORT_BATCH = 200 # messages read from the database per export query
+
+ROLES = ("user", "assistant")
+PLAIN, ZLIB = 0, 1
+
+Message = namedtuple("Message", ["seq", "role", "content"])
+
+SCHEMA = """
+create table if not exists conversations (
+    id integer primary key,
+    key text not null unique,
+    created real not null,
+    updated real not null
+);
+create table if not exists messages (
+    conversation integer not null references conversations(id) on delete cascade,
+    seq integer not null,
+    role integer not null,
+    encoding integer not null,
+    content blob not null,
+    primary key (conversation, seq)
+) without rowid;
+"""
+
+def encode(content):
+    data = content.encode("utf-8")
+    if len(content) >= COMPRESS_MIN_CHARS:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return ZLIB, compressed
+    return PLAIN, data
+
+def decode(encoding, data):
+    return (zlib.decompress(data) if encoding == ZLIB else bytes(data)).decode("utf-8")
+
+class ConversationStore:
+    # Thread-safe: each thread (e.g. each Streamlit session's script thread) gets its own connection
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._ids = {} # conversation key -> row id
+        self._lock = threading.Lock()
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        return cls(environ.get(STORE_ENV) or DEFAULT_PATH)
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=10)
+            if self.path != ":memory:":
+                db.execute("pragma journal_mode=wal")
+            db.execute("pragma synchronous=normal")
+            db.execute("pragma foreign_keys=on")
+        return db
+
+    def _id(self, key, create=False):
+        with self._lock:
+            conversation = self._ids.get(key)
+        if conversation is not None:
+            return conversation
+        db = self._connection()
+        row = db.execute("select id from conversations where key = ?", (key,)).fetchone()
+        if row is None:
+            if not create:
+                return None
+            now = time.time()
+            with db:
+                db.execute("insert or ignore into conversations (key, created, updated) values (?, ?, ?)", (key, now, now))
+            row = db.execute("select id from conversations where key = ?", (key,)).fetchone()
+        with self._lock:
+            self._ids[key] = row[0]
+        return row[0]
+
+    def append(self, key, role, content):
+        conversation = self._id(key, create=True)
+        encoding, data = encode(content)
+        db = self._connection()
+        with db:
+            # the next seq is picked in the insert itself, so concurrent appends can't take the same one
+            db.execute("insert into messages select ?, coalesce(max(seq), -1) + 1, ?, ?, ? from messages where conversation = ?",
+                       (conversation, ROLES.index(role), encoding, data, conversation))
+            db.execute("update conversations set updated = ? where id = ?", (time.time(), conversation))
+
+    def count(self, key):
+        conversation = self._id(key)
+        if conversation is None:
+            return 0
+        return self._connection().execute("select count(*) from messages where conversation = ?", (conversation,)).fetchone()[0]
+
+    def page(self, key, before=None, limit=PAGE_SIZE):
+        # Up to `limit` messages older than seq `before` (the latest ones if None), oldest first
+        conversation = self._id(key)
+        if conversation is None:
+            return []
+        rows = self._connection().execute(
+            "select seq, role, encoding, content from messages where conversation = ? and seq < ? "
+            "order by seq desc limit ?", (conversation, sys.maxsize if before is None else before, limit)).fetchall()
+        return [Message(seq, ROLES[role], decode(encoding, content)) for seq, role, encoding, content in reversed(rows)]
+
+    def messages(self, key, batch=EXPORT_BATCH):
+        # Every message, oldest first, read `batch` at a time
+        conversation = self._id(key)
+        if conversation is None:
+            return
+        after = -1
+        while True:
+            rows = self._connection().execute(
+                "select seq, role, encoding, content from messages where conversation = ? and seq > ? "
+                "order by seq limit ?", (conversation, after, batch)).fetchall()
+            for seq, role, encoding, content in rows:
+                yield Message(seq, ROLES[role], decode(encoding, content))
+            if len(rows) < batch:
+                return
+            after = rows[-1][0]
+
+    def export(self, key):
+        # The conversation as "role: content" lines, generated as it is read
+        for message in self.messages(key):
+            yield f"{message.role}: {message.content}\n"
+
+    def export_bytes(self, key):
+        # The export as UTF-8 bytes, the form st.download_button takes on every Streamlit version
+        return b"".join(line.encode("utf-8") for line in self.export(key))
+
+    def delete(self, key):
+        conversation = self._id(key)
+        if conversation is None:
+            return
+        with self._connection() as db:
+            db.execute("delete from messages where conversation = ?", (conversation,))
+            db.execute("delete from conversations where id = ?", (conversation,))
+        with self._lock:
+            self._ids.pop(key, None)
+
+    def stats(self):
+        db = self._connection()
+        conversations, = db.execute("select count(*) from conversations").fetchone()
+        messages, stored = db.execute("select count(*), coalesce(sum(length(content)), 0) from messages").fetchone()
+        return {"path": self.path, "conversations": conversations, "messages": messages, "content_bytes": stored}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a stored conversation as text")
+    parser.add_argument("database")
+    parser.add_argument("conversation", help="the conversation id, as in the app's ?conversation= URL parameter")
+    args = parser.parse_args(argv)
+    for line in ConversationStore(args.database).export(args.conversation):
+        sys.stdout.write(line)
+
+if __name__ == "__main__":
+    main()
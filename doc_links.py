@@ -0,0 +1,43 @@
+from cache import TTLCache
+from pipeline import count_call
+
+URL_LIFETIME = 360 # seconds a presigned URL stays valid
+URL_CACHE_TTL = URL_LIFETIME - 120 # a cached link always has at least two minutes left when it is shown
+
+# Process-wide, so every session shares the links to popular documents
+_url_cache = TTLCache(ttl=URL_CACHE_TTL, maxsize=2048)
+
+def resolve_urls(paths, fetch):
+    # Returns {relative_path: url} for the paths found on the stage. Cached links are resolved here; only the misses
+    # are passed to fetch(missing), so a pooled session is only checked out when there is something to look up
+    paths = list(dict.fromkeys(paths))
+    urls = {}
+    missing = []
+    for path in paths:
+        url = _url_cache.get(path)
+        if url is None:
+            missing.append(path)
+        else:
+            urls[path] = url
+
+    if missing:
+        urls.update(fetch(missing))
+    return {path: urls[path] for path in paths if path in urls}
+
+def fetch_presigned_urls(session, paths, stage="@docs"):
+    # Looks up every path in one query and caches the links
+    placeholders = ", ".join("?" for _ in paths)
+    cmd = f"""select RELATIVE_PATH, GET_PRESIGNED_URL({stage}, RELATIVE_PATH, {URL_LIFETIME}) as URL_LINK
+              from directory({stage}) where RELATIVE_PATH in ({placeholders})"""
+    count_call("sql")
+    urls = {}
+    for row in session.sql(cmd, params=list(paths)).collect():
+        urls[row["RELATIVE_PATH"]] = row["URL_LINK"]
+        _url_cache.set(row["RELATIVE_PATH"], row["URL_LINK"])
+    return urls
+
+def get_presigned_urls(session, paths, stage="@docs"):
+    return resolve_urls(paths, lambda missing: fetch_presigned_urls(session, missing, stage))
+
+def url_cache_stats():
+    return _url_cache.stats()
@@ -0,0 +1,285 @@
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from answer_cache import history_independent, normalize_query
+from category_router import ALL, CategoryRouter, ROUTER_THRESHOLD
+from context_builder import CONTEXT_TOKEN_BUDGET, build_context, estimate_tokens
+from conversation_memory import ConversationMemory
+from model_router import ModelRouter, rewrite_ok
+from pipeline import SingleFlight, StagePipeline
+from resilience import Deadline
+from retrieval import RetrievalResult, retrieve
+from search_client import canonical_key
+from streaming import TimedStream
+from tracing import span
+
+NUM_CHUNKS = 5
+MIN_SCORE = 0.6
+BATCH_WORKERS = 8 # questions of an answer_many() batch in flight at once
+DEGRADED_ANSWER = ("**The assistant can't generate an answer right now.** "
+                   "Please try again shortly, or check the reference documents linked in the sidebar.")
+
+# columns to query in the service
+COLUMNS = [
+    "chunk",
+    "relative_path",
+    "category"
+]
+
+@dataclass
+class Backends:
+    complete: object # complete(model, prompt, stream=False), e.g. snowflake.cortex.Complete
+    search: object # a Cortex search service handle, or anything with search(query, columns, filter=None, limit=10)
+    urls: object = None # urls(relative_paths) -> {relative_path: url}, e.g. doc_links.get_presigned_urls bound to a session
+
+@dataclass
+class Answer:
+    question: str
+    optimized_query: str
+    stream: TimedStream # iterate to get the text; generated lazily when streaming
+    category: str
+    relative_paths: list
+    retrieval: RetrievalResult = None # None when the answer came from the answer cache
+    pipeline: StagePipeline = None
+    errors: list = field(default_factory=list)
+
+    @property
+    def cached(self):
+        return self.retrieval is None
+
+def classify_prompt(query):
+    return f"""
+        Based on the QUESTION in between the <question> and </question> tags, if the user explicitly asks to search for a specific
+        category of documents that matches one of the categories below, then answer in one word from the options below. Simply having the
+        word in the question is not sufficient, the user must ask for an answer using the category of documents:
+        1. Safety
+        2. Building Code
+        3. Sustainability
+        4. Plumbing
+        5. Fire
+        6. Electrical
+
+        In all other cases, answer "ALL"
+
+        <question>
+        {query}
+        </question>
+        """
+
+def rewrite_prompt(chat_history, question):
+    return f"""
+        Based on the QUESTION between the <question> and </question> tags,
+        generate a query that is easier for you to understand, whether it is by writing out commonly used abbreviations, or narrowing ambiguities.
+        If the user attempts to rate your response in the QUESTION, generate a prompt commanding you to thank the user for their feedback if it is positive, or
+        apologize and promise to do better if it is negative.
+        If the query is explicitly referencing previous information given by either you or the user, extend the QUESTION with the CHAT HISTORY
+        provided between the <chat_history> and </chat_history> tags.
+        The query should be in natual language.
+        Answer with only the query. Do not add any explanation.
+
+        <question>
+        {question}
+        </question>
+        <chat_history>
+        {chat_history.prompt_text()}
+        </chat_history>
+        """
+
+def answer_prompt(chat_history, prompt_context, optimized_query):
+    return f"""
+           You are an expert chat assistant that extracts information from the CONTEXT provided
+           between <context> and </context> tags.
+           You offer a chat experience considering the information included in the CHAT HISTORY
+           provided between <chat_history> and </chat_history> tags.
+           When answering the question contained between <question> and </question> tags
+           be concise and do not hallucinate.
+           If you don't have the information, just say so.
+
+           Do not mention the CONTEXT used in your answer.
+           Do not mention the CHAT HISTORY used in your answer.
+
+           If you can't answer the question from the CONTEXT provided, answer ignoring the CONTEXT and CHAT HISTORY, but also state that
+           "This is the best answer I can provide with the available data. Please verify the information with the reference documents linked in
+           the sidebar to ensure full compliance with relevant regulations." and bold the text if possible.
+
+           If the user attempts to rate your response, either thank the user for their feedback if it is positive, or apologize and promise to do better
+           if it is negative.
+
+           <chat_history>
+           {chat_history.prompt_text()}
+           </chat_history>
+           <context>
+           {prompt_context}
+           </context>
+           <question>
+           {optimized_query}
+           </question>
+           Answer:
+           """
+
+class RagEngine:
+    # The rewrite -> route -> search -> filter -> generate request path, free of Streamlit.
+    # The Backends passed in are the only things it talks to, so the app, the eval harness and the benchmark share it.
+
+    def __init__(self, backends, relevance_filter=None, answer_cache=None, num_chunks=NUM_CHUNKS,
+                 min_score=MIN_SCORE, router_threshold=ROUTER_THRESHOLD, context_token_budget=CONTEXT_TOKEN_BUDGET,
+                 answer_model=None, columns=COLUMNS, request_deadline=None, model_router=None):
+        self.backends = backends
+        self.complete = backends.complete
+        self.svc = backends.search
+        self.relevance_filter = relevance_filter
+        self.answer_cache = answer_cache
+        self.num_chunks = num_chunks
+        self.context_token_budget = context_token_budget
+        self.models = model_router or ModelRouter.from_env() # which model serves each stage
+        self.answer_model = answer_model or self.models.model("answer")
+        self.columns = columns
+        self.request_deadline = request_deadline # seconds; enforced by a resilience.ResilientComplete backend
+        self.config = (self.answer_model, num_chunks, min_score) # cached answers are only reused under the same config
+        self.category_router = CategoryRouter(fallback=self.classify_category, threshold=router_threshold)
+
+    def classify_category(self, query):
+        try:
+            cat = self.models.call("classify", self.complete, classify_prompt(query))
+        except Exception:
+            return ALL # search every category rather than fail the question
+        return cat.replace("'", "").strip()
+
+    def optimize_query(self, chat_history, question):
+        sumary = self.models.call("rewrite", self.complete, rewrite_prompt(chat_history, question),
+                                  check=lambda text: rewrite_ok(text, question))
+        if not rewrite_ok(sumary, question):
+            return question # every model's rewrite was empty or rambling
+        return sumary.replace("'", "")
+
+    def retrieve(self, query, pipeline, errors):
+        result = retrieve(self.svc, query, self.columns, self.category_router, pipeline, limit=self.num_chunks)
+        if self.relevance_filter is None or not result.chunks:
+            return result
+        try:
+            kept = pipeline.run("relevance_filter", self.relevance_filter.filter, query, result.chunks)
+        except Exception as e:
+            # Keep the unfiltered context rather than losing the search results
+            errors.append(f"Relevance filter unavailable: {e}")
+            return result
+        return result.with_kept_chunks(kept)
+
+    def build_prompt(self, optimized_query, chat_history, retrieval, pipeline):
+        context = build_context(retrieval.context_results, self.context_token_budget, retrieval.context_json())
+        prompt = answer_prompt(chat_history, context.text, optimized_query)
+        pipeline.notes["prompt"] = dict(context.stats, prompt_chars=len(prompt), prompt_tokens=estimate_tokens(prompt))
+        return prompt
+
+    def create_prompt(self, optimized_query, chat_history, pipeline, errors):
+        try:
+            retrieval = self.retrieve(optimized_query, pipeline, errors)
+        except Exception as e:
+            errors.append(f"Search unavailable: {e}")
+            retrieval = RetrievalResult(optimized_query)
+        return self.build_prompt(optimized_query, chat_history, retrieval, pipeline), retrieval
+
+    def document_links(self, relative_paths, pipeline=None):
+        if self.backends.urls is None or not relative_paths:
+            return {}
+        with span("presigned_urls", pipeline):
+            return self.backends.urls(relative_paths)
+
+    def degraded_answer(self, optimized_query, retrieval, error, errors):
+        # When the answer model fails: a cached answer to the same question if there is one, otherwise a notice
+        # pointing at the documents search found
+        errors.append(f"Answer model unavailable: {error}")
+        if self.answer_cache is not None:
+            cached = self.answer_cache.get(optimized_query, retrieval.category, self.config)
+            if cached is not None:
+                errors.append("Answered from the answer cache")
+                return cached.answer
+        return DEGRADED_ANSWER
+
+    def answer_question(self, question, chat_history, stream=False):
+        errors = []
+        with StagePipeline() as pipeline:
+            if self.request_deadline is not None:
+                pipeline.deadline = Deadline(self.request_deadline)
+            try:
+                optimized_query = pipeline.run("rewrite", self.optimize_query, chat_history, question)
+            except Exception as e:
+                errors.append(f"Query rewrite skipped: {e}")
+                optimized_query = question
+
+            # Only questions that don't lean on the conversation can be answered from the shared cache
+            cacheable = self.answer_cache is not None and history_independent(question, chat_history)
+            if cacheable:
+                route = self.category_router.predict(optimized_query)
+                if self.category_router.confident(route):
+                    cached = pipeline.run("answer_cache", self.answer_cache.get, optimized_query, route.category, self.config)
+                    if cached is not None:
+                        return Answer(question, optimized_query, TimedStream(cached.answer, pipeline), cached.category,
+                                      list(cached.relative_paths), pipeline=pipeline, errors=errors)
+
+            prompt, retrieval = self.create_prompt(optimized_query, chat_history, pipeline, errors)
+
+            def store_answer(answer):
+                self.models.record("answer", self.answer_model, time.perf_counter() - answer_started, "ok")
+                if cacheable and retrieval.results:
+                    self.answer_cache.put(optimized_query, retrieval.category, self.config, answer, retrieval.relative_paths)
+
+            answer_started = time.perf_counter()
+            on_complete = store_answer
+            try:
+                if stream:
+                    chunks = self.complete(self.answer_model, prompt, stream=True)
+                else:
+                    chunks = pipeline.run("answer", self.complete, self.answer_model, prompt)
+            except Exception as e:
+                self.models.record("answer", self.answer_model, time.perf_counter() - answer_started, "error")
+                chunks = self.degraded_answer(optimized_query, retrieval, e, errors)
+                on_complete = None
+            response = TimedStream(chunks, pipeline, on_complete=on_complete)
+
+        return Answer(question, optimized_query, response, retrieval.category, retrieval.relative_paths, retrieval,
+                      pipeline=pipeline, errors=errors)
+
+    def _batch_engine(self, flight):
+        # A copy of this engine whose completion and search calls go through `flight`, so identical prompts
+        # and searches made by different questions of a batch are sent once
+        def complete(model, prompt, stream=False):
+            if stream:
+                return self.complete(model, prompt, stream=True)
+            return flight.call(("complete", model, prompt), self.complete, model, prompt)
+
+        class SharedSearch:
+            def search(_, query, columns, filter=None, limit=10):
+                key = ("search", canonical_key("", query, columns, filter, limit))
+                if filter is None:
+                    return flight.call(key, self.svc.search, query, columns, limit=limit)
+                return flight.call(key, self.svc.search, query, columns, filter=filter, limit=limit)
+
+        batch = copy.copy(self)
+        batch.complete = complete
+        batch.svc = SharedSearch()
+        batch.category_router = copy.copy(self.category_router) # shares the fitted model
+        batch.category_router.fallback = batch.classify_category
+        return batch
+
+    def answer_many(self, questions, max_workers=BATCH_WORKERS):
+        # Answers a list of independent questions (no chat history) concurrently, returning one Answer per question
+        # in order, with the text already generated in answer.stream.text. Repeated questions share their Answer.
+        flight = SingleFlight()
+        batch = self._batch_engine(flight)
+
+        def answer(question):
+            result = batch.answer_question(question, ConversationMemory())
+            for _ in result.stream: # runs the stream to the end, which also stores the answer in the cache
+                pass
+            return result
+
+        unique = {}
+        for question in questions:
+            unique.setdefault(normalize_query(question), question)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique))), thread_name_prefix="capstruct-batch") as executor:
+            answers = dict(zip(unique, executor.map(answer, unique.values())))
+
+        self.last_batch = dict(flight.stats(), questions=len(questions), unique_questions=len(unique))
+        return [answers[normalize_query(question)] for question in questions]
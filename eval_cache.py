@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import time
+
+import category_router
+import context_builder
+from conversation_memory import ConversationMemory
+from engine import answer_prompt, classify_prompt, rewrite_prompt
+from ingest import load_manifest
+from pipeline import percentile
+
+# Incremental evaluation for eval_runner.py. Each (variant, question) record is fingerprinted by everything that
+# can change its answer or its scores: the question, the pipeline config, the category router's rules and training
+# examples, the context packing settings, the prompt templates, the model names, the feedback functions and the
+# corpus version. A record evaluated before under the same fingerprint is reused
+# with its stored answer, latency and feedback scores, so only new or changed combinations are run and scored.
+# Questions are asked without chat history, so the question is all a record depends on beyond its variant.
+# The run then has to pass gates on mean feedback scores against a stored baseline, and on p95 latency measured
+# over the records evaluated in this run only: a reused latency can't show a slowdown in code the fingerprint
+# doesn't cover.
+
+CACHE_PATH = "eval_cache.jsonl"
+BASELINE_PATH = "eval_baseline.json"
+QUALITY_METRICS = ("Groundedness", "Answer Relevance", "Context Relevance") # the feedback names in build_feedbacks()
+MAX_SCORE_DROP = 0.05 # a mean feedback score may fall this much below the baseline
+MAX_LATENCY_INCREASE = 0.2 # p95 latency may grow by this share of the baseline
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def prompt_templates():
+    # The prompts as they are sent, with placeholders where the question, history and context go
+    history = ConversationMemory()
+    return {
+        "classify": classify_prompt("{question}"),
+        "rewrite": rewrite_prompt(history, "{question}"),
+        "answer": answer_prompt(history, "{context}", "{question}"),
+    }
+
+def router_config(router):
+    # The rules and the classifier's training examples, from which its calibration follows
+    return {
+        "rules": [rule.pattern for _, rule in category_router.EXPLICIT_RULES],
+        "any_category_term": category_router.ANY_CATEGORY_TERM.pattern,
+        "source_names": [name.pattern for _, name in category_router.SOURCE_NAMES],
+        "source_weight": category_router.SOURCE_WEIGHT,
+        "examples": router.examples,
+    }
+
+def context_config():
+    # How retrieved passages are merged and packed into the token budget
+    return {
+        "min_overlap": context_builder.MIN_OVERLAP,
+        "max_overlap": context_builder.MAX_OVERLAP,
+        "min_truncated_tokens": context_builder.MIN_TRUNCATED_TOKENS,
+    }
+
+def engine_config(engine):
+    relevance_filter = engine.relevance_filter
+    return {
+        "num_chunks": engine.num_chunks,
+        "min_score": engine.config[2],
+        "router_threshold": engine.category_router.threshold,
+        "context_token_budget": engine.context_token_budget,
+        "columns": list(engine.columns),
+        "relevance_filter": None if relevance_filter is None else
+            {"threshold": relevance_filter.threshold, "timeout": relevance_filter.timeout, "fallback": relevance_filter.fallback},
+        "models": engine.models.stages,
+        "answer_model": engine.answer_model,
+        "prompts": digest(prompt_templates()),
+        "router": digest(router_config(engine.category_router)),
+        "context_builder": context_config(),
+    }
+
+def corpus_version(manifest_path):
+    # A version of the indexed documents from ingest.py's manifest: changes whenever a document's content does
+    manifest = load_manifest(manifest_path)
+    if not manifest:
+        return None
+    return digest(sorted((path, entry["sha256"]) for path, entry in manifest.items()))[:16]
+
+def variant_fingerprint(version, engine, corpus, feedback):
+    # Everything but the question; `feedback` describes the feedback functions and their model
+    return digest({"version": version, "engine": engine_config(engine), "corpus": corpus, "feedback": feedback})
+
+def record_fingerprint(variant, question):
+    return digest([variant, question])
+
+class EvalCache:
+    # Evaluated records by fingerprint, in a JSON lines file that is appended to as records come in
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.records[record["fingerprint"]] = record
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint):
+        record = self.records.get(fingerprint)
+        if record is None or not record.get("scores"):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(record, cached=True)
+
+    def put(self, records):
+        with open(self.path, "a") as f:
+            for record in records:
+                record = dict(record, created=time.time())
+                self.records[record["fingerprint"]] = record
+                f.write(json.dumps(record) + "\n")
+
+    def stats(self):
+        return {"records": len(self.records), "reused": self.hits, "evaluated": self.misses}
+
+def summarize(records):
+    # Per variant: mean feedback scores over every record, latency percentiles over the records evaluated in this run
+    by_version = {}
+    for record in records:
+        by_version.setdefault(record["version"], []).append(record)
+    summary = {}
+    for version, version_records in by_version.items():
+        latencies = [record["latency_s"] for record in version_records if not record.get("cached")]
+        values = {"questions": len(version_records), "reused": len(version_records) - len(latencies),
+                  "p50_s": percentile(latencies, 50), "p95_s": percentile(latencies, 95)}
+        for metric in QUALITY_METRICS:
+            scores = [record["scores"][metric] for record in version_records
+                      if record.get("scores", {}).get(metric) is not None]
+            values[metric] = sum(scores) / len(scores) if scores else None
+        summary[version] = values
+    return summary
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(summary, path=BASELINE_PATH):
+    # Metrics this run couldn't measure, e.g. latency when every record was reused, keep their baseline values
+    baseline = load_baseline(path) or {}
+    for version, values in summary.items():
+        previous = baseline.get(version, {})
+        baseline[version] = {metric: previous.get(metric) if value is None else value for metric, value in values.items()}
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+def check_gates(summary, baseline, max_score_drop=MAX_SCORE_DROP, max_latency_increase=MAX_LATENCY_INCREASE):
+    # [(version, metric, baseline, current, limit, passed)] for every metric both runs have
+    gates = []
+    for version, values in summary.items():
+        base = (baseline or {}).get(version)
+        if base is None:
+            continue
+        for metric in QUALITY_METRICS:
+            if base.get(metric) is not None and values.get(metric) is not None:
+                limit = base[metric] - max_score_drop
+                gates.append((version, metric, base[metric], values[metric], limit, values[metric] >= limit))
+        if base.get("p95_s") is not None and values.get("p95_s") is not None:
+            limit = base["p95_s"] * (1 + max_latency_increase)
+            gates.append((version, "p95_s", base["p95_s"], values["p95_s"], limit, values["p95_s"] <= limit))
+    return gates
@@ -0,0 +1,198 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import nltk
+import pandas as pd
+from trulens.apps.custom import TruCustomApp
+from trulens.connectors.snowflake import SnowflakeConnector
+from trulens.core import TruSession
+from trulens.core.schema.feedback import FeedbackMode
+from trulens.providers.cortex.provider import Cortex
+
+from eval_cache import (BASELINE_PATH, CACHE_PATH, EvalCache, check_gates, corpus_version, load_baseline,
+                        record_fingerprint, save_baseline, summarize, variant_fingerprint)
+from pipeline import percentile
+from relevance_filter import RelevanceFilter
+from trulens_eval import MIN_SCORE, NUM_CHUNKS, PROMPTS, CapstructAI, CapstructAI_v1, build_feedbacks, connect
+
+APP_NAME = "CapstructAI"
+WORKERS = 8
+FEEDBACK_WORKERS = 8
+FEEDBACK_MODEL = "llama3.1-8b"
+RECORD_KEYS = ("fingerprint", "version", "question", "response", "latency_s", "calls", "scores", "cached")
+
+def load_questions(path):
+    # One question per line (.txt), a JSON list, or JSON lines with a "question" key
+    if path is None:
+        return list(PROMPTS)
+    with open(path) as f:
+        if path.endswith(".json"):
+            return [q if isinstance(q, str) else q["question"] for q in json.load(f)]
+        if path.endswith(".jsonl"):
+            return [json.loads(line)["question"] for line in f if line.strip()]
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+def latency_summary(latencies):
+    return {
+        "questions": len(latencies),
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "mean_s": sum(latencies) / len(latencies) if latencies else None,
+    }
+
+class VariantRunner:
+    # Runs one pipeline variant over a question set on a worker pool. Each worker thread gets its own app
+    # instance wrapped in its own TruCustomApp recorder; feedback is deferred. The questions are independent, so
+    # the app's chat history is cleared before each one and an answer doesn't depend on which worker ran it.
+
+    def __init__(self, version, make_app, feedbacks, workers=WORKERS):
+        self.version = version
+        self.make_app = make_app
+        self.feedbacks = feedbacks
+        self.workers = workers
+        self._local = threading.local()
+
+    def _worker_apps(self):
+        if not hasattr(self._local, "app"):
+            self._local.app = self.make_app()
+            self._local.tru_app = TruCustomApp(
+                self._local.app,
+                app_name=APP_NAME,
+                app_version=self.version,
+                feedbacks=self.feedbacks,
+                feedback_mode=FeedbackMode.NONE, # scored afterwards by run_feedback()
+            )
+        return self._local.app, self._local.tru_app
+
+    def _ask(self, question):
+        app, tru_app = self._worker_apps()
+        app.chat_history.clear()
+        start = time.perf_counter()
+        with tru_app as recording:
+            response = app.query(question)
+        return {
+            "version": self.version,
+            "question": question,
+            "response": response,
+            "latency_s": time.perf_counter() - start,
+            "calls": app.last_breakdown["calls"],
+            "cached": False,
+            "record": recording.get(),
+            "tru_app": tru_app,
+        }
+
+    def run(self, questions):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"eval-{self.version}") as executor:
+            return list(executor.map(self._ask, questions))
+
+def run_feedback(tru_session, results, feedbacks, workers=FEEDBACK_WORKERS):
+    # Deferred feedback: score every recorded answer in one batch once all the answers are in
+    def score(result):
+        feedback_results = list(tru_session.run_feedback_functions(
+            result["record"], feedbacks, app=result["tru_app"], wait=True))
+        tru_session.add_feedbacks(feedback_results)
+        result["scores"] = {feedback.name: feedback.result for feedback in feedback_results}
+        return len(feedback_results)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="eval-feedback") as executor:
+        return sum(executor.map(score, results))
+
+def report(tru_session, results):
+    # Latencies of the records evaluated in this run; reused ones were measured against older code
+    latencies = {}
+    for result in results:
+        if not result.get("cached"):
+            latencies.setdefault(result["version"], []).append(result["latency_s"])
+    latency = pd.DataFrame.from_dict(
+        {version: latency_summary(values) for version, values in latencies.items()}, orient="index")
+    latency.index.name = "app_version"
+
+    leaderboard = tru_session.get_leaderboard()
+    return leaderboard.reset_index().merge(latency.reset_index(), on="app_version", how="left")
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate CapstructAI pipeline variants concurrently")
+    parser.add_argument("questions", nargs="?", help=".txt (one per line), .json or .jsonl question set; defaults to the built-in prompts")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--feedback-workers", type=int, default=FEEDBACK_WORKERS)
+    parser.add_argument("--variants", nargs="+", default=["simple", "improved"], choices=["simple", "improved"])
+    parser.add_argument("--output", help="write per-question answers, latencies and call counts as JSON lines")
+    parser.add_argument("--cache", default=CACHE_PATH, help="answers and scores of evaluated records, reused while their fingerprint holds")
+    parser.add_argument("--no-cache", action="store_true", help="evaluate every record again")
+    parser.add_argument("--corpus-version", help="version of the indexed documents; defaults to a hash of --manifest")
+    parser.add_argument("--manifest", default="ingest_manifest.json", help="ingest.py manifest the corpus version is derived from")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="fail the run if quality or p95 latency regressed against this baseline")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run's summary as the new baseline")
+    args = parser.parse_args()
+
+    nltk.download('punkt_tab')
+    questions = load_questions(args.questions)
+
+    snowpark_session, svc = connect()
+    tru_session = TruSession(connector=SnowflakeConnector(snowpark_session=snowpark_session))
+    provider = Cortex(snowpark_session=snowpark_session, model_engine=FEEDBACK_MODEL)
+    feedbacks = build_feedbacks(provider)
+    relevance_filter = RelevanceFilter(provider.context_relevance, MIN_SCORE, max_workers=NUM_CHUNKS)
+
+    variants = {
+        "simple": lambda: CapstructAI(svc),
+        "improved": lambda: CapstructAI_v1(svc, relevance_filter),
+    }
+
+    # Only records whose fingerprint changed since they were last evaluated are run and scored again
+    cache = None if args.no_cache else EvalCache(args.cache)
+    corpus = args.corpus_version or corpus_version(args.manifest)
+    feedback = {"names": [f.name for f in feedbacks], "model": FEEDBACK_MODEL}
+
+    results = []
+    reused = []
+    for version in args.variants:
+        variant = variant_fingerprint(version, variants[version]().engine, corpus, feedback)
+        todo = []
+        for question in questions:
+            fingerprint = record_fingerprint(variant, question)
+            cached = cache.get(fingerprint) if cache is not None else None
+            if cached is None:
+                todo.append((question, fingerprint))
+            else:
+                reused.append(cached)
+        start = time.perf_counter()
+        variant_results = VariantRunner(version, variants[version], feedbacks, args.workers).run([q for q, _ in todo])
+        for result, (_, fingerprint) in zip(variant_results, todo):
+            result["fingerprint"] = fingerprint
+        print(f"{version}: {len(todo)} questions evaluated, {len(questions) - len(todo)} reused in {time.perf_counter() - start:.1f}s")
+        results.extend(variant_results)
+
+    start = time.perf_counter()
+    scored = run_feedback(tru_session, results, feedbacks, args.feedback_workers)
+    print(f"feedback: {scored} results in {time.perf_counter() - start:.1f}s")
+
+    records = [{key: result.get(key) for key in RECORD_KEYS} for result in results]
+    if cache is not None:
+        cache.put(records)
+    records += reused
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    print(report(tru_session, records).to_string())
+
+    summary = summarize(records)
+    print(json.dumps(summary, indent=2))
+    gates = check_gates(summary, load_baseline(args.baseline))
+    for version, metric, base, current, limit, passed in gates:
+        print(f"{'PASS' if passed else 'FAIL'} {version} {metric}: {current:.3f} (baseline {base:.3f}, limit {limit:.3f})")
+    if args.update_baseline:
+        save_baseline(summary, args.baseline)
+        print(f"baseline saved to {args.baseline}")
+    return 0 if all(gate[-1] for gate in gates) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+from category_router import CATEGORIES, ALL
+from textvec import tokenize
+
+# Local stand-ins for Cortex Complete, the Cortex search service, the presigned-URL SQL and the TruLens
+# Cortex provider, with configurable latency distributions, for benchmarking without a Snowflake account.
+
+WORDS = ("fire separation parking garage sprinkler guardrail height balcony exit stair riser tread handrail egress "
+         "occupancy assembly residential seismic foundation footing bearing wall insulation thermal resistance "
+         "ventilation exhaust hazardous materials plumbing drain vent trap backflow electrical panel clearance "
+         "grounding wiring signage scaffold fall protection worker safety permit inspection requirement minimum "
+         "maximum shall be provided in accordance with article sentence clause table storey building code").split()
+
+class Latency:
+    # Log-normal latency with the given median and 95th percentile, in seconds, scaled by `scale`
+
+    def __init__(self, median, p95=None, scale=1.0, rng=None):
+        self.median = median
+        self.sigma = math.log((p95 or median) / median) / 1.645 if median > 0 else 0.0
+        self.scale = scale
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def sample(self):
+        if self.median <= 0:
+            return 0.0
+        with self._lock:
+            value = self.rng.lognormvariate(math.log(self.median), self.sigma)
+        return value * self.scale
+
+    def sleep(self):
+        seconds = self.sample()
+        if seconds > 0:
+            time.sleep(seconds)
+        return seconds
+
+class CallLog:
+    # Thread-safe counters shared by the fakes
+
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+def _tag(prompt, tag):
+    # The last match, since the prompts' instructions mention the tags before the tagged sections
+    matches = re.findall(rf"<{tag}>\s*(.*?)\s*</{tag}>", prompt, re.DOTALL)
+    return matches[-1] if matches else ""
+
+# Latency of each model relative to mistral-large2; models not listed take as long as it does
+MODEL_SPEED = {"llama3.1-8b": 0.3, "mistral-7b": 0.3, "llama3.1-70b": 0.8}
+
+class FakeComplete:
+    # Callable with the signature of snowflake.cortex.Complete(model, prompt, stream=False)
+
+    def __init__(self, latency=None, first_token=None, token_interval=None, answer_words=120, scale=1.0, rng=None,
+                 log=None, failure_rate=0.0, model_speed=MODEL_SPEED, small_model_miss_rate=0.0):
+        rng = rng or random.Random(0)
+        self.latency = latency or Latency(1.2, 3.0, scale, rng) # short completions (rewrite, classify, summary)
+        self.first_token = first_token or Latency(0.8, 2.0, scale, rng) # answer time to first token
+        self.token_interval = token_interval or Latency(0.02, 0.05, scale, rng) # between streamed answer chunks
+        self.answer_words = answer_words
+        self.rng = rng
+        self.log = log or CallLog()
+        self.failure_rate = failure_rate # share of calls that raise, as an overloaded or failing model would
+        self.model_speed = model_speed
+        self.small_model_miss_rate = small_model_miss_rate # share of short completions a faster model gets wrong
+        self._lock = threading.Lock()
+
+    def _maybe_fail(self):
+        with self._lock:
+            failed = self.rng.random() < self.failure_rate
+        if failed:
+            self.log.add("complete_error")
+            raise RuntimeError("Cortex Complete failed (injected)")
+
+    def _answer_words(self, prompt):
+        words = tokenize(_tag(prompt, "question")) or ["the", "requirement"]
+        return [self.rng.choice(words + WORDS) for _ in range(self.answer_words)]
+
+    def _sleep(self, latency, model):
+        seconds = latency.sample() * self.model_speed.get(model, 1.0)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def _missed(self, model):
+        if self.model_speed.get(model, 1.0) >= 1.0:
+            return False
+        with self._lock:
+            return self.rng.random() < self.small_model_miss_rate
+
+    def _stream(self, model, prompt):
+        self._sleep(self.first_token, model)
+        self._maybe_fail()
+        words = self._answer_words(prompt)
+        for i in range(0, len(words), 4):
+            if i:
+                self.token_interval.sleep()
+            yield " ".join(words[i:i + 4]) + " "
+
+    def __call__(self, model, prompt, stream=False, **kwargs):
+        self.log.add(f"complete:{model}")
+        if "Answer:" in prompt:
+            if stream:
+                return self._stream(model, prompt)
+            chunks = list(self._stream(model, prompt))
+            return "".join(chunks)
+
+        self._sleep(self.latency, model)
+        self._maybe_fail()
+        missed = self._missed(model)
+        if "one word from the options below" in prompt:
+            return "The question does not ask for a category." if missed else ALL
+        if "<summary>" in prompt:
+            return (_tag(prompt, "summary") + " " + _tag(prompt, "messages"))[-800:]
+        return "" if missed else _tag(prompt, "question")
+
+def split_text(text, chunk_size=1512, chunk_overlap=256):
+    # Streaming stand-in for the text_chunker UDF: fixed-size windows that overlap by chunk_overlap characters
+    step = chunk_size - chunk_overlap
+    for start in range(0, max(len(text) - chunk_overlap, 1), step):
+        yield text[start:start + chunk_size]
+
+def make_corpus(n_docs=40, words_per_doc=3000, rng=None):
+    # Chunks shaped like DOCS_CHUNKS_TABLE rows: chunk, relative_path, category
+    rng = rng or random.Random(0)
+    rows = []
+    for i in range(n_docs):
+        category = CATEGORIES[i % len(CATEGORIES)]
+        relative_path = f"{category.replace(' ', '_')}_{i:03d}.pdf"
+        sentences = []
+        while sum(len(s) for s in sentences) < words_per_doc * 6:
+            sentences.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + ".")
+        for chunk in split_text(" ".join(sentences)):
+            rows.append({"chunk": chunk, "relative_path": relative_path, "category": category})
+    return rows
+
+class FakeSearchResponse:
+
+    def __init__(self, results):
+        self.results = results
+
+    def json(self):
+        return json.dumps({"results": self.results})
+
+class FakeSearchService:
+    # Stand-in for the Cortex search service handle: svc.search(query, columns, filter=None, limit=10)
+
+    def __init__(self, corpus, latency=None, scale=1.0, rng=None, log=None):
+        self.corpus = corpus
+        self.latency = latency or Latency(0.25, 0.8, scale, rng or random.Random(0))
+        self.log = log or CallLog()
+        self._tokens = [set(tokenize(row["chunk"])) for row in corpus]
+
+    def search(self, query, columns, filter=None, limit=10):
+        self.log.add("search")
+        self.latency.sleep()
+        category = (filter or {}).get("@eq", {}).get("category")
+        terms = set(tokenize(query))
+        scored = []
+        for i, row in enumerate(self.corpus):
+            if category is not None and row["category"] != category:
+                continue
+            scored.append((-len(terms & self._tokens[i]), i))
+        scored.sort()
+        results = [{column: self.corpus[i][column] for column in columns} for _, i in scored[:limit]]
+        return FakeSearchResponse(results)
+
+class _Result:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def collect(self):
+        return self.rows
+
+class FakeSession:
+    # Answers the batched GET_PRESIGNED_URL query in doc_links.get_presigned_urls
+
+    def __init__(self, latency=None, scale=1.0, rng=None, log=None):
+        self.latency = latency or Latency(0.4, 1.2, scale, rng or random.Random(0))
+        self.log = log or CallLog()
+        self._lock = threading.Lock() # one statement at a time, as on a single connection
+        self.closed = False
+
+    def sql(self, query, params=None):
+        if self.closed:
+            raise RuntimeError("session is closed")
+        self.log.add("sql")
+        with self._lock:
+            self.latency.sleep()
+        rows = [{"RELATIVE_PATH": path, "URL_LINK": f"https://example.invalid/docs/{path}?expires=360"}
+                for path in params or []]
+        return _Result(rows)
+
+    def close(self):
+        self.closed = True
+
+class FakeProvider:
+    # Stand-in for the TruLens Cortex provider's context_relevance(question, context) -> float
+
+    def __init__(self, latency=None, scale=1.0, rng=None, log=None):
+        self.latency = latency or Latency(0.6, 1.5, scale, rng or random.Random(0))
+        self.log = log or CallLog()
+
+    def context_relevance(self, question, context):
+        self.log.add("relevance")
+        self.latency.sleep()
+        terms = set(tokenize(question))
+        if not terms:
+            return 0.0
+        return min(1.0, len(terms & set(tokenize(context))) / len(terms) + 0.2)
@@ -0,0 +1,255 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+from collections import deque
+
+# Incremental ingestion of a local directory of document text extracts into DOCS_CHUNKS_TABLE.
+# A manifest remembers each file's size, mtime and content hash, so a run only chunks the files that changed
+# and emits the deletes and inserts for those files alone, e.g.
+#   python ingest.py extracts/ --manifest ingest_manifest.json --sql changes.sql
+
+CHUNK_SIZE = 1512 # same as the text_chunker UDF
+CHUNK_OVERLAP = 256
+SEPARATORS = ("\n\n", "\n", " ", "")
+EXTENSIONS = (".txt", ".md", ".pdf")
+INSERT_BATCH = 100 # rows per INSERT statement
+TABLE = "docs_chunks_table"
+STAGE = "@docs"
+
+# The filename rules the worksheet used to ask llama3-70b to apply, in the same order
+CATEGORY_RULES = [
+    ("Building Code", re.compile(r"^[0-9]{5,}$")), # the title is a string of numbers longer than 4 digits
+    ("Safety", re.compile(r"safe", re.IGNORECASE)), # "Safe" or "Safety"
+    ("Electrical", re.compile(r"electrical", re.IGNORECASE)),
+    ("Plumbing", re.compile(r"plumbing", re.IGNORECASE)),
+    ("Fire", re.compile(r"fire", re.IGNORECASE)),
+]
+DEFAULT_CATEGORY = "Sustainability"
+
+def document_title(relative_path):
+    return os.path.splitext(os.path.basename(relative_path))[0]
+
+def category_for(relative_path):
+    title = document_title(relative_path)
+    for category, rule in CATEGORY_RULES:
+        if rule.search(title):
+            return category
+    return DEFAULT_CATEGORY
+
+def category_sql(column="relative_path"):
+    # category_for() as a Snowflake CASE expression over a relative path column, for the worksheet's full load:
+    # the same rules, searched in the file name without its directory and extension
+    title = f"REGEXP_REPLACE(SPLIT_PART({column}, '/', -1), '[.][^.]*$', '')"
+    lines = ["CASE"]
+    for category, rule in CATEGORY_RULES:
+        flags = "i" if rule.flags & re.IGNORECASE else "c"
+        lines.append(f"    WHEN REGEXP_INSTR({title}, {sql_literal(rule.pattern)}, 1, 1, 0, '{flags}') > 0 THEN {sql_literal(category)}")
+    lines.append(f"    ELSE {sql_literal(DEFAULT_CATEGORY)}")
+    lines.append("END")
+    return "\n".join(lines)
+
+def stage_path(path, root):
+    # Path of the document on the stage. A text extract named like "1234567.pdf.txt" stands for "1234567.pdf".
+    relative_path = os.path.relpath(path, root).replace(os.sep, "/")
+    base, ext = os.path.splitext(relative_path)
+    if ext in (".txt", ".md") and os.path.splitext(base)[1]:
+        return base
+    return relative_path
+
+def _split(text, separator):
+    # Pieces of text that each end with the separator, without building the whole list
+    start = 0
+    while start < len(text):
+        end = text.find(separator, start)
+        if end < 0:
+            yield text[start:]
+            return
+        end += len(separator)
+        yield text[start:end]
+        start = end
+
+def _pieces(text, chunk_size, separators):
+    # Pieces no longer than chunk_size, split on the coarsest separator that gets them there
+    separator, finer = separators[0], separators[1:]
+    if not separator:
+        for start in range(0, len(text), chunk_size):
+            yield text[start:start + chunk_size]
+        return
+    for piece in _split(text, separator):
+        if len(piece) <= chunk_size:
+            yield piece
+        else:
+            yield from _pieces(piece, chunk_size, finer)
+
+def split_text(text, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    # Streaming counterpart of the RecursiveCharacterTextSplitter in the text_chunker UDF: pieces are packed into
+    # chunks of at most chunk_size characters, and each chunk starts with up to chunk_overlap characters of the last
+    window = deque()
+    length = 0
+    for piece in _pieces(text, chunk_size, SEPARATORS):
+        if window and length + len(piece) > chunk_size:
+            chunk = "".join(window).strip()
+            if chunk:
+                yield chunk
+            while window and (length > chunk_overlap or length + len(piece) > chunk_size):
+                length -= len(window.popleft())
+        window.append(piece)
+        length += len(piece)
+    chunk = "".join(window).strip()
+    if chunk:
+        yield chunk
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_text(path):
+    if not path.endswith(".pdf"):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return f.read()
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError(f"{path}: install pypdf to read PDFs directly, or ingest a text extract instead")
+    return "\n\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+
+def scan(root):
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            if name.endswith(EXTENSIONS):
+                yield os.path.join(directory, name)
+
+def load_manifest(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def plan(root, manifest):
+    # (changed, removed): files whose content changed since the manifest, and stage paths that are gone.
+    # Size and mtime are checked first, so unchanged files are not even read.
+    changed = []
+    seen = set()
+    for path in scan(root):
+        relative_path = stage_path(path, root)
+        seen.add(relative_path)
+        stat = os.stat(path)
+        entry = manifest.get(relative_path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            continue
+        digest = file_hash(path)
+        if entry and entry["size"] == stat.st_size and entry["sha256"] == digest:
+            entry["mtime"] = stat.st_mtime # touched but not changed
+            continue
+        changed.append((path, relative_path, stat, digest))
+    removed = sorted(set(manifest) - seen)
+    return changed, removed
+
+def ingest(root, manifest, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    # Yields ("delete", relative_path) and ("insert", row) changes and updates the manifest as it goes
+    changed, removed = plan(root, manifest)
+    for relative_path in removed:
+        yield "delete", relative_path
+        del manifest[relative_path]
+
+    for path, relative_path, stat, digest in changed:
+        if relative_path in manifest:
+            yield "delete", relative_path
+        category = category_for(relative_path)
+        chunks = 0
+        for chunk in split_text(read_text(path), chunk_size, chunk_overlap):
+            chunks += 1
+            yield "insert", {"relative_path": relative_path, "size": stat.st_size, "chunk": chunk, "category": category}
+        manifest[relative_path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": digest,
+                                   "chunks": chunks, "category": category}
+
+def sql_literal(value):
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
+def _insert_statement(rows, table=TABLE, stage=STAGE):
+    # file_url and the document's size come from the stage directory, as in the worksheet's full load
+    values = ",\n".join(
+        f"({sql_literal(row['relative_path'])}, {row['size']}, {sql_literal(row['chunk'])}, {sql_literal(row['category'])})"
+        for row in rows)
+    return (f"insert into {table} (relative_path, size, file_url, scoped_file_url, chunk, category)\n"
+            f"select v.column1, coalesce(d.size, v.column2), d.file_url, build_scoped_file_url({stage}, v.column1), "
+            f"v.column3, v.column4\nfrom (values\n{values}) v\n"
+            f"left join directory({stage}) d on d.relative_path = v.column1;")
+
+def sql_statements(changes, table=TABLE, stage=STAGE, batch=INSERT_BATCH):
+    rows = []
+    for action, value in changes:
+        if action == "insert":
+            rows.append(value)
+            if len(rows) >= batch:
+                yield _insert_statement(rows, table, stage)
+                rows = []
+        else:
+            if rows:
+                yield _insert_statement(rows, table, stage)
+                rows = []
+            yield f"delete from {table} where relative_path = {sql_literal(value)};"
+    if rows:
+        yield _insert_statement(rows, table, stage)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally chunk a directory of document extracts for DOCS_CHUNKS_TABLE")
+    parser.add_argument("root", nargs="?", help="directory of .txt/.md extracts (or .pdf, with pypdf installed)")
+    parser.add_argument("--manifest", default="ingest_manifest.json", help="state from the previous run")
+    parser.add_argument("--sql", help="write the deletes and inserts as SQL statements here (default: stdout)")
+    parser.add_argument("--jsonl", help="write the changes as JSON lines here instead of SQL")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--dry-run", action="store_true", help="don't update the manifest")
+    parser.add_argument("--category-sql", action="store_true", help="print the category rules as the worksheet's SQL CASE expression")
+    args = parser.parse_args(argv)
+    if args.category_sql:
+        print(category_sql())
+        return None
+    if args.root is None:
+        parser.error("the extracts directory is required")
+
+    manifest = load_manifest(args.manifest)
+    changes = ingest(args.root, manifest, args.chunk_size, args.chunk_overlap)
+    counts = {"insert": 0, "delete": 0}
+
+    def counted(changes):
+        for action, value in changes:
+            counts[action] += 1
+            yield action, value
+
+    out = open(args.jsonl or args.sql, "w") if (args.jsonl or args.sql) else sys.stdout
+    try:
+        if args.jsonl:
+            for action, value in counted(changes):
+                out.write(json.dumps({"action": action, "relative_path": value} if action == "delete"
+                                     else {"action": action, **value}) + "\n")
+        else:
+            for statement in sql_statements(counted(changes)):
+                out.write(statement + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if not args.dry_run:
+        save_manifest(args.manifest, manifest)
+    print(f"{counts['insert']} chunks inserted, {counts['delete']} documents deleted, "
+          f"{len(manifest)} documents in the manifest", file=sys.stderr)
+    return counts
+
+if __name__ == "__main__":
+    main()
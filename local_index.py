@@ -0,0 +1,222 @@
+import argparse
+import csv
+import json
+import math
+import os
+import time
+from collections import Counter
+
+import numpy as np
+
+from category_router import CATEGORIES
+from pipeline import count_call
+from search_client import SearchResponse
+from textvec import tokenize
+
+# In-process BM25 index over an export of DOCS_CHUNKS_TABLE (chunk, relative_path, category), with the same
+# search(query, columns, filter=None, limit=10) interface as the Cortex search service. The index is a directory
+# of .npy arrays that are memory-mapped on load, so opening it costs little more than reading the vocabulary.
+#   python local_index.py build chunks.jsonl index/
+#   python local_index.py search index/ "guardrail height for balconies" --category "Building Code"
+
+INDEX_VERSION = 1
+BM25_K1 = 1.2
+BM25_B = 0.75
+TEXT_COLUMNS = ("chunk", "relative_path")
+
+def load_rows(path):
+    # JSON lines or CSV with chunk, relative_path and category columns (any case), e.g. a DOCS_CHUNKS_TABLE export
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            row = {key.lower(): value for key, value in row.items()}
+            yield {"chunk": row["chunk"], "relative_path": row.get("relative_path") or "", "category": row.get("category") or ""}
+
+def _write_strings(directory, name, values):
+    # A column of strings as one UTF-8 blob plus offsets, so single values can be read from the memory map
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    np.save(os.path.join(directory, f"{name}_offsets.npy"), offsets)
+    np.save(os.path.join(directory, f"{name}_data.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+def build_index(rows, directory, k1=BM25_K1, b=BM25_B):
+    rows = list(rows)
+    os.makedirs(directory, exist_ok=True)
+    categories = list(CATEGORIES) + sorted({row["category"] for row in rows} - set(CATEGORIES))
+    category_ids = {category: i for i, category in enumerate(categories)}
+
+    vocab = {}
+    term_docs = [] # per term: [(doc, tf)]
+    lengths = np.zeros(len(rows), dtype=np.float32)
+    for doc, row in enumerate(rows):
+        counts = Counter(tokenize(row["chunk"]))
+        lengths[doc] = sum(counts.values())
+        for term, tf in counts.items():
+            term_id = vocab.setdefault(term, len(vocab))
+            if term_id == len(term_docs):
+                term_docs.append([])
+            term_docs[term_id].append((doc, tf))
+
+    # Postings in CSR layout with the full BM25 weight of each (term, doc) precomputed, so a query only adds weights
+    n_docs = len(rows)
+    avgdl = float(lengths.mean()) if n_docs else 0.0
+    indptr = np.zeros(len(term_docs) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(postings) for postings in term_docs])
+    doc_ids = np.empty(indptr[-1], dtype=np.int32)
+    weights = np.empty(indptr[-1], dtype=np.float32)
+    for term_id, postings in enumerate(term_docs):
+        start, end = indptr[term_id], indptr[term_id + 1]
+        docs = np.fromiter((doc for doc, _ in postings), dtype=np.int32, count=len(postings))
+        tf = np.fromiter((tf for _, tf in postings), dtype=np.float32, count=len(postings))
+        idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+        doc_ids[start:end] = docs
+        weights[start:end] = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[docs] / avgdl))
+
+    doc_categories = np.array([category_ids[row["category"]] for row in rows], dtype=np.uint8)
+    bitmaps = np.packbits(doc_categories[None, :] == np.arange(len(categories), dtype=np.uint8)[:, None], axis=1)
+
+    np.save(os.path.join(directory, "indptr.npy"), indptr)
+    np.save(os.path.join(directory, "doc_ids.npy"), doc_ids)
+    np.save(os.path.join(directory, "weights.npy"), weights)
+    np.save(os.path.join(directory, "categories.npy"), doc_categories)
+    np.save(os.path.join(directory, "category_bitmaps.npy"), bitmaps)
+    for column in TEXT_COLUMNS:
+        _write_strings(directory, column, [row[column] for row in rows])
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"version": INDEX_VERSION, "n_docs": n_docs, "k1": k1, "b": b,
+                   "categories": categories, "vocab": vocab}, f)
+    return LocalIndex.load(directory)
+
+class LocalIndex:
+    # Read-only and thread-safe once loaded
+
+    def __init__(self, meta, arrays):
+        self.n_docs = meta["n_docs"]
+        self.categories = meta["categories"]
+        self.vocab = meta["vocab"]
+        self.indptr = arrays["indptr"]
+        self.doc_ids = arrays["doc_ids"]
+        self.weights = arrays["weights"]
+        self.doc_categories = arrays["categories"]
+        self.strings = {column: (arrays[f"{column}_offsets"], arrays[f"{column}_data"]) for column in TEXT_COLUMNS}
+        # the category bitmaps, unpacked once into one boolean mask per category
+        bitmaps = np.unpackbits(arrays["category_bitmaps"], axis=1, count=self.n_docs).astype(bool)
+        self.masks = {category: bitmaps[i] for i, category in enumerate(self.categories)}
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"{directory}: index version {meta.get('version')}, expected {INDEX_VERSION}; rebuild it")
+        names = ["indptr", "doc_ids", "weights", "categories", "category_bitmaps"]
+        names += [f"{column}_{part}" for column in TEXT_COLUMNS for part in ("offsets", "data")]
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None) for name in names}
+        return cls(meta, arrays)
+
+    def _value(self, column, doc):
+        if column == "category":
+            return self.categories[self.doc_categories[doc]]
+        offsets, data = self.strings[column]
+        return bytes(data[offsets[doc]:offsets[doc + 1]]).decode("utf-8")
+
+    def _mask(self, filter):
+        # The subset of the service's filter syntax the app uses: {"@eq": {"category": ...}}
+        if filter is None:
+            return None
+        if set(filter) != {"@eq"} or set(filter["@eq"]) != {"category"}:
+            raise ValueError(f"Unsupported filter for the local index: {filter}")
+        category = filter["@eq"]["category"]
+        mask = self.masks.get(category)
+        return np.zeros(self.n_docs, dtype=bool) if mask is None else mask
+
+    def scores(self, query):
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocab.get(term)
+            if term_id is not None:
+                start, end = self.indptr[term_id], self.indptr[term_id + 1]
+                scores[self.doc_ids[start:end]] += self.weights[start:end] # doc ids are unique within a term
+        return scores
+
+    def top(self, query, filter=None, limit=10):
+        # [(doc, score)] of the best matching chunks, best first; chunks sharing no term with the query are left out
+        if limit <= 0:
+            return []
+        scores = self.scores(query)
+        mask = self._mask(filter)
+        if mask is not None:
+            scores[~mask] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        order = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(doc), float(scores[doc])) for doc in order]
+
+    def search(self, query, columns, filter=None, limit=10):
+        results = [{column: self._value(column, doc) for column in columns} for doc, _ in self.top(query, filter, limit)]
+        return SearchResponse(results)
+
+class FallbackSearchService:
+    # The local index first; the remote service when the index can't answer (an unsupported filter, no matching
+    # chunk at all) or fails
+
+    def __init__(self, local, remote, min_results=1):
+        self.local = local
+        self.remote = remote
+        self.min_results = min_results
+        self.local_hits = 0
+        self.fallbacks = 0
+
+    def search(self, query, columns, filter=None, limit=10):
+        try:
+            response = self.local.search(query, columns, filter=filter, limit=limit)
+        except Exception:
+            response = None
+        if response is not None and len(response.results) >= min(self.min_results, limit):
+            count_call("local_search")
+            self.local_hits += 1
+            return response
+
+        self.fallbacks += 1
+        if filter is None:
+            return self.remote.search(query, columns, limit=limit)
+        return self.remote.search(query, columns, filter=filter, limit=limit)
+
+    def stats(self):
+        return {"local_hits": self.local_hits, "fallbacks": self.fallbacks}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the local BM25 search index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build an index from a .jsonl or .csv export of DOCS_CHUNKS_TABLE")
+    build.add_argument("export")
+    build.add_argument("directory")
+    search = commands.add_parser("search", help="run a query against an index")
+    search.add_argument("directory")
+    search.add_argument("query")
+    search.add_argument("--category")
+    search.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    if args.command == "build":
+        index = build_index(load_rows(args.export), args.directory)
+        print(f"{index.n_docs} chunks, {len(index.vocab)} terms indexed in {time.perf_counter() - start:.2f}s")
+        return
+
+    index = LocalIndex.load(args.directory)
+    loaded = time.perf_counter()
+    filter = {"@eq": {"category": args.category}} if args.category else None
+    response = index.search(args.query, ["chunk", "relative_path", "category"], filter=filter, limit=args.limit)
+    searched = time.perf_counter()
+    for result in response.results:
+        print(f"{result['relative_path']} [{result['category']}]: {result['chunk'][:120]!r}")
+    print(f"loaded in {(loaded - start) * 1000:.1f}ms, searched in {(searched - loaded) * 1000:.2f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from category_router import parse_category
+from pipeline import percentile
+
+# Which Cortex model serves each stage of a request. Every stage has a ladder of models, cheapest first: a call
+# goes to the first one and only moves up when that model fails or its output fails the stage's check (an empty
+# rewrite, a category that can't be parsed). Latency and outcomes are kept per stage and model, so the ladders
+# can be tuned from data. CAPSTRUCT_MODELS overrides the defaults per stage, e.g.
+#   CAPSTRUCT_MODELS='{"rewrite": ["mistral-7b", "mistral-large2"], "answer": ["llama3.1-70b"]}'
+
+MODELS_ENV = "CAPSTRUCT_MODELS"
+SMALL_MODEL = "llama3.1-8b"
+LARGE_MODEL = "mistral-large2"
+STAGE_MODELS = {
+    "rewrite": [SMALL_MODEL, LARGE_MODEL],
+    "classify": [SMALL_MODEL, LARGE_MODEL],
+    "answer": [LARGE_MODEL],
+    "relevance": [SMALL_MODEL], # the TruLens provider's model; its scores are not checked, so it never escalates
+    "summary": [SMALL_MODEL, LARGE_MODEL], # the rolling conversation summary, made in the background
+}
+MAX_REWRITE_RATIO = 4 # a "rewrite" this many times longer than the question is an answer, not a query
+LATENCY_WINDOW = 200 # recent latencies kept per stage and model
+
+def rewrite_ok(rewrite, question=None):
+    rewrite = rewrite.strip()
+    if not rewrite:
+        return False
+    return question is None or len(rewrite) <= MAX_REWRITE_RATIO * len(question) + 200
+
+def category_ok(label):
+    return parse_category(label) is not None
+
+def summary_ok(summary):
+    return bool(summary.strip())
+
+CHECKS = {"rewrite": rewrite_ok, "classify": category_ok, "summary": summary_ok}
+
+class ModelRouter:
+    # Thread-safe; one per process, shared by every session
+
+    def __init__(self, stages=None, checks=CHECKS):
+        self.stages = {stage: list(models) for stage, models in STAGE_MODELS.items()}
+        for stage, models in (stages or {}).items():
+            self.stages[stage] = [models] if isinstance(models, str) else list(models)
+        self.checks = checks
+        self.records = {} # (stage, model) -> counts and recent latencies
+        self.escalations = {} # stage -> calls that went past the first model
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        setting = environ.get(MODELS_ENV, "")
+        return cls(json.loads(setting) if setting else None)
+
+    def models(self, stage):
+        return self.stages.get(stage) or [LARGE_MODEL]
+
+    def model(self, stage):
+        return self.models(stage)[0]
+
+    def record(self, stage, model, seconds, outcome):
+        # outcome: "ok", "rejected" (the output failed the stage's check) or "error"
+        with self._lock:
+            record = self.records.get((stage, model))
+            if record is None:
+                record = self.records[stage, model] = {"calls": 0, "ok": 0, "rejected": 0, "error": 0,
+                                                       "latencies": deque(maxlen=LATENCY_WINDOW)}
+            record["calls"] += 1
+            record[outcome] += 1
+            record["latencies"].append(seconds)
+
+    def timed(self, stage, fn, *args, **kwargs):
+        # fn(*args, **kwargs), recorded against the stage's first model, e.g. the relevance provider's calls
+        model = self.model(stage)
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record(stage, model, time.perf_counter() - start, "error")
+            raise
+        self.record(stage, model, time.perf_counter() - start, "ok")
+        return result
+
+    def call(self, stage, complete, prompt, check=None):
+        # complete(model, prompt) up the stage's ladder until an output passes the check. If none does, the last
+        # output is returned (or the last error raised) and the caller decides what to make of it.
+        check = check or self.checks.get(stage)
+        models = self.models(stage)
+        for i, model in enumerate(models):
+            if i:
+                with self._lock:
+                    self.escalations[stage] = self.escalations.get(stage, 0) + 1
+            last = i == len(models) - 1
+            start = time.perf_counter()
+            try:
+                result = complete(model, prompt)
+            except Exception:
+                self.record(stage, model, time.perf_counter() - start, "error")
+                if last:
+                    raise
+                continue
+            if check is not None and not check(result):
+                self.record(stage, model, time.perf_counter() - start, "rejected")
+                if not last:
+                    continue
+            else:
+                self.record(stage, model, time.perf_counter() - start, "ok")
+            return result
+
+    def stats(self):
+        with self._lock:
+            records = {key: dict(record, latencies=list(record["latencies"])) for key, record in self.records.items()}
+            escalations = dict(self.escalations)
+        stats = {}
+        for stage, models in self.stages.items():
+            stage_stats = {"models": models, "escalations": escalations.get(stage, 0)}
+            for model in models:
+                record = records.get((stage, model))
+                if record is None:
+                    continue
+                latencies = record.pop("latencies")
+                stage_stats[model] = dict(record, success_rate=round(record["ok"] / record["calls"], 3),
+                                          p50_s=percentile(latencies, 50), p95_s=percentile(latencies, 95))
+            stats[stage] = stage_stats
+        return stats
@@ -0,0 +1,155 @@
+import contextvars
+import math
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+MAX_WORKERS = 8 # shared by every request in the process, so keep it in line with the warehouse concurrency
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="capstruct-stage")
+
+_current_pipeline = contextvars.ContextVar("capstruct_pipeline", default=None)
+_current_stage = contextvars.ContextVar("capstruct_stage", default=None)
+
+def percentile(values, q):
+    # Linear interpolation between closest ranks, q in [0, 100]
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def current_pipeline():
+    return _current_pipeline.get()
+
+def current_stage():
+    # Name of the stage the calling code runs in, e.g. "rewrite" or "answer"
+    return _current_stage.get()
+
+def count_call(backend, n=1):
+    # Count a backend call (complete, search, relevance, sql, ...) against the request that is currently running
+    pipeline = _current_pipeline.get()
+    if pipeline is not None:
+        pipeline.count_call(backend, n)
+
+class StagePipeline:
+    # Runs the stages of a single request, either inline or on the shared thread pool,
+    # and records when each stage started and finished relative to the start of the request.
+
+    def __init__(self, executor=None):
+        self.executor = executor or _executor
+        self.started = time.perf_counter()
+        self.futures = {}
+        self.timings = {}
+        self.discarded = set()
+        self.calls = Counter()
+        self.first_token_s = None
+        self.notes = {} # per-request statistics from the stages, e.g. prompt sizes
+        self.deadline = None # resilience.Deadline for the whole request, if it has one
+        self._lock = threading.Lock()
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_pipeline.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _current_pipeline.reset(self._token)
+        return False
+
+    def count_call(self, backend, n=1):
+        with self._lock:
+            self.calls[backend] += n
+
+    def _timed(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        token = _current_stage.set(name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_stage.reset(token)
+            self.record(name, start, time.perf_counter())
+
+    def record(self, name, start, end):
+        # Record a stage that ran outside run()/submit(), e.g. a streamed answer consumed by the UI
+        self.timings[name] = (start - self.started, end - self.started)
+
+    def run(self, name, fn, *args, **kwargs):
+        # Run a stage in the calling thread (for stages nothing else can overlap with)
+        return self._timed(name, fn, *args, **kwargs)
+
+    def submit(self, name, fn, *args, **kwargs):
+        # Stages run in a copy of the caller's context so that count_call() still finds this pipeline
+        context = contextvars.copy_context()
+        future = self.executor.submit(context.run, self._timed, name, fn, *args, **kwargs)
+        self.futures[name] = future
+        return future
+
+    def result(self, name, timeout=None):
+        return self.futures[name].result(timeout=timeout)
+
+    def discard(self, name):
+        # Throw away a speculative stage. If it has not started yet it never runs,
+        # otherwise it finishes in the background and its result is ignored.
+        self.discarded.add(name)
+        future = self.futures.get(name)
+        if future is not None:
+            future.cancel()
+
+    def breakdown(self):
+        wall_clock = time.perf_counter() - self.started
+        stages = {}
+        for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            stages[name] = {
+                "start_s": round(start, 4),
+                "end_s": round(end, 4),
+                "duration_s": round(end - start, 4),
+                "discarded": name in self.discarded,
+            }
+        serial = sum(stage["duration_s"] for stage in stages.values() if not stage["discarded"])
+        return {
+            "stages": stages,
+            "wall_clock_s": round(wall_clock, 4),
+            "serial_s": round(serial, 4), # time the same stages would have taken one after another
+            "saved_s": round(max(0.0, serial - wall_clock), 4),
+            "time_to_first_token_s": None if self.first_token_s is None else round(self.first_token_s, 4),
+            "calls": dict(self.calls),
+            "total_calls": sum(self.calls.values()),
+            **self.notes,
+        }
+
+class SingleFlight:
+    # Calls made with the same key share one result: the first caller runs fn, callers arriving while it is
+    # running (or after it finished, for the life of this object) wait for and reuse its result or exception
+
+    def __init__(self):
+        self.futures = {}
+        self.calls = 0
+        self.shared = 0
+        self._lock = threading.Lock()
+
+    def call(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self.futures.get(key)
+            owner = future is None
+            if owner:
+                future = self.futures[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not owner:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "shared": self.shared}
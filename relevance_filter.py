@@ -0,0 +1,106 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from cache import TTLCache
+from pipeline import count_call
+
+RELEVANCE_WORKERS = 40 # concurrent scoring calls per process: several requests' worth of max_workers each
+RELEVANCE_TIMEOUT = 4.0 # seconds the filter may spend before unscored chunks are decided by the fallback policy
+RELEVANCE_CACHE_TTL = 24 * 60 * 60
+RELEVANCE_CACHE_SIZE = 20000
+
+KEEP = "keep" # if no chunk could be scored at all, they are all passed through to the prompt
+DROP = "drop" # unscored chunks are left out
+
+# Process-wide, so filters rebuilt on every Streamlit rerun share the worker threads and the scores
+_executor = ThreadPoolExecutor(max_workers=RELEVANCE_WORKERS, thread_name_prefix="capstruct-relevance")
+_score_cache = TTLCache(RELEVANCE_CACHE_TTL, maxsize=RELEVANCE_CACHE_SIZE)
+
+def chunk_key(query, chunk):
+    return (" ".join(query.lower().split()), hashlib.sha1(chunk.encode("utf-8")).hexdigest())
+
+class RelevanceFilter:
+    # Scores the retrieved chunks against the query concurrently, keeps those scoring at least `threshold`,
+    # and memoizes (query, chunk hash) -> score so repeated questions don't pay for scoring again.
+    # Each request scores at most `max_workers` chunks at a time, best ranked first, so a filter shared by every
+    # session doesn't let one request's chunks queue behind another's; chunks not started by the deadline are
+    # never scored. Chunks left unscored are dropped, unless the fallback is KEEP and none could be scored.
+
+    def __init__(self, score_fn, threshold, max_workers=5, timeout=RELEVANCE_TIMEOUT, fallback=KEEP, cache=None):
+        self.score_fn = score_fn # e.g. the Cortex provider's context_relevance(question, context) -> float
+        self.threshold = threshold
+        self.max_workers = max_workers # scoring calls in flight per request
+        self.timeout = timeout
+        self.fallback = fallback
+        self.cache = _score_cache if cache is None else cache
+        self.timed_out = 0
+        self.skipped = 0 # chunks whose scoring hadn't started by the deadline
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def _score(self, query, chunk, expires):
+        if time.monotonic() >= expires:
+            return None # the request has given up on it
+        score = self.score_fn(query, chunk)
+        if not isinstance(score, float):
+            score = score[0] # feedback functions may return (score, reasons)
+        self.cache.set(chunk_key(query, chunk), score)
+        return score
+
+    def scores(self, query, chunks):
+        # {chunk: score}, without the chunks that couldn't be scored within the budget
+        scores = {}
+        pending = []
+        for chunk in dict.fromkeys(chunks):
+            score = self.cache.get(chunk_key(query, chunk))
+            if score is not None:
+                scores[chunk] = score
+            else:
+                pending.append(chunk)
+        if not pending:
+            return scores
+
+        count_call("relevance", len(pending))
+        expires = time.monotonic() + self.timeout
+        pending.reverse() # popped best ranked first
+        futures = {}
+        while pending or futures:
+            while pending and len(futures) < self.max_workers:
+                chunk = pending.pop()
+                futures[_executor.submit(self._score, query, chunk, expires)] = chunk
+            done, _ = wait(futures, timeout=max(0.0, expires - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                chunk = futures.pop(future)
+                try:
+                    score = future.result()
+                except Exception:
+                    with self._lock:
+                        self.failed += 1
+                    continue
+                if score is not None:
+                    scores[chunk] = score
+
+        # Chunks already being scored finish in the background and land in the cache for next time
+        cancelled = sum(future.cancel() for future in futures)
+        with self._lock:
+            self.timed_out += len(futures) - cancelled
+            self.skipped += len(pending) + cancelled
+        return scores
+
+    def filter(self, query, chunks):
+        # The chunks that pass, in their original (search rank) order
+        scores = self.scores(query, chunks)
+        if not scores and self.fallback == KEEP:
+            return list(chunks) # the scorer is unavailable; keep the search results rather than an empty context
+        return [chunk for chunk in chunks if scores.get(chunk, -1.0) >= self.threshold]
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["timed_out"] = self.timed_out
+        stats["skipped"] = self.skipped
+        stats["failed"] = self.failed
+        return stats
@@ -0,0 +1,262 @@
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from pipeline import current_pipeline, current_stage, percentile
+
+REQUEST_DEADLINE = 45.0 # seconds for a whole question, from the rewrite to the first answer token
+STAGE_TIMEOUTS = { # the most a single stage may take of what is left of the deadline
+    "rewrite": 8.0,
+    "classify": 6.0,
+    "answer": 30.0, # to the first token when streaming
+}
+DEFAULT_TIMEOUT = 20.0 # completions outside a request's stages, e.g. conversation summaries
+RETRIES = 2
+BACKOFF = 0.25 # base of the exponential backoff between retries, with full jitter
+HEDGE_MIN_SAMPLES = 20 # latencies seen for a stage before its p95 is trusted as the hedge delay
+HEDGE_MIN_DELAY = 0.5
+FAILURE_THRESHOLD = 5 # consecutive failures that open the circuit
+RESET_TIMEOUT = 30.0 # seconds the circuit stays open before a trial call is let through
+COMPLETE_WORKERS = 16
+
+# Completion attempts run here so the caller can stop waiting; an abandoned attempt finishes in the background
+_executor = ThreadPoolExecutor(max_workers=COMPLETE_WORKERS, thread_name_prefix="capstruct-complete")
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class Deadline:
+
+    def __init__(self, seconds, clock=time.monotonic):
+        self.clock = clock
+        self.expires = clock() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - self.clock())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, stage_timeout):
+        return min(stage_timeout, self.remaining())
+
+class CircuitBreaker:
+    # Closed: calls go through. Open after `failure_threshold` consecutive failures: calls fail fast.
+    # Half-open once `reset_timeout` has passed: one trial call decides whether it closes again.
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.clock() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def release(self):
+        # A call let through that neither succeeded nor failed, e.g. one the caller gave up on: a half-open
+        # breaker lets the next call be its trial
+        with self._lock:
+            self.trial = False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial:
+                    self.opens += 1
+                self.opened_at = self.clock()
+                self.trial = False
+
+class ResilientComplete:
+    # Drop-in wrapper for complete(model, prompt, stream=False) that bounds each call by the stage's timeout and the
+    # request's deadline, sends a duplicate (hedged) request when the first one is slower than the stage's recent
+    # p95 for that model, retries failures with jittered backoff, and fails fast while the circuit breaker is open.
+    # There is a breaker per (model, stage), so a failing small model doesn't cut off the answer model; every failed
+    # attempt counts towards it, a retry is only made while it still allows calls, and running out of the request's
+    # own deadline doesn't count. Retries share the stage's timeout rather than each getting a fresh one.
+    # Streaming calls are hedged and timed up to their first chunk; the rest of the stream is not interrupted.
+
+    def __init__(self, complete, stage_timeouts=STAGE_TIMEOUTS, default_timeout=DEFAULT_TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, hedge=True, hedge_min_delay=HEDGE_MIN_DELAY, make_breaker=CircuitBreaker, rng=None):
+        self.complete = complete
+        self.stage_timeouts = stage_timeouts
+        self.default_timeout = default_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.make_breaker = make_breaker
+        self.breakers = {} # (model, stage) -> CircuitBreaker
+        self.rng = rng or random.Random()
+        self.latencies = {} # (stage, model) -> recent successful latencies
+        self.counts = {"calls": 0, "hedges": 0, "hedge_wins": 0, "retries": 0, "timeouts": 0, "rejected": 0}
+        self._lock = threading.Lock()
+
+    def breaker(self, model, stage):
+        with self._lock:
+            breaker = self.breakers.get((model, stage))
+            if breaker is None:
+                breaker = self.breakers[model, stage] = self.make_breaker()
+            return breaker
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def hedge_delay(self, stage, model, timeout):
+        with self._lock:
+            recent = list(self.latencies.get((stage, model), ()))
+        if len(recent) < HEDGE_MIN_SAMPLES:
+            return timeout / 2
+        return max(self.hedge_min_delay, percentile(recent, 95))
+
+    def _observe(self, stage, model, seconds):
+        with self._lock:
+            self.latencies.setdefault((stage, model), deque(maxlen=200)).append(seconds)
+
+    def _attempt(self, model, prompt, stream, expires):
+        if time.monotonic() >= expires:
+            # queued behind other calls until its caller had already given up
+            raise DeadlineExceeded("attempt expired before it started")
+        if not stream:
+            return self.complete(model, prompt)
+        chunks = iter(self.complete(model, prompt, stream=True))
+        return next(chunks, ""), chunks
+
+    def _hedged(self, stage, model, prompt, stream, timeout):
+        # One attempt, plus a duplicate if the first is slower than the hedge delay; the first to finish wins
+        start = time.monotonic()
+        expires = start + timeout
+        submit = lambda: _executor.submit(contextvars.copy_context().run, self._attempt, model, prompt, stream, expires)
+        first = submit()
+        futures = all_futures = [first]
+        done, _ = wait(futures, timeout=min(self.hedge_delay(stage, model, timeout), timeout) if self.hedge else timeout)
+        if not done and self.hedge and time.monotonic() - start < timeout:
+            self._count("hedges")
+            futures = all_futures = [first, submit()]
+        while not done:
+            left = timeout - (time.monotonic() - start)
+            if left <= 0:
+                break
+            done, _ = wait(futures, timeout=left, return_when=FIRST_COMPLETED)
+            if done and all(future.exception() is not None for future in done) and len(done) < len(futures):
+                # the first to finish failed; give the other one the rest of the time
+                futures = [future for future in futures if future not in done]
+                done = set()
+                continue
+        if not done:
+            self._count("timeouts")
+            _abandon(all_futures, stream)
+            raise DeadlineExceeded(f"{stage or 'complete'} did not finish within {timeout:.1f}s")
+
+        future = next((future for future in done if future.exception() is None), next(iter(done)))
+        _abandon([other for other in all_futures if other is not future], stream)
+        result = future.result()
+        if future is not first:
+            self._count("hedge_wins")
+        self._observe(stage, model, time.monotonic() - start)
+        return result
+
+    def __call__(self, model, prompt, stream=False):
+        stage = current_stage() or ("answer" if stream else None)
+        pipeline = current_pipeline()
+        deadline = pipeline.deadline if pipeline is not None else None
+        stage_timeout = self.stage_timeouts.get(stage, self.default_timeout)
+
+        breaker = self.breaker(model, stage)
+        self._count("calls")
+        if not breaker.allow():
+            self._count("rejected")
+            raise CircuitOpenError(f"{model} is failing for {stage or 'complete'}; circuit open")
+        stage_expires = time.monotonic() + stage_timeout
+        error = None
+        for attempt in range(self.retries + 1):
+            stage_left = stage_expires - time.monotonic()
+            timeout = deadline.timeout(stage_left) if deadline is not None else stage_left
+            if timeout <= 0:
+                breaker.release() # out of time before this attempt started; the model didn't fail it
+                if error is not None:
+                    raise error
+                raise DeadlineExceeded("request deadline passed")
+            try:
+                result = self._hedged(stage, model, prompt, stream, timeout)
+            except DeadlineExceeded as e:
+                if timeout < stage_left:
+                    # cut short by the request's deadline rather than the stage's own timeout
+                    breaker.release()
+                    raise
+                breaker.failure()
+                error = e
+            except Exception as e:
+                breaker.failure()
+                error = e
+            else:
+                breaker.success()
+                break
+            if attempt == self.retries or not breaker.allow():
+                # out of retries, or the breaker opened on this call's failures or other calls'
+                raise error
+            self._count("retries")
+            time.sleep(min(self.rng.uniform(0, self.backoff * 2 ** attempt), max(0.0, stage_expires - time.monotonic())))
+
+        if not stream:
+            return result
+        first, rest = result
+        return _prepend(first, rest)
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self.breakers)
+            counts = dict(self.counts)
+        open_breakers = sorted(f"{model}/{stage or 'complete'}" for (model, stage), breaker in breakers.items()
+                               if breaker.state != "closed")
+        return dict(counts, breakers_open=open_breakers, breaker_opens=sum(breaker.opens for breaker in breakers.values()))
+
+def _abandon(futures, stream):
+    # Attempts nobody is waiting for: drop the ones that haven't started, and close the stream of any that do
+    # come back so its connection isn't left open
+    for future in futures:
+        if not future.cancel() and stream:
+            future.add_done_callback(_close_stream)
+
+def _close_stream(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result()[1], "close", None)
+    if close is not None:
+        close()
+
+def _prepend(first, rest):
+    if first:
+        yield first
+    yield from rest
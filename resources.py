@@ -0,0 +1,68 @@
+import time
+
+from search_client import CachingSearchClient
+from session_pool import HEALTH_CHECK_INTERVAL, POOL_SIZE, SessionPool, SharedSession
+
+class SnowflakeResources:
+    # Process-wide Snowflake handles shared by every browser session and rerun: a pool of Snowpark sessions, and
+    # for each pooled session its search service handle and TruLens relevance provider, built on first use. Every
+    # call checks a session out for itself, so concurrent users get parallel connections up to `pool_size`.
+    # A session that sat idle for `health_check_interval` seconds is checked before it is used again, and
+    # replaced, together with everything built from it, when it has expired. Given an `active_session` (Streamlit
+    # in Snowflake) every call shares that one session instead.
+
+    def __init__(self, connect, search_service, make_provider=None, search_name="",
+                 health_check_interval=HEALTH_CHECK_INTERVAL, clock=time.monotonic, pool_size=POOL_SIZE,
+                 active_session=None):
+        self.connect = connect # () -> Snowpark session
+        self.search_service = search_service # session -> Cortex search service handle
+        self.make_provider = make_provider # session -> TruLens provider, only built when first needed
+        if active_session is not None:
+            self.pool = SharedSession(active_session, clock=clock)
+        else:
+            self.pool = SessionPool(lambda: self._timed("connect_s", self.connect), max_size=pool_size,
+                                    health_check_interval=health_check_interval, clock=clock)
+        self.search = CachingSearchClient(_LiveSearchService(self), name=search_name)
+        self.timings = {} # seconds spent building each resource, most recent build
+
+    def _timed(self, name, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 4)
+
+    def service(self, session):
+        # The search service handle of a checked-out session
+        return self.pool.attached(session, "service", lambda session: self._timed("search_service_s", self.search_service, session))
+
+    def provider(self, session):
+        return self.pool.attached(session, "provider", lambda session: self._timed("provider_s", self.make_provider, session))
+
+    def run(self, fn, *args, **kwargs):
+        # fn(session, ...) on a pooled session, retried once on a fresh session if it fails and the session turns
+        # out to have expired
+        return self.pool.run(fn, *args, **kwargs)
+
+    def stream(self, fn, *args, **kwargs):
+        # fn(session, ...) returning an iterator; the session is given back once it is exhausted or closed
+        return self.pool.stream(fn, *args, **kwargs)
+
+    def stats(self):
+        stats = self.pool.stats()
+        return {
+            "connects": stats["created"],
+            "reconnects": stats["discarded"],
+            "provider_loaded": any("provider" in entry.attached for entry in list(self.pool.entries.values())),
+            "pool": stats,
+            **self.timings,
+        }
+
+class _LiveSearchService:
+    # Search service handle that runs each search on a pooled session's service, so a reconnect is picked up
+
+    def __init__(self, resources):
+        self.resources = resources
+
+    def search(self, query, columns, **kwargs):
+        return self.resources.run(lambda session: self.resources.service(session).search(query, columns, **kwargs))
@@ -0,0 +1,77 @@
+import json
+from dataclasses import dataclass, field, replace
+
+from category_router import ALL
+from pipeline import StagePipeline, current_pipeline
+
+@dataclass(frozen=True)
+class RetrievalResult:
+    # Everything retrieval produced for one question, carried through the rest of the request
+    query: str
+    category: str = ALL
+    results: list = field(default_factory=list) # hits from the search service, one dict of COLUMNS per chunk
+    raw_json: str = ""
+    kept: list = None # hits that passed the relevance filter, None when no filter was applied
+
+    @classmethod
+    def from_response(cls, query, category, response):
+        if response.results:
+            return cls(query, category, list(response.results), response.json())
+        return cls(query, category)
+
+    @property
+    def context_results(self):
+        return self.results if self.kept is None else self.kept
+
+    @property
+    def chunks(self):
+        return [curr["chunk"] for curr in self.context_results]
+
+    @property
+    def relative_paths(self):
+        # Documents behind the context, or behind every hit if the filter rejected them all
+        hits = self.context_results or self.results
+        return list(dict.fromkeys(curr["relative_path"] for curr in hits if curr.get("relative_path")))
+
+    def context_json(self):
+        if self.kept is None:
+            return self.raw_json
+        if not self.kept:
+            return ""
+        return json.dumps({"results": self.kept})
+
+    def with_kept_chunks(self, chunks):
+        chunks = set(chunks)
+        return replace(self, kept=[curr for curr in self.results if curr["chunk"] in chunks])
+
+def search_chunks(svc, query, columns, cat=ALL, limit=5):
+    if cat == ALL:
+        return svc.search(query, columns, limit=limit)
+    filter_obj = {"@eq":{"category": cat}}
+    return svc.search(query, columns, filter=filter_obj, limit=limit)
+
+def retrieve(svc, query, columns, router, pipeline=None, limit=5):
+    # One category decision and one search per question
+
+    if pipeline is None:
+        pipeline = current_pipeline() or StagePipeline()
+
+    route = pipeline.run("route", router.predict, query)
+    if router.confident(route) or router.fallback is None:
+        cat = route.category
+        response = pipeline.run("search", search_chunks, svc, query, columns, cat, limit)
+        return RetrievalResult.from_response(query, cat, response)
+
+    # The local router isn't sure, so ask the LLM. The unfiltered search starts while the classifier is still
+    # running, since most questions don't ask for a category. If a category comes back, the speculative result is thrown away.
+    pipeline.submit("classify", router.classify_with_fallback, query)
+    pipeline.submit("search", search_chunks, svc, query, columns, ALL, limit)
+    cat = pipeline.result("classify").category
+
+    if cat == ALL:
+        response = pipeline.result("search")
+    else:
+        pipeline.discard("search")
+        response = pipeline.run("search_filtered", search_chunks, svc, query, columns, cat, limit)
+
+    return RetrievalResult.from_response(query, cat, response)
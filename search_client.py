@@ -0,0 +1,63 @@
+import json
+import sys
+
+from cache import TTLCache
+from pipeline import count_call
+
+SEARCH_CACHE_TTL = 60 # matches the service's TARGET_LAG = '1 minute', so cached results never outlive a re-index by more than that
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_BYTES = 32 * 1024 * 1024
+
+class SearchResponse:
+    # Detached copy of a search response with the same .results / .json() interface as the Cortex one
+
+    def __init__(self, results, raw_json=None):
+        self.results = results
+        self._json = raw_json
+
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps({"results": self.results})
+        return self._json
+
+def _sizeof(response):
+    return sys.getsizeof(response.json())
+
+# Shared by every client in the process, so reruns and other sessions reuse each other's results
+_search_cache = TTLCache(SEARCH_CACHE_TTL, maxsize=SEARCH_CACHE_SIZE, max_bytes=SEARCH_CACHE_BYTES, sizeof=_sizeof)
+
+def canonical_key(name, query, columns, filter, limit):
+    return (
+        name,
+        " ".join(query.split()),
+        tuple(columns),
+        json.dumps(filter, sort_keys=True, separators=(",", ":")) if filter is not None else None,
+        limit,
+    )
+
+class CachingSearchClient:
+    # Drop-in wrapper around a Cortex search service handle that memoizes svc.search(query, columns, filter, limit)
+
+    def __init__(self, svc, name="", cache=None):
+        self.svc = svc
+        self.name = name # distinguishes services sharing the process-wide cache
+        self.cache = _search_cache if cache is None else cache
+
+    def search(self, query, columns, filter=None, limit=10):
+        key = canonical_key(self.name, query, columns, filter, limit)
+        response = self.cache.get(key)
+        if response is not None:
+            count_call("search_cache_hit")
+            return response
+
+        count_call("search")
+        if filter is None:
+            raw = self.svc.search(query, columns, limit=limit)
+        else:
+            raw = self.svc.search(query, columns, filter=filter, limit=limit)
+        response = SearchResponse(list(raw.results or []), raw.json())
+        self.cache.set(key, response)
+        return response
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,245 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from pipeline import percentile
+
+POOL_SIZE = 8 # sessions at most; size it against what the warehouse can run at once
+HEALTH_CHECK_INTERVAL = 300 # seconds a session may sit idle before it is checked again on checkout
+CHECKOUT_TIMEOUT = 30.0 # seconds to wait for a free session before giving up
+WAIT_WINDOW = 500 # recent checkout waits kept for the percentiles
+
+class PoolTimeout(TimeoutError):
+    pass
+
+class _Entry:
+
+    def __init__(self, session, now):
+        self.session = session
+        self.returned = now # when it was last given back (or created)
+        self.attached = {} # objects built from this session, e.g. its search service handle
+
+class SessionPool:
+    # A bounded pool of Snowpark sessions. Each request checks a session out, uses it alone and gives it back,
+    # so concurrent users don't queue on one connection. Sessions are created on demand up to max_size; one that
+    # sat idle for health_check_interval is checked with "select 1" before it is handed out, and replaced if dead.
+
+    def __init__(self, connect, max_size=POOL_SIZE, health_check_interval=HEALTH_CHECK_INTERVAL,
+                 timeout=CHECKOUT_TIMEOUT, clock=time.monotonic):
+        self.connect = connect # () -> a new Snowpark session
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self.clock = clock
+        self.idle = deque() # most recently returned last, so the same few sessions stay warm
+        self.entries = {} # id(session) -> _Entry, for every session in the pool
+        self.size = 0 # sessions in the pool or being connected
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.counts = {"checkouts": 0, "waited": 0, "timeouts": 0, "created": 0, "discarded": 0, "health_checks": 0}
+        self.waits = deque(maxlen=WAIT_WINDOW)
+        self._cond = threading.Condition()
+
+    def _create(self):
+        session = self.connect()
+        with self._cond:
+            self.entries[id(session)] = _Entry(session, self.clock())
+            self.counts["created"] += 1
+        return session
+
+    def _close(self, session):
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def healthy(self, session):
+        with self._cond:
+            self.counts["health_checks"] += 1
+        try:
+            session.sql("select 1").collect()
+        except Exception:
+            return False
+        return True
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            while not self.idle and self.size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counts["timeouts"] += 1
+                    raise PoolTimeout(f"no Snowflake session free within {timeout}s ({self.max_size} in use)")
+                self._cond.wait(remaining)
+            entry = self.idle.pop() if self.idle else None
+            if entry is None:
+                self.size += 1 # reserved while connecting
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.counts["checkouts"] += 1
+            wait = time.monotonic() - start
+            self.counts["waited"] += wait > 0.001
+            self.waits.append(wait)
+
+        try:
+            if entry is None:
+                return self._create()
+            if self.clock() - entry.returned >= self.health_check_interval and not self.healthy(entry.session):
+                self._forget(entry.session)
+                with self._cond:
+                    self.size += 1
+                return self._create()
+            return entry.session
+        except BaseException:
+            with self._cond:
+                self.size -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+
+    def _forget(self, session):
+        with self._cond:
+            self.entries.pop(id(session), None)
+            self.size -= 1
+            self.counts["discarded"] += 1
+        self._close(session)
+
+    def release(self, session, discard=False):
+        if discard:
+            self._forget(session)
+        with self._cond:
+            self.in_use -= 1
+            entry = self.entries.get(id(session))
+            if entry is not None and not discard:
+                entry.returned = self.clock()
+                self.idle.append(entry)
+            self._cond.notify()
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        session = self.acquire(timeout)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def _checked_out(self, fn, *args, **kwargs):
+        # (session, fn(session, ...)) with the session still checked out, retried once on another session if fn
+        # fails and its session turns out to be dead
+        session = self.acquire()
+        try:
+            return session, fn(session, *args, **kwargs)
+        except Exception:
+            healthy = self.healthy(session)
+            self.release(session, discard=not healthy)
+            if healthy:
+                raise
+        except BaseException:
+            self.release(session)
+            raise
+        session = self.acquire()
+        try:
+            return session, fn(session, *args, **kwargs)
+        except BaseException:
+            self.release(session)
+            raise
+
+    def run(self, fn, *args, **kwargs):
+        # fn(session, ...) on a session of its own
+        session, result = self._checked_out(fn, *args, **kwargs)
+        self.release(session)
+        return result
+
+    def stream(self, fn, *args, **kwargs):
+        # fn(session, ...) returning an iterator, e.g. a streamed Complete, that may still read through the session.
+        # The session stays checked out until the stream is exhausted, fails or is closed.
+        session, chunks = self._checked_out(lambda session: iter(fn(session, *args, **kwargs)))
+        return _HeldStream(self, session, chunks)
+
+    def attached(self, session, name, build):
+        # build(session), made once per pooled session and kept for as long as the session is; `session` must be
+        # checked out by the caller
+        entry = self.entries[id(session)]
+        if name not in entry.attached:
+            entry.attached[name] = build(session)
+        return entry.attached[name]
+
+    def stats(self):
+        with self._cond:
+            waits = list(self.waits)
+            return dict(self.counts, max_size=self.max_size, size=self.size, in_use=self.in_use, idle=len(self.idle),
+                        peak_in_use=self.peak_in_use, wait_p50_s=percentile(waits, 50),
+                        wait_p95_s=percentile(waits, 95), wait_max_s=max(waits, default=None))
+
+class SharedSession(SessionPool):
+    # The one active session of Streamlit in Snowflake, where the app can't open sessions of its own. It is handed
+    # to every caller at once instead of being checked out, so one user's streamed answer doesn't queue everyone
+    # else's searches behind it, and it is never health-checked away or closed: Snowflake owns it.
+
+    def __init__(self, session, clock=time.monotonic):
+        super().__init__(lambda: session, max_size=1, clock=clock)
+        self.session = session
+        self.entries[id(session)] = _Entry(session, clock())
+        self.size = 1
+        self.counts["created"] = 1
+
+    def acquire(self, timeout=None):
+        with self._cond:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.counts["checkouts"] += 1
+            self.waits.append(0.0)
+        return self.session
+
+    def release(self, session, discard=False):
+        with self._cond:
+            self.in_use -= 1
+
+    def _checked_out(self, fn, *args, **kwargs):
+        # No other session to retry on
+        session = self.acquire()
+        try:
+            return session, fn(session, *args, **kwargs)
+        except BaseException:
+            self.release(session)
+            raise
+
+class _HeldStream:
+    # Iterator over a stream read through a checked-out session, which goes back to the pool exactly once: when the
+    # stream ends, fails or is closed, or when it is dropped unread
+
+    def __init__(self, pool, session, chunks):
+        self.pool = pool
+        self.session = session
+        self.chunks = chunks
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.session is None:
+            raise StopIteration
+        try:
+            return next(self.chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            session, self.session = self.session, None
+        if session is None:
+            return
+        try:
+            close = getattr(self.chunks, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self.pool.release(session)
+
+    def __del__(self):
+        self.close()
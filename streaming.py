@@ -0,0 +1,39 @@
+import time
+
+class TimedStream:
+    # Wraps the chunks of a completion, recording time-to-first-token and total time from the start of the request.
+    # A plain string is treated as a stream with a single chunk, so non-streaming answers go through the same path;
+    # their stage was already timed by pipeline.run(), or never ran (a cached answer), so it isn't recorded here.
+
+    def __init__(self, chunks, pipeline=None, stage="answer", on_complete=None):
+        self.streamed = not isinstance(chunks, str)
+        self.chunks = chunks if self.streamed else [chunks]
+        self.pipeline = pipeline
+        self.stage = stage
+        self.on_complete = on_complete # called with the full text once the stream is exhausted
+        self.started = pipeline.started if pipeline is not None else time.perf_counter()
+        self.stage_started = time.perf_counter()
+        self.first_token_s = None
+        self.total_s = None
+        self.parts = []
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.first_token_s is None:
+                self.first_token_s = time.perf_counter() - self.started
+            self.parts.append(chunk)
+            yield chunk
+        self.total_s = time.perf_counter() - self.started
+        if self.pipeline is not None:
+            if self.streamed and self.stage not in self.pipeline.timings:
+                self.pipeline.record(self.stage, self.stage_started, time.perf_counter())
+            self.pipeline.first_token_s = self.first_token_s
+        if self.on_complete is not None:
+            self.on_complete(self.text)
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def timings(self):
+        return {"time_to_first_token_s": self.first_token_s, "total_s": self.total_s}
@@ -1,17 +1,31 @@
+import time
+_script_started = time.perf_counter()
+import os
+import re
+import sys
+import uuid
+from collections import deque
+
 import streamlit as st # Import python packages
 from snowflake.snowpark import Session
 from snowflake.cortex import Complete
 from snowflake.core import Root
-from snowflake.connector import connect
 from snowflake.snowpark.context import get_active_session
 
-from trulens.core import Feedback
-from trulens.core.guardrails.base import context_filter
-from trulens.apps.custom import instrument
-from trulens.providers.cortex.provider import Cortex
-
 import pandas as pd
-import json
+
+from answer_cache import get_answer_cache
+from conversation_memory import ConversationMemory, make_llm_summarizer, summary_executor
+from conversation_store import PAGE_SIZE, ConversationStore
+from doc_links import fetch_presigned_urls, resolve_urls, url_cache_stats
+from engine import Backends, RagEngine
+from model_router import ModelRouter
+from pipeline import count_call, percentile
+from relevance_filter import RelevanceFilter
+from resilience import REQUEST_DEADLINE, ResilientComplete
+from resources import SnowflakeResources
+from submissions import Submission, get_submissions
+from tracing import get_tracer
 
 pd.set_option("max_colwidth",None)
 
@@ -19,19 +33,19 @@ pd.set_option("max_colwidth",None)
 NUM_CHUNKS = 5 # Num-chunks provided as context. Play with this to check how it affects your accuracy
 slide_window = 7 # how many last conversations to remember. This is the slide window.
 MIN_SCORE = 0.6 # minimum relevance score for a chunk to be accepted as context
+CONTEXT_TOKEN_BUDGET = 2000 # tokens of retrieved text packed into the answer prompt
+RELEVANCE_TIMEOUT = 4.0 # seconds of relevance scoring before unscored chunks are decided by RELEVANCE_FALLBACK
+RELEVANCE_FALLBACK = "keep" # "keep" every chunk when none could be scored in time, or "drop" them
+ROUTER_THRESHOLD = 0.8 # minimum confidence for the local category router before falling back to the LLM classifier
+STREAM_ANSWER = True # stream the answer into the chat as it is generated instead of waiting for the whole response
+POOL_SIZE = int(os.environ.get("CAPSTRUCT_POOL_SIZE", 8)) # Snowpark sessions shared by all users; size it against the warehouse
+LOCAL_INDEX = os.environ.get("CAPSTRUCT_LOCAL_INDEX") # directory built by `local_index.py build`; Cortex search stays the fallback
 
 # service parameters
 CORTEX_SEARCH_DATABASE = "CC_QUICKSTART_CORTEX_SEARCH_DOCS"
 CORTEX_SEARCH_SCHEMA = "DATA"
 CORTEX_SEARCH_SERVICE = "CC_SEARCH_SERVICE_CS"
 
-# columns to query in the service
-COLUMNS = [
-    "chunk",
-    "relative_path",
-    "category"
-]
-
 connection_params = {
       "account": st.secrets["ACCOUNT"],
       "user": st.secrets["USER"],
@@ -42,23 +56,47 @@ connection_params = {
       "warehouse": "COMPUTE_WH"
     }
 
-try:
-    session = get_active_session()
-except:
-    session =  Session.builder.configs(connection_params).create()
+def connect():
+    try:
+        return get_active_session()
+    except:
+        return Session.builder.configs(connection_params).create()
 
-root = Root(session)                         
-svc = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE]
+def active_session():
+    # The session Streamlit in Snowflake runs with, None anywhere else
+    try:
+        return get_active_session()
+    except:
+        return None
 
-st.set_page_config(page_title=None, page_icon=None, layout="centered", initial_sidebar_state="expanded", menu_items=None) 
+def search_service(session):
+    root = Root(session)
+    return root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE]
 
-debug = False
+def make_provider(session):
+    # TruLens is only imported once the relevance filter first needs a score
+    from trulens.providers.cortex.provider import Cortex
+    return Cortex(snowpark_session=session, model_engine=model_router.model("relevance"))
+
+@st.cache_resource
+def get_model_router():
+    # Per-stage model assignments (CAPSTRUCT_MODELS) and the latency and success counts they are tuned from
+    return ModelRouter.from_env()
+
+@st.cache_resource
+def get_resources():
+    # Built once per process rather than on every rerun, and shared by all sessions
+    # Inside Snowflake there is only the one active session, shared by every call rather than pooled
+    return SnowflakeResources(connect, search_service, make_provider, search_name=CORTEX_SEARCH_SERVICE, pool_size=POOL_SIZE,
+                              active_session=active_session())
 
-provider = Cortex(snowpark_session=session, model_engine="llama3.1-8b")
+model_router = get_model_router()
+resources = get_resources()
+svc = resources.search
 
-f_context_relevance_score = Feedback(
-        provider.context_relevance, name="Context Relevance"
-    )
+st.set_page_config(page_title=None, page_icon=None, layout="centered", initial_sidebar_state="expanded", menu_items=None) 
+
+debug = False
 
 def config_options():
 
@@ -66,198 +104,138 @@ def config_options():
     
     if debug:
         st.sidebar.expander("Session State").write(st.session_state)
+        st.sidebar.expander("Startup").json(startup_stats())
 
-def init_messages():
-
-    # Initialize chat history
-    if st.session_state.clear_conversation or "messages" not in st.session_state:
-        st.session_state.messages = []
-
-@instrument
-@context_filter(f_context_relevance_score, MIN_SCORE, keyword_for_prompt="query")
-def get_similar_chunks_search_service(query):
-    
-    prompt = f"""
-        Based on the QUESTION in between the <question> and </question> tags, if the user explicitly asks to search for a specific 
-        category of documents that matches one of the categories below, then answer in one word from the options below. Simply having the 
-        word in the question is not sufficient, the user must ask for an answer using the category of documents:
-        1. Safety
-        2. Building Code
-        3. Sustainability
-        4. Plumbing
-        5. Fire
-        6. Electrical
-
-        In all other cases, answer "ALL"
-        
-        <question>
-        {query}
-        </question>
-        """
-    cat = Complete('mistral-large2', prompt)
-    cat = cat.replace("'", "").strip()
-    #if st.session_state.category_value == "All Building and Safety Codes":
-
-    st.sidebar.text("Category")
-    st.sidebar.caption(cat)
+def start_conversation(conversation_id=None):
+    st.session_state.conversation_id = conversation_id or uuid.uuid4().hex
+    st.query_params["conversation"] = st.session_state.conversation_id # reloading the page resumes it
+    st.session_state.pending = None
+    st.session_state.history_pages = 1
+    st.session_state.export_ready = False
 
-    if cat == "ALL":
-        response = svc.search(query, COLUMNS, limit=NUM_CHUNKS)
-    else:
-        filter_obj = {"@eq":{"category": cat}}
-        response = svc.search(query, COLUMNS, filter=filter_obj, limit=NUM_CHUNKS)
+def init_messages():
 
-    if debug:
-        st.sidebar.json(response.json())
-    
-    if response.results:
-        results =  [curr["chunk"] for curr in response.results]
-        ret = response.json()
-    else:
-        results = []
-        ret = ""
-        
-    return results, ret
+    # Initialize chat history; the messages themselves live in the conversation store
+    if st.session_state.clear_conversation or "conversation_id" not in st.session_state:
+        resumed = None if st.session_state.clear_conversation else st.query_params.get("conversation")
+        start_conversation(resumed if resumed and re.fullmatch(r"[0-9a-f]{32}", resumed) else None)
+    if st.session_state.clear_conversation or "memory" not in st.session_state:
+        # the summary is updated in the background, not on the answer's request path
+        st.session_state.memory = ConversationMemory(max_messages=slide_window - 1, executor=summary_executor(),
+                                                     summarizer=make_llm_summarizer(engine.complete, model_router))
+        for message in conversation_store.page(st.session_state.conversation_id, limit=slide_window - 1):
+            st.session_state.memory.add(message.role, message.content)
+
+def complete(model, prompt, stream=False):
+    count_call("complete")
+    if stream:
+        # the session is held until the answer has been read to the end (or the stream is closed)
+        return resources.stream(lambda session: Complete(model, prompt, stream=True, session=session))
+    return resources.run(lambda session: Complete(model, prompt, session=session))
+
+def context_relevance(question, context):
+    return model_router.timed("relevance", resources.run,
+                              lambda session: resources.provider(session).context_relevance(question, context))
+
+def search_backend():
+    # The local index in front of the Cortex search service, when one is configured and loads
+    if not LOCAL_INDEX:
+        return svc
+    try:
+        from local_index import FallbackSearchService, LocalIndex # needs numpy
+        return FallbackSearchService(LocalIndex.load(LOCAL_INDEX), svc)
+    except Exception as e:
+        print(f"Local index {LOCAL_INDEX} unavailable, using Cortex search only: {e}", file=sys.stderr)
+        return svc
+
+@st.cache_resource
+def get_engine():
+    relevance_filter = RelevanceFilter(context_relevance, MIN_SCORE, max_workers=NUM_CHUNKS,
+                                       timeout=RELEVANCE_TIMEOUT, fallback=RELEVANCE_FALLBACK)
+    # Timeouts, hedging, retries and a circuit breaker around every Cortex completion, shared by all sessions
+    # Cached document links are resolved without checking out a session; only the misses go through the pool
+    urls = lambda paths: resolve_urls(paths, lambda missing: resources.run(fetch_presigned_urls, missing))
+    backends = Backends(ResilientComplete(complete), search_backend(), urls=urls)
+    return RagEngine(backends, relevance_filter=relevance_filter, answer_cache=get_answer_cache(), num_chunks=NUM_CHUNKS,
+                     min_score=MIN_SCORE, router_threshold=ROUTER_THRESHOLD, context_token_budget=CONTEXT_TOKEN_BUDGET,
+                     request_deadline=REQUEST_DEADLINE, model_router=model_router)
+
+engine = get_engine()
+relevance_filter = engine.relevance_filter
+answer_cache = engine.answer_cache
+submissions = get_submissions()
+
+@st.cache_resource
+def get_conversation_store():
+    # Every conversation's messages, in SQLite at CAPSTRUCT_CONVERSATIONS (default conversations.db)
+    return ConversationStore.from_env()
+
+conversation_store = get_conversation_store()
+tracer = get_tracer() # set CAPSTRUCT_TRACE=1 (stderr) or CAPSTRUCT_TRACE=<path> for per-request JSON lines
+
+@st.cache_resource
+def startup_report():
+    # Seconds from the top of the script to main(): the first run in this process, then the latest reruns
+    return {"cold_start_s": None, "reruns_s": deque(maxlen=100)}
+
+def startup_stats():
+    startup = startup_report()
+    reruns = list(startup["reruns_s"])
+    return {
+        "cold_start_s": startup["cold_start_s"],
+        "rerun_p50_s": percentile(reruns, 50),
+        "rerun_p95_s": percentile(reruns, 95),
+        "resources": resources.stats(),
+    }
 
 def get_chat_history():
-#Get the history from the st.session_stage.messages according to the slide window parameter
-    
-    chat_history = []
-    
-    start_index = max(0, len(st.session_state.messages) - slide_window)
-    for i in range (start_index , len(st.session_state.messages) -1):
-         chat_history.append(st.session_state.messages[i])
-
-    return chat_history
-
-def optimize_query(chat_history, question):
-    prompt = f"""
-        Based on the QUESTION between the <question> and </question> tags, 
-        generate a query that is easier for you to understand, whether it is by writing out commonly used abbreviations, or narrowing ambiguities. 
-        If the user attempts to rate your response in the QUESTION, generate a prompt commanding you to thank the user for their feedback if it is positive, or 
-        apologize and promise to do better if it is negative.
-        If the query is explicitly referencing previous information given by either you or the user, extend the QUESTION with the CHAT HISTORY 
-        provided between the <chat_history> and </chat_history> tags.
-        The query should be in natual language. 
-        Answer with only the query. Do not add any explanation.
-        
-        <question>
-        {question}
-        </question>
-        <chat_history>
-        {chat_history}
-        </chat_history>
-        """
-    
-    sumary = Complete('mistral-large2', prompt)   
+    # Recent messages plus a rolling summary of older ones, bounded in size however long the session gets
+    return st.session_state.memory
 
-    sumary = sumary.replace("'", "")
+def answer_question(submission, stream=STREAM_ANSWER):
+    # Returns the answer as a SharedStream; iterate it to get the text, which is generated lazily when streaming.
+    # The pipeline runs once per submission, however many reruns ask for it.
 
-    return sumary
-    
-    
-def create_prompt (myquestion):
+    answer = submissions.run(submission, engine.answer_question, submission.question.replace("'", ""),
+                             get_chat_history(), stream=stream)
 
-    chat_history = get_chat_history()
-    optimized_query = optimize_query(chat_history, myquestion)
-    
-    try:
-        _, prompt_context = get_similar_chunks_search_service(optimized_query)
-    except:
-        prompt_context = ""
-        
     st.sidebar.text("Optimized query:")
-    st.sidebar.caption(optimized_query)
-    prompt = f"""
-           You are an expert chat assistant that extracts information from the CONTEXT provided
-           between <context> and </context> tags.
-           You offer a chat experience considering the information included in the CHAT HISTORY
-           provided between <chat_history> and </chat_history> tags.
-           When answering the question contained between <question> and </question> tags
-           be concise and do not hallucinate.  
-           If you don't have the information, just say so.
-           
-           Do not mention the CONTEXT used in your answer.
-           Do not mention the CHAT HISTORY used in your answer.
-
-           If you can't answer the question from the CONTEXT provided, answer ignoring the CONTEXT and CHAT HISTORY, but also state that 
-           "This is the best answer I can provide with the available data. Please verify the information with the reference documents linked in 
-           the sidebar to ensure full compliance with relevant regulations." and bold the text if possible.
-           
-           If the user attempts to rate your response, either thank the user for their feedback if it is positive, or apologize and promise to do better
-           if it is negative.
-           
-           <chat_history>
-           {chat_history}
-           </chat_history>
-           <context>          
-           {prompt_context}
-           </context>
-           <question>  
-           {optimized_query}
-           </question>
-           Answer: 
-           """
-    
-    try:
-        json_data = json.loads(prompt_context)
-        relative_paths = set(item['relative_path'] for item in json_data['results'])
-    except:
-        relative_paths = []
-
-    return prompt, relative_paths
-
-def fetch_documents(query):
-    prompt = f"""
-        Based on the QUESTION in between the <question> and </question> tags, if the user explicitly asks to search for a specific 
-        category of documents that matches one of the categories below, then answer in one word from the options below. Simply having the 
-        word in the question is not sufficient, the user must ask for an answer using the category of documents:
-        1. Safety
-        2. Building Code
-        3. Sustainability
-        4. Plumbing
-        5. Fire
-        6. Electrical
-
-        In all other cases, answer "ALL"
-        
-        <question>
-        {query}
-        </question>
-        """
-    cat = Complete('mistral-large2', prompt)
-    cat = cat.replace("'", "").strip()
-
-    if cat == "ALL":
-        response = svc.search(query, COLUMNS, limit=NUM_CHUNKS)
-    else:
-        filter_obj = {"@eq":{"category": cat}}
-        response = svc.search(query, COLUMNS, filter=filter_obj, limit=NUM_CHUNKS)
-
-    data = json.loads(response.json())
-    relative_paths = set(item['relative_path'] for item in data['results'])
-    return relative_paths
-    
-def answer_question(myquestion):
+    st.sidebar.caption(answer.optimized_query)
+    st.sidebar.text("Category")
+    st.sidebar.caption(answer.category)
+    for error in answer.errors:
+        st.sidebar.caption(error)
 
-    prompt, relative_paths =create_prompt (myquestion)
-    response = Complete('mistral-large2', prompt)
+    if debug and answer.retrieval is not None and answer.retrieval.raw_json:
+        st.sidebar.json(answer.retrieval.raw_json)
 
-    if len(relative_paths) < 1:
-        relative_paths = fetch_documents(prompt)
-    return response, relative_paths
+    return answer.stream, answer.relative_paths
 
 def export_chat_history():
-    ret = ""
-    for message in st.session_state.messages:
-        ret += message["role"]
-        ret += ": "
-        ret += message["content"]
-        ret += "\n"
-    return ret
+    # Only built once "Download Chat" is clicked, read from the store a batch at a time
+    return conversation_store.export_bytes(st.session_state.conversation_id)
+
+def request_export():
+    st.session_state.export_ready = True
+
+def export_done():
+    st.session_state.export_ready = False
+
+def load_older_messages():
+    st.session_state.history_pages += 1
 
 def delete_conversation():
-    st.session_state.messages = []
+    conversation_store.delete(st.session_state.conversation_id)
+    st.session_state.memory.clear()
+    start_conversation()
+
+def submit_question():
+    # on_change of the question box and on_click of the send button, the only events that ask a question.
+    # Both firing for one question give the same submission.
+    question = st.session_state.question.strip()
+    if question:
+        conversation_id = st.session_state.conversation_id
+        st.session_state.pending = Submission.create(conversation_id, conversation_store.count(conversation_id), question)
     
 def main():    
     st.title("CapstructAI")
@@ -268,12 +246,21 @@ def main():
     
     with st.expander(label='Chat History'):
         with st.container(height=500):
-            for message in st.session_state.messages:
-                with st.chat_message(message["role"]):
-                    st.markdown(message["content"])
+            # Only the latest page of messages is rendered; older pages are loaded on demand
+            messages = conversation_store.page(st.session_state.conversation_id,
+                                               limit=PAGE_SIZE * st.session_state.history_pages)
+            if messages and messages[0].seq > 0:
+                st.button("Load older messages", key="older_messages", on_click=load_older_messages)
+            for message in messages:
+                with st.chat_message(message.role):
+                    st.markdown(message.content)
             col1, col2, col3 = st.columns([1,2,1])
             with col1:
-                st.download_button("Download Chat", data=export_chat_history(), file_name="chat_history.txt")
+                if st.session_state.export_ready:
+                    st.download_button("Save chat_history.txt", data=export_chat_history(), file_name="chat_history.txt",
+                                       on_click=export_done)
+                else:
+                    st.button("Download Chat", key="export_chat", on_click=request_export)
             with col3:
                 st.button("Clear Chat", key="delete_convo", on_click=delete_conversation)
 
@@ -283,13 +270,17 @@ def main():
     with input_field:
         col1, col2 = st.columns([6,1])
         with col1:
-            question = st.text_input("Enter question", placeholder="Ask me a question", label_visibility="collapsed")
+            question = st.text_input("Enter question", placeholder="Ask me a question", label_visibility="collapsed",
+                                     key="question", on_change=submit_question)
         with col2:
-            send_button = st.button(":arrow_forward:")
-    
-    if question or send_button:
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": question})
+            st.button(":arrow_forward:", on_click=submit_question)
+
+    submission = st.session_state.pending
+    if submission is None and question:
+        submissions.skip() # a rerun from another widget, with the last question still in the box
+
+    if submission is not None:
+        question = submission.question
         # Display user message in chat message container
         with st.chat_message("user"):
             st.markdown(question)
@@ -299,24 +290,68 @@ def main():
     
             question = question.replace("'","")
     
-            with st.spinner("Thinking..."):
-                response, relative_paths = answer_question(question)            
-                response = response.replace("'", "")
+            try:
+                with st.spinner("Thinking..."):
+                    stream, relative_paths = answer_question(submission)
+
+                response = ""
+                for chunk in stream:
+                    response += chunk.replace("'", "")
+                    message_placeholder.markdown(response + "▌")
                 message_placeholder.markdown(response)
-
-                if len(relative_paths) > 0:
-                    with st.sidebar.expander("Related Documents"):
-                        for path in relative_paths:
-                            cmd2 = f"select GET_PRESIGNED_URL(@docs, '{path}', 360) as URL_LINK from directory(@docs)"
-                            df_url_link = session.sql(cmd2).to_pandas()
-                            url_link = df_url_link._get_value(0,'URL_LINK')
-                
-                            display_url = f"Doc: [{path}]({url_link})"
-                            st.sidebar.markdown(display_url)
-
-        
-        st.session_state.messages.append({"role": "assistant", "content": response})
+            except Exception:
+                # Asking again starts over instead of replaying the same error on every rerun
+                st.session_state.pending = None
+                submissions.forget(submission)
+                raise
+
+            if "answer_timings" not in st.session_state:
+                st.session_state.answer_timings = []
+            st.session_state.answer_timings = st.session_state.answer_timings[-99:] + [stream.timings()]
+
+            if len(relative_paths) > 0:
+                with st.sidebar.expander("Related Documents"):
+                    url_links = engine.document_links(relative_paths, stream.pipeline)
+                    for path, url_link in url_links.items():
+                        display_url = f"Doc: [{path}]({url_link})"
+                        st.sidebar.markdown(display_url)
+
+                    if debug:
+                        st.sidebar.caption(f"Document link cache: {url_cache_stats()}")
+
+            request_id = tracer.finish(stream.pipeline, "app")
+
+            if debug:
+                if request_id is not None:
+                    st.sidebar.caption(f"Request id: {request_id}")
+                st.sidebar.expander("Stage timings").json(stream.pipeline.breakdown())
+                if tracer.enabled:
+                    st.sidebar.expander("Stage latency histograms").json(tracer.snapshot())
+                st.sidebar.caption(f"Conversation memory: {st.session_state.memory.stats()}")
+                st.sidebar.caption(f"Answer cache: {answer_cache.stats()}")
+                st.sidebar.caption(f"Search cache: {svc.stats()}")
+                if engine.svc is not svc:
+                    st.sidebar.caption(f"Local index: {engine.svc.stats()}")
+                st.sidebar.caption(f"Relevance scores: {relevance_filter.stats()}")
+                st.sidebar.caption(f"Completions: {engine.complete.stats()}")
+                st.sidebar.caption(f"Session pool: {resources.pool.stats()}")
+                st.sidebar.expander("Models by stage").json(model_router.stats())
+                st.sidebar.caption(f"Submissions: {submissions.stats()}")
+
+        # Recorded once the answer is complete, by whichever run got to the end of it
+        st.session_state.pending = None
+        conversation_store.append(st.session_state.conversation_id, "user", submission.question)
+        conversation_store.append(st.session_state.conversation_id, "assistant", response)
+        st.session_state.export_ready = False
+        st.session_state.memory.add("user", question)
+        st.session_state.memory.add("assistant", response)
         
 if __name__ == "__main__":
+    startup = startup_report()
+    setup_s = time.perf_counter() - _script_started
+    if startup["cold_start_s"] is None:
+        startup["cold_start_s"] = setup_s
+    else:
+        startup["reruns_s"].append(setup_s)
     main()
     
@@ -0,0 +1,135 @@
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+
+from cache import TTLCache
+
+# Each submitted question runs the pipeline exactly once. A submission is identified by its conversation, its
+# position in it and its text, so widget callbacks firing twice for one click, or a rerun that interrupts a
+# question still being answered, pick up the pending result instead of asking the models again.
+
+SUBMISSION_TTL = 600 # seconds a finished answer is kept for reruns that ask for it again
+FINISHED_SUBMISSIONS = 256 # finished answers kept; submissions still running are never evicted
+SUBMISSION_WORKERS = 16 # questions being answered at once across all sessions
+
+@dataclass(frozen=True)
+class Submission:
+    id: str
+    question: str
+
+    @classmethod
+    def create(cls, conversation_id, turn, question):
+        key = f"{conversation_id}\x00{turn}\x00{question}".encode("utf-8")
+        return cls(hashlib.sha256(key).hexdigest()[:16], question)
+
+class SharedStream:
+    # The chunks of an answer, drained once in the background and replayed to every reader: a rerun that picks up
+    # an answer still being generated shows it from the start and then follows along
+
+    def __init__(self, source):
+        self.source = source # the engine's TimedStream
+        self.pipeline = source.pipeline
+        self.parts = []
+        self.done = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def drain(self):
+        try:
+            for chunk in self.source:
+                with self._cond:
+                    self.parts.append(chunk)
+                    self._cond.notify_all()
+        except BaseException as e:
+            self.error = e
+        with self._cond:
+            self.done = True
+            self._cond.notify_all()
+
+    def __iter__(self):
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self.parts) and not self.done:
+                    self._cond.wait()
+                if i < len(self.parts):
+                    chunk = self.parts[i]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            i += 1
+            yield chunk
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def timings(self):
+        return self.source.timings()
+
+class SubmissionRegistry:
+    # Process-wide; shared by every session
+
+    def __init__(self, ttl=SUBMISSION_TTL, max_workers=SUBMISSION_WORKERS, maxsize=FINISHED_SUBMISSIONS):
+        self.running = {} # submission id -> Future of the engine.Answer, until its stream is drained
+        self.results = TTLCache(ttl, maxsize=maxsize) # the same for finished submissions
+        self.executed = 0
+        self.shared = 0 # submissions that were already running or answered
+        self.reruns = 0 # reruns with a question in the box but nothing submitted
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="capstruct-submission")
+        self._lock = threading.Lock()
+
+    def _execute(self, submission, future, fn, args, kwargs):
+        try:
+            answer = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(submission, None) # a resubmission gets a fresh try
+            future.set_exception(e)
+            return
+        stream = SharedStream(answer.stream)
+        future.set_result(replace(answer, stream=stream))
+        stream.drain() # runs to the end even if the script run that asked is stopped by a rerun
+        self._finish(submission, future if stream.error is None else None)
+
+    def _finish(self, submission, future):
+        # Unpins a submission; a finished answer is kept for reruns, a failed one is dropped
+        with self._lock:
+            self.running.pop(submission.id, None)
+            if future is not None:
+                self.results.set(submission.id, future)
+
+    def run(self, submission, fn, *args, **kwargs):
+        # The engine.Answer of fn(*args, **kwargs) (e.g. engine.answer_question) for this submission, with its stream
+        # replaced by a SharedStream. Only the first call for a submission id runs fn; it runs in the background.
+        with self._lock:
+            future = self.running.get(submission.id) or self.results.get(submission.id)
+            if future is None:
+                future = self.running[submission.id] = Future()
+                self.executed += 1
+                self._executor.submit(self._execute, submission, future, fn, args, kwargs)
+            else:
+                self.shared += 1
+        return future.result()
+
+    def forget(self, submission):
+        # Drops a finished submission, e.g. one whose answer failed, so asking again runs it again
+        with self._lock:
+            self.results.pop(submission.id)
+
+    def skip(self):
+        # A rerun that the old `if question or send_button:` check would have answered again
+        with self._lock:
+            self.reruns += 1
+
+    def stats(self):
+        with self._lock:
+            return {"executed": self.executed, "shared": self.shared, "running": len(self.running), "reruns_skipped": self.reruns,
+                    "duplicates_suppressed": self.shared + self.reruns}
+
+_submissions = SubmissionRegistry()
+
+def get_submissions():
+    # The process-wide registry; module state survives Streamlit reruns
+    return _submissions
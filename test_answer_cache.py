@@ -0,0 +1,33 @@
+from answer_cache import AnswerCache
+from conversation_memory import ConversationMemory
+from engine import Backends, RagEngine
+from fakes import FakeComplete, FakeSearchService, Latency, make_corpus
+
+def make_engine():
+    complete = FakeComplete(latency=Latency(0), first_token=Latency(0), token_interval=Latency(0))
+    engine = RagEngine(Backends(complete, FakeSearchService(make_corpus(n_docs=6), latency=Latency(0))),
+                       answer_cache=AnswerCache())
+    return engine, complete
+
+def ask(engine, question, memory):
+    answer = engine.answer_question(question, memory)
+    text = "".join(answer.stream)
+    memory.add("user", question)
+    memory.add("assistant", text)
+    return answer
+
+def test_repeated_question_is_answered_from_the_cache():
+    engine, complete = make_engine()
+    assert not ask(engine, "What is the minimum guardrail height for a balcony?", ConversationMemory()).cached
+    answered = complete.log.calls["complete:mistral-large2"]
+    assert ask(engine, "What is the minimum guardrail height for a balcony?", ConversationMemory()).cached
+    assert complete.log.calls["complete:mistral-large2"] == answered
+
+def test_question_that_refers_to_history_is_not_answered_from_the_cache():
+    engine, _ = make_engine()
+    ask(engine, "Is that also the minimum for a balcony?", ConversationMemory())
+    assert ask(engine, "Is that also the minimum for a balcony?", ConversationMemory()).cached # no history to refer to
+    memory = ConversationMemory()
+    ask(engine, "What is the minimum guardrail height for a deck?", memory)
+    assert not ask(engine, "Is that also the minimum for a balcony?", memory).cached
+    assert engine.answer_cache.stats()["hits"] == 1
@@ -0,0 +1,24 @@
+import pytest
+
+from category_router import ALL, CategoryRouter
+
+def no_llm(query):
+    raise AssertionError(f"asked the LLM to classify {query!r}")
+
+@pytest.mark.parametrize("question, category", [
+    ("What does the plumbing code say about backflow prevention?", "Plumbing"),
+    ("plumbing code for water heater venting", "Plumbing"),
+    ("What are the fire code requirements for extinguishers?", "Fire"),
+    ("Electrical code rules for GFCI outlets in kitchens", "Electrical"),
+    ("What does WorkSafe BC require for scaffolds?", "Safety"),
+    ("What does the building code say about handrail height?", "Building Code"),
+    ("What does the energy step code say about heat pumps?", "Sustainability"),
+    ("According to the fire code, how many extinguishers does a parking garage need?", "Fire"),
+    ("What are the fire protection requirements for parking garages?", ALL),
+    ("What plumbing fixtures are needed in a washroom?", ALL),
+    ("How high should a guardrail be?", ALL),
+])
+def test_representative_questions_route_without_the_llm(question, category):
+    route = CategoryRouter(fallback=no_llm).route(question)
+    assert route.category == category
+    assert route.source != "llm"
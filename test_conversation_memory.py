@@ -0,0 +1,34 @@
+from conversation_memory import ConversationMemory
+
+class HeldExecutor:
+    # Runs submitted summaries only when told to, like a summary model that is taking its time
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        self.jobs.append((fn, args))
+
+    def run_all(self):
+        jobs, self.jobs = self.jobs, []
+        for fn, args in jobs:
+            fn(*args)
+
+def summarize(summary, messages):
+    return "\n".join(filter(None, [summary] + [f"summarized {message['content']}" for message in messages]))
+
+def test_pending_is_capped_while_a_summary_is_running():
+    executor = HeldExecutor()
+    memory = ConversationMemory(max_messages=2, summarize_every=2, summarizer=summarize, executor=executor)
+    for i in range(20):
+        memory.add("user", f"Question {i}. Details.")
+        assert len(memory.pending) <= 4 # the two being summarized and at most two more
+    assert len(executor.jobs) == 1
+
+    text = memory.prompt_text()
+    assert text.index("user: Question 0") < text.index("user: Question 2") < text.index("user: Question 15")
+    assert "user: Question 5\n" in text and "Question 5. Details" not in text # folded to its first sentence
+
+    executor.run_all()
+    assert memory.summary.startswith("summarized Question 0. Details.\nsummarized Question 1. Details.\nuser: Question 2")
+    assert [message["content"] for message in memory.pending] == ["Question 16. Details.", "Question 17. Details."]
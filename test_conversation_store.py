@@ -0,0 +1,24 @@
+import pytest
+
+from conversation_store import ConversationStore
+
+def make_store():
+    store = ConversationStore(":memory:")
+    store.append("chat", "user", "How tall must a guardrail be?")
+    store.append("chat", "assistant", "At least 1070 mm. " * 40) # long enough to be stored compressed
+    return store
+
+def test_export_bytes():
+    store = make_store()
+    data = store.export_bytes("chat")
+    assert data.startswith(b"user: How tall must a guardrail be?\nassistant: At least 1070 mm.")
+    assert data == "".join(store.export("chat")).encode("utf-8")
+    assert store.export_bytes("unknown") == b""
+
+def test_export_is_valid_download_data():
+    # What st.download_button does with its `data` before it renders
+    pytest.importorskip("streamlit")
+    from streamlit.elements.widgets.button import marshall_file
+    from streamlit.proto.DownloadButton_pb2 import DownloadButton
+
+    marshall_file("chat", make_store().export_bytes("chat"), DownloadButton(), "text/plain", "chat_history.txt")
@@ -0,0 +1,22 @@
+import category_router
+import context_builder
+from engine import Backends, RagEngine
+from eval_cache import variant_fingerprint
+
+def fingerprint():
+    return variant_fingerprint("improved", RagEngine(Backends(None, None)), corpus=None, feedback=None)
+
+def test_fingerprint_covers_router_and_context_packing(monkeypatch):
+    before = fingerprint()
+    assert fingerprint() == before
+
+    monkeypatch.setattr(category_router, "SEED_EXAMPLES", category_router.SEED_EXAMPLES[:-1])
+    assert fingerprint() != before
+    monkeypatch.undo()
+
+    monkeypatch.setattr(category_router, "SOURCE_WEIGHT", category_router.SOURCE_WEIGHT + 1)
+    assert fingerprint() != before
+    monkeypatch.undo()
+
+    monkeypatch.setattr(context_builder, "MAX_OVERLAP", context_builder.MAX_OVERLAP + 1)
+    assert fingerprint() != before
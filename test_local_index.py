@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from fakes import make_corpus
+from local_index import LocalIndex, build_index
+
+def test_top_limits(tmp_path):
+    build_index(make_corpus(n_docs=4), str(tmp_path))
+    index = LocalIndex.load(str(tmp_path))
+    assert index.top("guardrail height", limit=0) == []
+    assert index.top("guardrail height", limit=-1) == []
+    best = index.top("guardrail height", limit=3)
+    assert len(best) == 3 and best[0][1] >= best[1][1] >= best[2][1]
+    assert index.top("guardrail height", limit=1) == best[:1]
@@ -0,0 +1,36 @@
+import time
+
+from cache import TTLCache
+from fakes import FakeProvider, Latency
+from relevance_filter import DROP, RelevanceFilter
+
+QUERY = "minimum guardrail height for a balcony"
+CHUNKS = [
+    "Guardrail height shall be at least 1070 mm for a balcony.",
+    "Handrail height on a stair shall be between 865 mm and 965 mm.",
+    "Sprinkler heads in a parking garage shall be spaced at most 4.6 m apart.",
+    "A balcony guardrail shall not be climbable.",
+    "Exit signs shall be illuminated.",
+]
+
+def test_late_scores_land_in_the_cache():
+    provider = FakeProvider(latency=Latency(0.2))
+    relevance_filter = RelevanceFilter(provider.context_relevance, 0.6, max_workers=5, timeout=0.05,
+                                       fallback=DROP, cache=TTLCache(60))
+    assert relevance_filter.filter(QUERY, CHUNKS) == []
+    assert relevance_filter.stats()["timed_out"] == 5
+
+    time.sleep(0.3) # the abandoned calls finish in the background
+    kept = relevance_filter.filter(QUERY, CHUNKS)
+    assert kept == [CHUNKS[0], CHUNKS[3]]
+    assert provider.log.calls["relevance"] == 5 # the second request was answered from the cache
+
+def test_chunks_not_started_by_the_deadline_are_never_scored():
+    provider = FakeProvider(latency=Latency(0.2))
+    relevance_filter = RelevanceFilter(provider.context_relevance, 0.6, max_workers=2, timeout=0.05,
+                                       fallback=DROP, cache=TTLCache(60))
+    relevance_filter.filter(QUERY, CHUNKS)
+    time.sleep(0.3)
+    stats = relevance_filter.stats()
+    assert stats["timed_out"] == 2 and stats["skipped"] == 3
+    assert provider.log.calls["relevance"] == 2
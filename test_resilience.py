@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+from fakes import FakeComplete, Latency
+from resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded, ResilientComplete
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class Latencies(Latency):
+    # Each call takes the next of the given latencies, then the last one
+
+    def __init__(self, *seconds):
+        super().__init__(0)
+        self.seconds = list(seconds)
+
+    def sample(self):
+        with self._lock:
+            return self.seconds.pop(0) if len(self.seconds) > 1 else self.seconds[0]
+
+def test_breaker_opens_then_half_opens():
+    clock = Clock()
+    fake = FakeComplete(latency=Latency(0), failure_rate=1.0)
+    complete = ResilientComplete(fake, retries=0, hedge=False,
+                                 make_breaker=lambda: CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock))
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match="injected"):
+            complete("mistral-large2", "Rewrite <question>guardrail height</question>")
+    with pytest.raises(CircuitOpenError):
+        complete("mistral-large2", "Rewrite <question>guardrail height</question>")
+    assert fake.log.calls["complete:mistral-large2"] == 2
+    assert complete.stats()["breakers_open"] == ["mistral-large2/complete"]
+
+    clock.now += 10
+    fake.failure_rate = 0.0
+    assert complete("mistral-large2", "Rewrite <question>guardrail height</question>") == "guardrail height"
+    assert complete.breaker("mistral-large2", None).state == "closed"
+    assert complete.stats()["breaker_opens"] == 1
+
+def test_failed_trial_reopens_without_retrying():
+    clock = Clock()
+    fake = FakeComplete(latency=Latency(0), failure_rate=1.0)
+    complete = ResilientComplete(fake, retries=2, backoff=0, hedge=False,
+                                 make_breaker=lambda: CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock))
+    with pytest.raises(RuntimeError):
+        complete("mistral-large2", "Rewrite <question>guardrail height</question>")
+    clock.now += 10
+    with pytest.raises(RuntimeError):
+        complete("mistral-large2", "Rewrite <question>guardrail height</question>")
+    assert fake.log.calls["complete:mistral-large2"] == 2
+    assert complete.breaker("mistral-large2", None).state == "open"
+
+def test_hedge_wins_when_the_first_attempt_is_slow():
+    fake = FakeComplete(latency=Latencies(1.0, 0.01))
+    complete = ResilientComplete(fake, default_timeout=0.4, retries=0)
+    start = time.monotonic()
+    assert complete("mistral-large2", "Rewrite <question>guardrail height</question>") == "guardrail height"
+    assert time.monotonic() - start < 0.5
+    stats = complete.stats()
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+
+def test_retries_share_the_stage_timeout():
+    fake = FakeComplete(latency=Latency(0.5))
+    complete = ResilientComplete(fake, default_timeout=0.2, retries=2, backoff=0, hedge=False)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        complete("mistral-large2", "Rewrite <question>guardrail height</question>")
+    assert time.monotonic() - start < 0.35
+    assert fake.log.calls["complete:mistral-large2"] == 1
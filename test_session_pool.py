@@ -0,0 +1,76 @@
+import pytest
+
+from fakes import FakeSession, Latency
+from session_pool import PoolTimeout, SessionPool, SharedSession
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def make_pool(**kwargs):
+    sessions = []
+
+    def connect():
+        sessions.append(FakeSession(latency=Latency(0)))
+        return sessions[-1]
+
+    return SessionPool(connect, **kwargs), sessions
+
+def test_checkout_times_out_when_every_session_is_in_use():
+    pool, _ = make_pool(max_size=1)
+    session = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire(timeout=0.05)
+    assert pool.stats()["timeouts"] == 1
+    pool.release(session)
+    assert pool.acquire(timeout=0.05) is session
+
+def test_dead_idle_session_is_replaced_on_checkout():
+    clock = Clock()
+    pool, sessions = make_pool(max_size=1, health_check_interval=300, clock=clock)
+    pool.run(lambda session: None)
+    sessions[0].close() # expired while idle
+    clock.now += 300
+    session = pool.acquire()
+    assert session is sessions[1]
+    assert pool.stats()["discarded"] == 1 and pool.size == 1
+    pool.release(session)
+
+def test_run_retries_on_another_session_when_its_session_died():
+    pool, sessions = make_pool(max_size=2)
+    pool.run(lambda session: None)
+    sessions[0].close()
+    rows = pool.run(lambda session: session.sql("select 1", params=["doc.pdf"]).collect())
+    assert rows[0]["RELATIVE_PATH"] == "doc.pdf"
+    assert pool.stats()["discarded"] == 1 and sessions[1].closed is False
+
+def test_stream_holds_its_session_until_exhausted_or_closed():
+    pool, _ = make_pool(max_size=1)
+    stream = pool.stream(lambda session: iter(["Guards ", "are ", "required."]))
+    assert next(stream) == "Guards "
+    assert pool.in_use == 1
+    assert "".join(stream) == "are required."
+    assert pool.in_use == 0
+
+    stream = pool.stream(lambda session: iter(["Guards ", "are ", "required."]))
+    next(stream)
+    stream.close()
+    stream.close()
+    assert pool.in_use == 0 and len(pool.idle) == 1
+
+def fail(session):
+    raise RuntimeError("query failed")
+
+def test_shared_session_is_never_closed():
+    session = FakeSession(latency=Latency(0))
+    pool = SharedSession(session)
+    stream = pool.stream(lambda session: iter(["a", "b"]))
+    assert pool.run(lambda session: session) is session # not queued behind the open stream
+    assert list(stream) == ["a", "b"]
+    with pytest.raises(RuntimeError):
+        pool.run(fail)
+    assert pool.in_use == 0 and session.closed is False
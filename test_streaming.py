@@ -0,0 +1,25 @@
+import time
+
+from pipeline import StagePipeline
+from streaming import TimedStream
+
+def slow_answer(seconds):
+    time.sleep(seconds)
+    return "Guards are required where the drop exceeds 600 mm."
+
+def test_non_streamed_answer_keeps_its_stage_timing():
+    with StagePipeline() as pipeline:
+        answer = pipeline.run("answer", slow_answer, 0.05)
+    recorded = pipeline.timings["answer"]
+    stream = TimedStream(answer, pipeline)
+    assert "".join(stream) == answer
+    assert pipeline.timings["answer"] == recorded
+    assert recorded[1] - recorded[0] >= 0.05
+    assert stream.timings()["time_to_first_token_s"] is not None
+
+def test_streamed_answer_is_timed_when_consumed():
+    with StagePipeline() as pipeline:
+        stream = TimedStream(iter(["Guards ", "are ", "required."]), pipeline)
+    assert "answer" not in pipeline.timings
+    assert "".join(stream) == "Guards are required."
+    assert "answer" in pipeline.timings
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conversation_memory import ConversationMemory
+from engine import Backends, RagEngine
+from fakes import FakeComplete, FakeSearchService, Latency, make_corpus
+from submissions import Submission, SubmissionRegistry
+
+def make_engine():
+    complete = FakeComplete(latency=Latency(0.01), first_token=Latency(0.05), token_interval=Latency(0.001))
+    return RagEngine(Backends(complete, FakeSearchService(make_corpus(n_docs=6), latency=Latency(0)))), complete
+
+def test_each_submission_runs_once():
+    engine, complete = make_engine()
+    registry = SubmissionRegistry()
+    submission = Submission.create("chat", 0, "What is the minimum guardrail height for a balcony?")
+    executions = []
+
+    def answer_question(question):
+        executions.append(question)
+        return engine.answer_question(question, ConversationMemory(), stream=True)
+
+    # a double-fired callback and reruns asking for the same submission while it is still being answered
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        answers = list(executor.map(lambda _: registry.run(submission, answer_question, submission.question), range(4)))
+    texts = ["".join(answer.stream) for answer in answers]
+
+    assert len(executions) == 1
+    assert complete.log.calls["complete:mistral-large2"] == 1
+    assert len(set(texts)) == 1 and texts[0]
+    assert registry.stats()["executed"] == 1 and registry.stats()["shared"] == 3
+
+    # a rerun after it finished gets the kept answer
+    assert "".join(registry.run(submission, answer_question, submission.question).stream) == texts[0]
+    assert len(executions) == 1
+
+def test_failed_submission_runs_again():
+    registry = SubmissionRegistry()
+    submission = Submission.create("chat", 0, "What is the minimum guardrail height for a balcony?")
+    attempts = []
+
+    def fail(question):
+        attempts.append(question)
+        raise RuntimeError("search service unavailable")
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            registry.run(submission, fail, submission.question)
+    assert len(attempts) == 2
+    assert registry.stats()["running"] == 0
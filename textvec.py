@@ -0,0 +1,38 @@
+import math
+import re
+import zlib
+from collections import Counter
+
+N_FEATURES = 4096 # hashed feature space, small enough to keep every vector in memory
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+def bucket(feature, n_features):
+    # crc32 rather than hash() so vectors are stable across processes and restarts
+    return zlib.crc32(feature.encode("utf-8")) % n_features
+
+def hashed_features(text, n_features=N_FEATURES, ngrams=2):
+    # Sparse bag of hashed word n-grams: {bucket: count}
+    tokens = tokenize(text)
+    features = Counter()
+    for n in range(1, ngrams + 1):
+        for i in range(len(tokens) - n + 1):
+            features[bucket(" ".join(tokens[i:i + n]), n_features)] += 1
+    return features
+
+def norm(vector):
+    return math.sqrt(sum(value * value for value in vector.values()))
+
+def cosine(a, b, norm_a=None, norm_b=None):
+    if len(a) > len(b):
+        a, b = b, a
+        norm_a, norm_b = norm_b, norm_a
+    dot = sum(value * b.get(key, 0) for key, value in a.items())
+    if dot == 0:
+        return 0.0
+    norm_a = norm_a if norm_a is not None else norm(a)
+    norm_b = norm_b if norm_b is not None else norm(b)
+    return dot / (norm_a * norm_b)
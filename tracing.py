@@ -0,0 +1,128 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from pipeline import current_pipeline
+
+TRACE_ENV = "CAPSTRUCT_TRACE" # unset or "0": off, "1": JSON lines to stderr, anything else: path of a JSON lines file
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
+CALL_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21) # backend calls per request
+
+@contextmanager
+def span(name, pipeline=None):
+    # Times a block as a stage of the request, for work that doesn't go through StagePipeline.run()/submit()
+    pipeline = pipeline or current_pipeline()
+    if pipeline is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        pipeline.record(name, start, time.perf_counter())
+
+class Histogram:
+    # Fixed-bucket histogram; percentiles are reported as the upper bound of the bucket they fall in, capped at the max
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last bucket holds everything above buckets[-1]
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+class Tracer:
+    # Turns each finished request's StagePipeline into one JSON line and folds it into process-wide histograms
+    # of stage latency and backend calls. When disabled, finish() returns straight away and nothing is kept.
+
+    def __init__(self, enabled=False, output=None):
+        self.enabled = enabled
+        self.output = output # a path, or a file object such as sys.stderr
+        self.stages = {}
+        self.calls = {}
+        self.requests = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        setting = environ.get(TRACE_ENV, "")
+        if setting in ("", "0"):
+            return cls()
+        return cls(enabled=True, output=sys.stderr if setting == "1" else setting)
+
+    def _write(self, line):
+        if self.output is None:
+            return
+        if self._file is None:
+            self._file = open(self.output, "a") if isinstance(self.output, str) else self.output
+        self._file.write(line + "\n")
+        self._file.flush()
+
+    def finish(self, pipeline, kind, **attrs):
+        # Returns the request id written to the log, or None when tracing is off
+        if not self.enabled or pipeline is None:
+            return None
+
+        breakdown = pipeline.breakdown()
+        request_id = uuid.uuid4().hex[:12]
+        record = {"ts": round(time.time(), 3), "request_id": request_id, "kind": kind, **attrs, **breakdown}
+        line = json.dumps(record, default=str)
+
+        with self._lock:
+            self.requests += 1
+            durations = {name: stage["duration_s"] for name, stage in breakdown["stages"].items() if not stage["discarded"]}
+            durations["request"] = breakdown["wall_clock_s"]
+            if breakdown["time_to_first_token_s"] is not None:
+                durations["first_token"] = breakdown["time_to_first_token_s"]
+            for name, duration in durations.items():
+                self.stages.setdefault(name, Histogram()).observe(duration)
+            for backend in set(self.calls) | set(breakdown["calls"]):
+                self.calls.setdefault(backend, Histogram(CALL_BUCKETS)).observe(breakdown["calls"].get(backend, 0))
+            self._write(line)
+        return request_id
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "stages_s": {name: histogram.snapshot() for name, histogram in self.stages.items()},
+                "calls_per_request": {backend: histogram.snapshot() for backend, histogram in self.calls.items()},
+            }
+
+_tracer = Tracer.from_env()
+
+def get_tracer():
+    # The process-wide tracer, configured from the CAPSTRUCT_TRACE environment variable
+    return _tracer
@@ -8,162 +8,97 @@ from trulens.connectors.snowflake import SnowflakeConnector
 from trulens.providers.cortex.provider import Cortex
 from trulens.apps.custom import instrument
 
-import json
 from snowflake.snowpark.context import get_active_session
-from trulens.core.guardrails.base import context_filter
 import nltk
 
-# Download the NLTK data
-nltk.download('punkt_tab')
+from conversation_memory import ConversationMemory, make_llm_summarizer
+from engine import Backends, RagEngine
+from pipeline import StagePipeline, count_call, current_pipeline
+from relevance_filter import RelevanceFilter
+from search_client import CachingSearchClient
+from tracing import get_tracer
 
 NUM_CHUNKS = 5
 MIN_SCORE = 0.6
+ROUTER_THRESHOLD = 0.8
+CONTEXT_TOKEN_BUDGET = 2000
 
 CORTEX_SEARCH_DATABASE = "CC_QUICKSTART_CORTEX_SEARCH_DOCS"
 CORTEX_SEARCH_SCHEMA = "DATA"
 CORTEX_SEARCH_SERVICE = "CC_SEARCH_SERVICE_CS"
 
+CONNECTION_PARAMS = {
+  "account":  "<account>",
+  "user": "<user>",
+  "password": "<password>",
+  "role": "<role>",
+  "database": CORTEX_SEARCH_DATABASE,
+  "schema": CORTEX_SEARCH_SCHEMA,
+  "warehouse": "COMPUTE_WH"
+}
+
+PROMPTS = ["What are the structural integrity requirements for foundation systems in Vancouver for buildings over 100 feet tall, particularly in seismic zones?",
+           "What are the fire protection and smoke ventilation requirements for underground parking garages in Vancouver according to the BC Building Code?",
+           "What are the specific design requirements for load-bearing walls in multi-story commercial buildings under Vancouver’s seismic regulations?",
+           "What are the ventilation system requirements for industrial facilities in Vancouver that handle hazardous materials to ensure worker safety?",
+           "What are the energy efficiency and insulation requirements for residential buildings in Vancouver, particularly in terms of thermal resistance (R-values)?",
+           "What are the construction site signage requirements for hazardous areas, such as those with high-voltage equipment, in Vancouver?",
+           "What are the requirements for soil contamination testing before commencing construction in Vancouver?"
+           ]
+
+def complete(model, prompt, stream=False):
+    count_call("complete")
+    return Complete(model, prompt, stream=stream)
+
 class CapstructAI:
+    # The app's request path (engine.RagEngine) without Streamlit, with the retrieval step instrumented for TruLens
+
+    def __init__(self ,svc, complete=complete, relevance_filter=None):
+        self.engine = RagEngine(Backends(complete, svc), relevance_filter=relevance_filter, num_chunks=NUM_CHUNKS,
+                                min_score=MIN_SCORE, router_threshold=ROUTER_THRESHOLD,
+                                context_token_budget=CONTEXT_TOKEN_BUDGET)
+        self.chat_history = ConversationMemory(summarizer=make_llm_summarizer(complete, self.engine.models))
+        self.last_retrieval = None
+        self.last_errors = []
 
-    def __init__(self ,svc):
-        self.svc = svc
-        self.chat_history = []
-        self.columns = [
-                        "chunk",
-                        "relative_path",
-                        "category"
-                        ]
-    
     @instrument        
     def retrieve_context(self, query):
-        prompt = f"""
-            Based on the QUESTION in between the <question> and </question> tags, if the user explicitly asks to search for a specific 
-            category of documents that matches one of the categories below, then answer in one word from the options below. Simply having the 
-            word in the question is not sufficient, the user must ask for an answer using the category of documents:
-            1. Safety
-            2. Building Code
-            3. Sustainability
-            4. Plumbing
-            5. Fire
-            6. Electrical
-    
-            In all other cases, answer "ALL"
-            
-            <question>
-            {query}
-            </question>
-            """
-        cat = Complete('mistral-large2', prompt)
-        cat = cat.replace("'", "").strip()
-        
-        if cat == "ALL":
-            response = self.svc.search(query, self.columns, limit=NUM_CHUNKS)
-        else:
-            filter_obj = {"@eq":{"category": cat}}
-            response = self.svc.search(query, self.columns, filter=filter_obj, limit=NUM_CHUNKS)
-                
-        if response.results:
-            results =  [curr["chunk"] for curr in response.results]
-            ret = response.json()
-        else:
-            results = []
-            ret = ""
-        
-        return results, ret
-        
-    def optimize_query(self, question):
-        prompt = f"""
-            Based on the QUESTION between the <question> and </question> tags, 
-            generate a query that is easier for you to understand, whether it is by writing out commonly used abbreviations, or narrowing ambiguities. 
-            If the user attempts to rate your response in the QUESTION, generate a prompt commanding you to thank the user for their feedback if it is positive, or 
-            apologize and promise to do better if it is negative.
-            If the query is explicitly referencing previous information given by either you or the user, extend the QUESTION with the CHAT HISTORY 
-            provided between the <chat_history> and </chat_history> tags.
-            The query should be in natual language. 
-            Answer with only the query. Do not add any explanation.
-            
-            <question>
-            {question}
-            </question>
-            <chat_history>
-            {self.chat_history}
-            </chat_history>
-            """
-        
-        sumary = Complete('mistral-large2', prompt)   
-    
-        sumary = sumary.replace("'", "")
-    
-        return sumary
-    
-    def create_prompt(self, myquestion):
-    
-        optimized_query = self.optimize_query(myquestion)
-        _, prompt_context = self.retrieve_context(optimized_query)
-        prompt = f"""
-               You are an expert chat assistant that extracts information from the CONTEXT provided
-               between <context> and </context> tags.
-               You offer a chat experience considering the information included in the CHAT HISTORY
-               provided between <chat_history> and </chat_history> tags.
-               When answering the question contained between <question> and </question> tags
-               be concise and do not hallucinate.  
-               If you don't have the information, just say so.
-               
-               Do not mention the CONTEXT used in your answer.
-               Do not mention the CHAT HISTORY used in your answer.
-    
-               If you can't answer the question from the CONTEXT provided, answer ignoring the CONTEXT and CHAT HISTORY, but also state that 
-               "This is the best answer I can provide with the available data. Please verify the information with the reference documents linked in 
-               the sidebar to ensure full compliance with relevant regulations." and bold the text if possible.
-               
-               If the user attempts to rate your response, either thank the user for their feedback if it is positive, or apologize and promise to do better
-               if it is negative.
-               
-               <chat_history>
-               {self.chat_history}
-               </chat_history>
-               <context>          
-               {prompt_context}
-               </context>
-               <question>  
-                {optimized_query}
-               </question>
-               Answer: 
-               """
-    
-        return prompt
+        pipeline = current_pipeline() or StagePipeline()
+        self.last_retrieval = self.engine.retrieve(query, pipeline, self.last_errors)
+        return self.last_retrieval.chunks, self.last_retrieval.context_json()
 
     @instrument
     def query(self, myquestion):
     
-        prompt = self.create_prompt(myquestion)
-    
-        response = Complete('mistral-large2', prompt)  
+        self.last_errors = []
+        with StagePipeline() as pipeline:
+            optimized_query = pipeline.run("rewrite", self.engine.optimize_query, self.chat_history, myquestion)
+            self.retrieve_context(optimized_query)
+            prompt = self.engine.build_prompt(optimized_query, self.chat_history, self.last_retrieval, pipeline)
+            response = pipeline.run("answer", self.engine.complete, self.engine.answer_model, prompt)
+        self.last_breakdown = pipeline.breakdown()
+        get_tracer().finish(pipeline, type(self).__name__)
 
-        self.chat_history.append({"role": "user", "content": myquestion})
-        self.chat_history.append({"role": "assistant", "content": response})
+        self.chat_history.add("user", myquestion)
+        self.chat_history.add("assistant", response)
         return response
     
-def main():
-    connection_params = {
-      "account":  "<account>",
-      "user": "<user>",
-      "password": "<password>",
-      "role": "<role>",
-      "database": CORTEX_SEARCH_DATABASE,
-      "schema": CORTEX_SEARCH_SCHEMA,
-      "warehouse": "COMPUTE_WH"
-    }
-    
+class CapstructAI_v1(CapstructAI):
+    # CapstructAI with retrieved chunks filtered by context relevance before they reach the prompt
+
+    def __init__(self, svc, relevance_filter, complete=complete):
+        super().__init__(svc, complete, relevance_filter)
+
+def connect(connection_params=CONNECTION_PARAMS):
     snowpark_session =  Session.builder.configs(connection_params).create()
     root = Root(snowpark_session)                         
-    svc = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE]
-    
-    snowpark_connector = SnowflakeConnector(snowpark_session=snowpark_session)
-    tru_session = TruSession(connector=snowpark_connector)
-    
-    provider = Cortex(snowpark_session=snowpark_session, model_engine="llama3.1-8b")
+    svc = CachingSearchClient(
+        root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE],
+        name=CORTEX_SEARCH_SERVICE,
+    )
+    return snowpark_session, svc
 
+def build_feedbacks(provider):
     f_groundedness = (
         Feedback(provider.groundedness_measure_with_cot_reasons, name="Groundedness")
         .on(Select.RecordCalls.retrieve_context.rets[0][:].collect())
@@ -183,89 +118,54 @@ def main():
         .on_output()
         .aggregate(np.mean)
     )
+
+    return [f_groundedness, f_answer_relevance, f_context_relevance]
+    
+def main():
+    # Download the NLTK data
+    nltk.download('punkt_tab')
+
+    snowpark_session, svc = connect()
+    
+    snowpark_connector = SnowflakeConnector(snowpark_session=snowpark_session)
+    tru_session = TruSession(connector=snowpark_connector)
+    
+    provider = Cortex(snowpark_session=snowpark_session, model_engine="llama3.1-8b")
+    feedbacks = build_feedbacks(provider)
     
     rag = CapstructAI(svc)
     tru_rag = TruCustomApp(
         rag,
         app_name="CapstructAI",
         app_version="simple",
-        feedbacks=[f_groundedness, f_answer_relevance, f_context_relevance]
+        feedbacks=feedbacks
         )
-        
-    prompts = ["What are the structural integrity requirements for foundation systems in Vancouver for buildings over 100 feet tall, particularly in seismic zones?",
-               "What are the fire protection and smoke ventilation requirements for underground parking garages in Vancouver according to the BC Building Code?",
-               "What are the specific design requirements for load-bearing walls in multi-story commercial buildings under Vancouver’s seismic regulations?",
-               "What are the ventilation system requirements for industrial facilities in Vancouver that handle hazardous materials to ensure worker safety?",
-               "What are the energy efficiency and insulation requirements for residential buildings in Vancouver, particularly in terms of thermal resistance (R-values)?",
-               "What are the construction site signage requirements for hazardous areas, such as those with high-voltage equipment, in Vancouver?",
-               "What are the requirements for soil contamination testing before commencing construction in Vancouver?"
-               ]
     
     with tru_rag as recording:
-        for prompt in prompts:
+        for prompt in PROMPTS:
             print(prompt)
             response = rag.query(prompt)
             print(response)
+            print(rag.last_breakdown["calls"], rag.last_breakdown["prompt"])
     print("getting results")
     tru_session.get_leaderboard()
 
-    f_context_relevance_score = (
-        Feedback(provider.context_relevance, name="Context Relevance")
-    )
-
-    class CapstructAI_v1(CapstructAI):
-        
-        @instrument
-        @context_filter(f_context_relevance_score, MIN_SCORE, keyword_for_prompt="query")
-        def retrieve_context(self, query):
-            prompt = f"""
-                Based on the QUESTION in between the <question> and </question> tags, if the user explicitly asks to search for a specific 
-                category of documents that matches one of the categories below, then answer in one word from the options below. Simply having the 
-                word in the question is not sufficient, the user must ask for an answer using the category of documents:
-                1. Safety
-                2. Building Code
-                3. Sustainability
-                4. Plumbing
-                5. Fire
-                6. Electrical
-        
-                In all other cases, answer "ALL"
-                
-                <question>
-                {query}
-                </question>
-                """
-            cat = Complete('mistral-large2', prompt)
-            cat = cat.replace("'", "").strip()
-            
-            if cat == "ALL":
-                response = self.svc.search(query, self.columns, limit=NUM_CHUNKS)
-            else:
-                filter_obj = {"@eq":{"category": cat}}
-                response = self.svc.search(query, self.columns, filter=filter_obj, limit=NUM_CHUNKS)
-                        
-            if response.results:
-                results =  [curr["chunk"] for curr in response.results]
-                ret = response.json()
-            else:
-                results = []
-                ret = ""
-                
-            return results, ret
+    relevance_filter = RelevanceFilter(provider.context_relevance, MIN_SCORE, max_workers=NUM_CHUNKS)
 
-    improved_rag = CapstructAI_v1(svc)
+    improved_rag = CapstructAI_v1(svc, relevance_filter)
     tru_filtered_rag = TruCustomApp(
         improved_rag,
         app_name="CapstructAI",
         app_version="improved",
-        feedbacks=[f_groundedness, f_answer_relevance, f_context_relevance],
+        feedbacks=feedbacks,
     )
 
     with tru_filtered_rag as recording:
-        for prompt in prompts:
+        for prompt in PROMPTS:
             print(prompt)
             response = improved_rag.query(prompt)
             print(response)
+            print(improved_rag.last_breakdown["calls"], improved_rag.last_breakdown["prompt"])
     
     tru_session.get_leaderboard()
 